@@ -0,0 +1,158 @@
+from collections.abc import Callable
+from dataclasses import dataclass
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+from city_road_network.algo.csr import CSRGraph
+
+TREES_MEMORY_BYTES = 64 * 2**20  # budget for shortest path trees computed at once, per process
+TREE_BYTES_PER_NODE = 64  # distances, predecessors, flow and the flattened copies `push_up_trees` makes
+MAX_SOURCES_CHUNK = 256
+LINE_SEARCH_STEPS = 30
+
+
+@dataclass(frozen=True)
+class AssignmentIteration:
+    iteration: int
+    relative_gap: float
+    step: float
+    total_travel_time: float
+
+
+def get_csgraph(csr: CSRGraph, weight: str) -> csr_matrix:
+    """Slot weights as a scipy sparse matrix. Explicit zeros are kept, csgraph treats them as edges."""
+    return csr_matrix((csr.weights[weight], csr.indices, csr.indptr), shape=(csr.n_nodes, csr.n_nodes))
+
+
+def get_sources_chunk(n_nodes: int) -> int:
+    """Number of shortest path trees over ``n_nodes`` that fit `TREES_MEMORY_BYTES`."""
+    return int(max(1, min(MAX_SOURCES_CHUNK, TREES_MEMORY_BYTES // max(1, n_nodes * TREE_BYTES_PER_NODE))))
+
+
+def push_up_trees(pred: np.ndarray, flow: np.ndarray) -> np.ndarray:
+    """Adds flow of every node to its predecessor, children before parents, in place.
+
+    Rows of ``pred`` (as returned by scipy ``dijkstra``) are independent shortest path trees, ``flow`` holds demand
+    at destinations. Afterwards every node holds the flow of its subtree, that is the volume on the tree edge into it.
+    Only nodes between destinations and roots are visited. They are processed in rounds once all their children are
+    done, which is equivalent to reverse settle order and stays correct with zero-weight edges.
+    """
+    n_trees, n_nodes = pred.shape
+    offsets = (np.arange(n_trees, dtype=np.int64) * n_nodes)[:, None]
+    parent = np.where(pred >= 0, pred + offsets, -1).ravel()
+    flat = flow.reshape(-1)
+
+    on_path = np.zeros(len(parent), dtype=bool)
+    frontier = np.flatnonzero(flat)
+    while len(frontier):
+        on_path[frontier] = True
+        frontier = parent[frontier]
+        frontier = np.unique(frontier[frontier >= 0])
+        frontier = frontier[~on_path[frontier]]
+
+    nodes = np.flatnonzero(on_path & (parent >= 0))
+    pending = np.bincount(parent[nodes], minlength=len(parent))
+    ready = nodes[pending[nodes] == 0]
+    while len(ready):
+        parents = parent[ready]
+        np.add.at(flat, parents, flat[ready])
+        np.subtract.at(pending, parents, 1)
+        parents = np.unique(parents)
+        ready = parents[(pending[parents] == 0) & (parent[parents] >= 0)]
+    return flow
+
+
+def load_trees(csr: CSRGraph, pred: np.ndarray, flow: np.ndarray) -> np.ndarray:
+    """Volumes per slot of loading ``flow`` demand at destinations onto shortest path trees ``pred``."""
+    push_up_trees(pred, flow)
+    carrying = np.flatnonzero((flow > 0) & (pred >= 0))
+    rows, nodes = np.divmod(carrying, csr.n_nodes)
+    slots = csr.find_slots(pred[rows, nodes], nodes)
+    return np.bincount(slots, weights=flow[rows, nodes], minlength=len(csr.indices))
+
+
+def all_or_nothing(
+    csr: CSRGraph, weight: str, origins: np.ndarray, targets: np.ndarray, counts: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """Loads ``counts`` trips of every ``origins[k] -> targets[k]`` pair onto shortest path trees of origin nodes.
+
+    Paths are never built, memory depends on the graph size only: trees are grown for as many origins at once as fit
+    `TREES_MEMORY_BYTES`.
+
+    :return: volumes per original edge and shortest path cost per pair, ``inf`` for unreachable pairs which are not
+        loaded.
+    """
+    graph = get_csgraph(csr, weight)
+    slot_volumes = np.zeros(len(csr.indices), dtype=np.float64)
+    costs = np.full(len(origins), np.inf)
+    sources, inverse = np.unique(origins, return_inverse=True)
+    chunk_size = get_sources_chunk(csr.n_nodes)
+    for start in range(0, len(sources), chunk_size):
+        chunk = sources[start : start + chunk_size]
+        dist, pred = dijkstra(graph, directed=True, indices=chunk, return_predecessors=True)
+        pairs = np.flatnonzero((inverse >= start) & (inverse < start + len(chunk)))
+        rows = inverse[pairs] - start
+        costs[pairs] = dist[rows, targets[pairs]]
+        loaded = np.isfinite(costs[pairs])
+        flow = np.zeros(dist.shape)
+        np.add.at(flow, (rows[loaded], targets[pairs][loaded]), counts[pairs][loaded])
+        slot_volumes += load_trees(csr, pred, flow)
+    edge_volumes = np.bincount(csr.edge_ids[weight], weights=slot_volumes, minlength=csr.n_edges)
+    return edge_volumes, costs
+
+
+def zone_all_or_nothing(
+    csr: CSRGraph, weight: str, zone_nodes: list[np.ndarray], zones: np.ndarray, trips: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """Loads trips from ``zones`` (rows ``trips`` of a trip matrix) with one shortest path tree per zone.
+
+    The tree grows from all nodes of the origin zone at once, so every destination is reached from the closest of
+    them. Trips to zone ``j`` are spread evenly over its reachable nodes.
+
+    :return: volumes per original edge and mean shortest path cost per OD cell, ``inf`` where no destination node is
+        reachable.
+    """
+    graph = get_csgraph(csr, weight)
+    slot_volumes = np.zeros(len(csr.indices), dtype=np.float64)
+    costs = np.full(trips.shape, np.inf)
+    for row, (zone, zone_trips) in enumerate(zip(zones, trips)):
+        if not len(zone_nodes[zone]) or not zone_trips.any():
+            continue
+        dist, pred, _ = dijkstra(
+            graph, directed=True, indices=zone_nodes[zone], min_only=True, return_predecessors=True
+        )
+        flow = np.zeros(csr.n_nodes)
+        for d_zone in np.flatnonzero(zone_trips):
+            nodes = zone_nodes[d_zone][np.isfinite(dist[zone_nodes[d_zone]])]
+            if not len(nodes):
+                continue
+            flow[nodes] += zone_trips[d_zone] / len(nodes)
+            costs[row, d_zone] = dist[nodes].mean()
+        slot_volumes += load_trees(csr, pred[None], flow[None])
+    edge_volumes = np.bincount(csr.edge_ids[weight], weights=slot_volumes, minlength=csr.n_edges)
+    return edge_volumes, costs
+
+
+def relative_gap(times: np.ndarray, volumes: np.ndarray, shortest_travel_time: float) -> float:
+    """``(TSTT - SPTT) / TSTT``, how much current travel time exceeds loading everything on current shortest paths."""
+    total = float(times @ volumes)
+    if total <= 0:
+        return 0.0
+    return (total - shortest_travel_time) / total
+
+
+def line_search(travel_time: Callable[[np.ndarray], np.ndarray], volumes: np.ndarray, target: np.ndarray) -> float:
+    """Step towards ``target`` minimizing the Beckmann objective, found by bisection on its derivative."""
+    direction = target - volumes
+    if travel_time(target) @ direction <= 0:
+        return 1.0
+    low, high = 0.0, 1.0
+    for _ in range(LINE_SEARCH_STEPS):
+        middle = (low + high) / 2
+        if travel_time(volumes + middle * direction) @ direction > 0:
+            high = middle
+        else:
+            low = middle
+    return (low + high) / 2
@@ -0,0 +1,133 @@
+from collections.abc import Callable
+from dataclasses import dataclass
+
+import numpy as np
+from scipy.optimize import minimize
+
+from city_road_network.algo.gravity_model import balance_trip_mat
+from city_road_network.utils.utils import get_logger
+
+logger = get_logger(__name__)
+
+DEFAULT_TLD_BINS_KM = np.array([0, 1, 2, 3, 5, 7.5, 10, 15, 20, 30, 50, np.inf])
+
+
+@dataclass(frozen=True)
+class DeterrenceFamily:
+    """Deterrence function ``func(d_mat, scale, *params)`` of distances in km.
+
+    The scale cancels out in doubly-constrained balancing, so only ``params`` are calibrated, starting from
+    ``initial`` within ``bounds``.
+    """
+
+    name: str
+    func: Callable[..., np.ndarray]
+    params: tuple[str, ...]
+    initial: tuple[float, ...]
+    bounds: tuple[tuple[float, float], ...]
+    scale: float = 1.0
+
+    def __call__(self, d_mat: np.ndarray, *params: float) -> np.ndarray:
+        """Friction between zones ``d_mat`` km apart, zero for zero distances as in `calc_friction_mat`."""
+        d_mat = np.asarray(d_mat, dtype=np.float64)
+        with np.errstate(divide="ignore", over="ignore"):
+            friction_mat = self.func(d_mat, self.scale, *params)
+        friction_mat[d_mat == 0] = 0
+        return friction_mat
+
+
+DETERRENCE_FAMILIES = {
+    family.name: family
+    for family in (
+        DeterrenceFamily(
+            "combined",
+            lambda d, a, b, c: a * d**b * np.exp(c * d),
+            ("b", "c"),
+            (-0.02, -0.123),
+            ((-3.0, 1.0), (-3.0, 0.0)),
+            scale=28507,
+        ),
+        DeterrenceFamily("exponential", lambda d, a, c: a * np.exp(c * d), ("c",), (-0.123,), ((-3.0, 0.0),)),
+        DeterrenceFamily("power", lambda d, a, b: a * d**b, ("b",), (-1.0,), ((-5.0, 0.0),)),
+    )
+}
+
+
+@dataclass(frozen=True)
+class CalibrationResult:
+    """Fitted deterrence parameters, ``shares`` of modelled trips per distance bin and their squared ``error`` from
+    the target distribution."""
+
+    family: DeterrenceFamily
+    params: dict[str, float]
+    error: float
+    shares: np.ndarray
+    evaluations: int
+    converged: bool
+
+    def friction_mat(self, d_mat: np.ndarray) -> np.ndarray:
+        return self.family(d_mat, *self.params.values())
+
+
+def model_trip_length_distribution(trip_mat: np.ndarray, distance_mat: np.ndarray, bins_km=DEFAULT_TLD_BINS_KM):
+    """Shares of trips of ``trip_mat`` in distance bins ``[bins_km[k], bins_km[k + 1])``."""
+    counts, _ = np.histogram(distance_mat, bins=bins_km, weights=trip_mat)
+    return counts / max(counts.sum(), 1e-12)
+
+
+def calibrate_gravity_model(
+    distance_mat: np.ndarray,
+    productions,
+    attractions,
+    target_shares,
+    bins_km=DEFAULT_TLD_BINS_KM,
+    family: str = "combined",
+    initial: tuple[float, ...] | None = None,
+    max_evaluations: int = 400,
+    balance_iter: int = 100,
+    eps: float = 1e-6,
+) -> CalibrationResult:
+    """Fits a deterrence function of ``family`` (see `DETERRENCE_FAMILIES`) so that trips balanced to ``productions``
+    and ``attractions`` follow ``target_shares`` per distance bin, e.g. `get_trip_length_distribution`.
+
+    The objective is the sum of squared differences of shares minimised by Nelder-Mead. Every evaluation reuses
+    ``distance_mat`` and its bins and warm-starts `balance_trip_mat` with the factors of the previous one. Balancing
+    stops at ``eps`` which is tighter than in `run_gravity_model`, otherwise warm starts make the objective noisy.
+    """
+    deterrence = DETERRENCE_FAMILIES[family]
+    target_shares = np.asarray(target_shares, dtype=np.float64)
+    target_shares = target_shares / target_shares.sum()
+    n_bins = len(bins_km) - 1
+    if len(target_shares) != n_bins:
+        raise ValueError(f"Got {len(target_shares)} target shares for {n_bins} bins")
+    bin_index = np.digitize(distance_mat, bins_km).ravel() - 1
+    in_bins = (bin_index >= 0) & (bin_index < n_bins)
+    bin_index = np.where(in_bins, bin_index, 0)
+    col_factors = None
+
+    def get_shares(params) -> np.ndarray:
+        nonlocal col_factors
+        friction_mat = deterrence(distance_mat, *params)
+        result = balance_trip_mat(friction_mat, productions, attractions, balance_iter, eps, col_factors=col_factors)
+        if np.all(np.isfinite(result.col_factors)):
+            col_factors = result.col_factors
+        counts = np.bincount(bin_index, weights=result.trip_mat.ravel() * in_bins, minlength=n_bins)
+        return counts / max(counts.sum(), 1e-12)
+
+    def objective(params) -> float:
+        error = float(np.square(get_shares(params) - target_shares).sum())
+        return error if np.isfinite(error) else np.inf
+
+    x0 = deterrence.initial if initial is None else initial
+    optimum = minimize(
+        objective,
+        x0,
+        method="Nelder-Mead",
+        bounds=deterrence.bounds,
+        options={"maxfev": max_evaluations, "xatol": 1e-4, "fatol": 1e-8},
+    )
+    params = dict(zip(deterrence.params, optimum.x.tolist()))
+    logger.info("Calibrated %s deterrence %s in %s evaluations, error %.3g", family, params, optimum.nfev, optimum.fun)
+    shares = get_shares(optimum.x)
+    error = float(np.square(shares - target_shares).sum())
+    return CalibrationResult(deterrence, params, error, shares, int(optimum.nfev), bool(optimum.success))
@@ -0,0 +1,358 @@
+import os
+from heapq import heapify, heappop, heappush
+from math import inf
+
+import networkx as nx
+import numpy as np
+
+from city_road_network.algo.csr import CSRGraph
+from city_road_network.utils.io import read_graph
+from city_road_network.utils.utils import get_data_subdir, get_logger
+
+logger = get_logger(__name__)
+
+
+class ContractionHierarchy:
+    """Customizable contraction hierarchy over the slots of a `CSRGraph` for fast repeated point-to-point queries.
+
+    Nodes are contracted in ``rank`` order without witness searches, so the shortcuts are valid for any weights:
+    contracting a node connects all of its remaining neighbours. Upward edges ``{u, x}`` (``rank[x] > rank[u]``) of
+    node ``u`` are ``nodes[indptr[u]:indptr[u + 1]]`` of both ``forward`` and ``backward``, which are ``(indptr,
+    nodes, weights, middle)`` arrays: ``forward`` weighs ``u -> x`` and ``backward`` weighs ``x -> u``, ``middle`` is
+    the contracted node a shortcut bypasses or -1 for original edges. Edges without a path of their direction weigh
+    ``inf``. `customize` computes weights for new slot weights by triangle relaxation in rank order.
+    """
+
+    def __init__(
+        self,
+        node_ids: np.ndarray,
+        indptr: np.ndarray,
+        indices: np.ndarray,
+        base_weights: np.ndarray,
+        rank: np.ndarray,
+        forward: tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray],
+        backward: tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray],
+    ) -> None:
+        self.node_ids = node_ids
+        self.indptr = indptr
+        self.indices = indices
+        self.base_weights = base_weights
+        self.rank = rank
+        self.forward = forward
+        self.backward = backward
+        self.settled = 0  # nodes settled by queries so far, for instrumentation
+
+    @classmethod
+    def build(cls, csr: CSRGraph, weight: str) -> "ContractionHierarchy":
+        rank, up_indptr, up_nodes = contract(csr.indptr, csr.indices)
+        no_weights = np.full(len(up_nodes), np.inf)
+        no_middle = np.full(len(up_nodes), -1, dtype=np.int32)
+        hierarchy = cls(
+            csr.node_ids,
+            csr.indptr,
+            csr.indices,
+            None,
+            rank,
+            (up_indptr, up_nodes, no_weights, no_middle),
+            (up_indptr, up_nodes, no_weights.copy(), no_middle.copy()),
+        )
+        hierarchy.customize(csr.weights[weight])
+        return hierarchy
+
+    @property
+    def n_nodes(self) -> int:
+        return len(self.rank)
+
+    def matches(self, csr: CSRGraph) -> bool:
+        """Whether the hierarchy was built for the nodes and slots of ``csr``."""
+        return (
+            np.array_equal(self.node_ids, csr.node_ids)
+            and np.array_equal(self.indptr, csr.indptr)
+            and np.array_equal(self.indices, csr.indices)
+        )
+
+    def customize(self, weights: np.ndarray):
+        """Computes weights of hierarchy edges for new slot weights, the shortcuts and node order stay the same.
+
+        Original edges start with their slot weights, then every node in rank order relaxes shortcuts between its
+        upper neighbours ``u -> v -> x``. A node's lower triangles are all relaxed before it, so nodes are processed
+        in levels, each level at once.
+        """
+        weights = np.array(weights, dtype=np.float64)
+        up_indptr, up_nodes = self.forward[0], self.forward[1]
+        slot_edges, slot_up = self._get_slot_edges()
+        up_weights = np.full(len(up_nodes), np.inf)
+        down_weights = np.full(len(up_nodes), np.inf)
+        up_weights[slot_edges[slot_up]] = weights[slot_up]
+        down_weights[slot_edges[~slot_up & (slot_edges >= 0)]] = weights[~slot_up & (slot_edges >= 0)]
+        up_middle = np.full(len(up_nodes), -1, dtype=np.int32)
+        down_middle = np.full(len(up_nodes), -1, dtype=np.int32)
+        for lower, upper, shortcut, middle in self._get_triangles():
+            # lower = {v, u}, upper = {v, x}, shortcut = {u, x} with rank v < u < x
+            for shortcut_weights, shortcut_middle, cost in (
+                (up_weights, up_middle, down_weights[lower] + up_weights[upper]),
+                (down_weights, down_middle, down_weights[upper] + up_weights[lower]),
+            ):
+                before = shortcut_weights[shortcut]
+                np.minimum.at(shortcut_weights, shortcut, cost)
+                improved = (cost < before) & (cost == shortcut_weights[shortcut])
+                shortcut_middle[shortcut[improved]] = middle[improved]
+        self.forward = (up_indptr, up_nodes, up_weights, up_middle)
+        self.backward = (up_indptr, up_nodes, down_weights, down_middle)
+        self.base_weights = weights
+        self._lists = None
+
+    def _get_edge_index(self) -> tuple[np.ndarray, np.ndarray]:
+        """Sorted ``lower * n_nodes + upper`` keys of hierarchy edges and their positions."""
+        up_indptr, up_nodes = self.forward[0], self.forward[1]
+        lower = np.repeat(np.arange(self.n_nodes, dtype=np.int64), np.diff(up_indptr))
+        keys = lower * self.n_nodes + up_nodes
+        order = np.argsort(keys, kind="stable")
+        return keys[order], order
+
+    def _find_edges(self, lower: np.ndarray, upper: np.ndarray) -> np.ndarray:
+        keys, order = self._get_edge_index()
+        return order[np.searchsorted(keys, np.asarray(lower, dtype=np.int64) * self.n_nodes + upper)]
+
+    def _get_slot_edges(self) -> tuple[np.ndarray, np.ndarray]:
+        """Hierarchy edge of every slot, -1 for loops, and whether the slot goes up the hierarchy."""
+        cached = getattr(self, "_slot_edges", None)
+        if cached is None:
+            sources = np.repeat(np.arange(self.n_nodes, dtype=np.int64), np.diff(self.indptr))
+            targets = self.indices.astype(np.int64)
+            slot_up = self.rank[sources] < self.rank[targets]
+            edges = np.full(len(targets), -1, dtype=np.int64)
+            proper = sources != targets
+            lower = np.where(slot_up, sources, targets)[proper]
+            upper = np.where(slot_up, targets, sources)[proper]
+            edges[proper] = self._find_edges(lower, upper)
+            cached = self._slot_edges = edges, slot_up & proper
+        return cached
+
+    def _get_triangles(self) -> list[tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]]:
+        """Triangles ``(lower edge, upper edge, shortcut, middle node)`` per level of the middle node."""
+        cached = getattr(self, "_triangles", None)
+        if cached is not None:
+            return cached
+        up_indptr, up_nodes = self.forward[0], self.forward[1]
+        indptr_list, nodes_list = up_indptr.tolist(), up_nodes.tolist()
+        rank = self.rank
+        level = np.zeros(self.n_nodes, dtype=np.int64)
+        lower, upper, middle = [], [], []
+        for v in np.argsort(rank).tolist():
+            start, stop = indptr_list[v], indptr_list[v + 1]
+            if stop - start:
+                level[up_nodes[start:stop]] = np.maximum(level[up_nodes[start:stop]], level[v] + 1)
+            if stop - start < 2:
+                continue
+            edges = np.arange(start, stop)
+            edges = edges[np.argsort(rank[nodes_list[start:stop]])]
+            first, second = np.triu_indices(len(edges), 1)
+            lower.append(edges[first])
+            upper.append(edges[second])
+            middle.append(np.full(len(first), v, dtype=np.int32))
+        if not lower:
+            self._triangles = []
+            return self._triangles
+        lower, upper, middle = np.concatenate(lower), np.concatenate(upper), np.concatenate(middle)
+        shortcut = self._find_edges(up_nodes[lower], up_nodes[upper])
+        by_level = np.argsort(level[middle], kind="stable")
+        bounds = np.flatnonzero(np.diff(level[middle][by_level])) + 1
+        self._triangles = [
+            (lower[part], upper[part], shortcut[part], middle[part]) for part in np.split(by_level, bounds)
+        ]
+        return self._triangles
+
+    def save(self, filename: str):
+        np.savez(
+            filename,
+            node_ids=self.node_ids,
+            indptr=self.indptr,
+            indices=self.indices,
+            base_weights=self.base_weights,
+            rank=self.rank,
+            **{f"forward_{i}": array for i, array in enumerate(self.forward)},
+            **{f"backward_{i}": array for i, array in enumerate(self.backward)},
+        )
+
+    @classmethod
+    def load(cls, filename: str) -> "ContractionHierarchy":
+        with np.load(filename) as data:
+            return cls(
+                data["node_ids"],
+                data["indptr"],
+                data["indices"],
+                data["base_weights"],
+                data["rank"],
+                tuple(data[f"forward_{i}"] for i in range(4)),
+                tuple(data[f"backward_{i}"] for i in range(4)),
+            )
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_lists", None)
+        return state
+
+    def _get_lists(self):
+        lists = getattr(self, "_lists", None)
+        if lists is None:
+            lists = tuple(tuple(array.tolist() for array in side) for side in (self.forward, self.backward))
+            self._lists = lists
+        return lists
+
+    def query(self, source: int, target: int) -> tuple[float, list[int]]:
+        """Bidirectional upward search. Returns the cost and the unpacked path over original nodes.
+
+        :raises nx.NetworkXNoPath: if ``target`` is not reachable from ``source``.
+        """
+        if source == target:
+            return 0.0, [source]
+        sides = self._get_lists()
+        dists = ({source: 0.0}, {target: 0.0})
+        parents = ({source: (-1, -1)}, {target: (-1, -1)})
+        heaps = ([(0.0, source)], [(0.0, target)])
+        done = (set(), set())
+        best = inf
+        meeting = -1
+        while heaps[0] or heaps[1]:
+            for side in (0, 1):
+                heap = heaps[side]
+                if not heap:
+                    continue
+                d, u = heappop(heap)
+                if d >= best:
+                    heap.clear()
+                    continue
+                if u in done[side]:
+                    continue
+                done[side].add(u)
+                other = dists[1 - side].get(u)
+                if other is not None and d + other < best:
+                    best = d + other
+                    meeting = u
+                indptr, nodes, weights, _ = sides[side]
+                dist, parent = dists[side], parents[side]
+                for e in range(indptr[u], indptr[u + 1]):
+                    x = nodes[e]
+                    nd = d + weights[e]
+                    if nd < dist.get(x, inf):
+                        dist[x] = nd
+                        parent[x] = (u, e)
+                        heappush(heap, (nd, x))
+        self.settled += len(done[0]) + len(done[1])
+        if meeting == -1:
+            raise nx.NetworkXNoPath(f"Node {target} not reachable from {source}")
+
+        head = []
+        x = meeting
+        node, e = parents[0][x]
+        while node != -1:
+            head.append(self._unpack(node, x, sides[0][3][e])[:-1])
+            x = node
+            node, e = parents[0][x]
+        path = [node for segment in reversed(head) for node in segment]
+        x = meeting
+        node, e = parents[1][x]
+        while node != -1:
+            path.extend(self._unpack(x, node, sides[1][3][e])[:-1])
+            x = node
+            node, e = parents[1][x]
+        path.append(x)
+        return best, path
+
+    def _unpack(self, u: int, x: int, middle: int) -> list[int]:
+        """Expands hierarchy edge ``u -> x`` into original nodes."""
+        path = [u]
+        stack = [(u, x, middle)]
+        while stack:
+            a, b, m = stack.pop()
+            if m == -1:
+                path.append(b)
+            else:
+                stack.append((m, b, self._middle(m, b)))
+                stack.append((a, m, self._middle(a, m)))
+        return path
+
+    def _middle(self, u: int, x: int) -> int:
+        sides = self._get_lists()
+        if self.rank[u] < self.rank[x]:
+            owner, other, (indptr, nodes, _, middle) = u, x, sides[0]
+        else:
+            owner, other, (indptr, nodes, _, middle) = x, u, sides[1]
+        for e in range(indptr[owner], indptr[owner + 1]):
+            if nodes[e] == other:
+                return middle[e]
+        raise ValueError(f"Edge {u} -> {x} is not in the hierarchy")
+
+
+def contract(indptr: np.ndarray, indices: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Contracts all nodes of a CSR graph, ignoring edge directions and weights. Nodes are ordered greedily by the
+    number of shortcuts their contraction adds less their degree, plus the number of contracted neighbours to spread
+    contraction over the graph.
+
+    :return: ``rank`` per node and upward edges as ``indptr`` and ``nodes``, see `ContractionHierarchy`.
+    """
+    n_nodes = len(indptr) - 1
+    adjacency = [set() for _ in range(n_nodes)]
+    sources = np.repeat(np.arange(n_nodes), np.diff(indptr)).tolist()
+    for u, x in zip(sources, indices.tolist()):
+        if u != x:
+            adjacency[u].add(x)
+            adjacency[x].add(u)
+
+    def count_shortcuts(v: int) -> int:
+        neighbours = list(adjacency[v])
+        return sum(1 for k, u in enumerate(neighbours) for x in neighbours[k + 1 :] if x not in adjacency[u])
+
+    deleted_neighbours = [0] * n_nodes
+
+    def priority(v: int) -> int:
+        return count_shortcuts(v) - len(adjacency[v]) + deleted_neighbours[v]
+
+    queue = [(priority(v), v) for v in range(n_nodes)]
+    heapify(queue)
+    rank = np.empty(n_nodes, dtype=np.int32)
+    upward = [None] * n_nodes
+    for position in range(n_nodes):
+        while True:
+            _, v = heappop(queue)
+            current = priority(v)
+            if not queue or current <= queue[0][0]:
+                break
+            heappush(queue, (current, v))
+        rank[v] = position
+        neighbours = sorted(adjacency[v])
+        upward[v] = neighbours
+        for u in neighbours:
+            adjacency[u].discard(v)
+            adjacency[u].update(neighbours)
+            adjacency[u].discard(u)
+            deleted_neighbours[u] += 1
+        adjacency[v] = set()
+        if position and position % 10_000 == 0:
+            logger.info("Contracted %s of %s nodes", position, n_nodes)
+    up_indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+    np.cumsum([len(nodes) for nodes in upward], out=up_indptr[1:])
+    up_nodes = np.array([x for nodes in upward for x in nodes], dtype=np.int32)
+    return rank, up_indptr, up_nodes
+
+
+def get_hierarchy_filename(weight: str, city_name: str | None = None) -> str:
+    clean_weight = weight.replace("(", "").replace(")", "").replace(" ", "_")
+    return os.path.join(get_data_subdir(city_name), f"ch_{clean_weight}.npz")
+
+
+def build_contraction_hierarchy(city_name: str | None = None, weight: str = "flow_time (s)") -> ContractionHierarchy:
+    """Builds contraction hierarchy from processed nodelist and edgelist of a city and saves it next to them."""
+    data_dir = get_data_subdir(city_name)
+    graph = read_graph(os.path.join(data_dir, "nodelist_upd.csv"), os.path.join(data_dir, "edgelist_upd.csv"))
+    csr = CSRGraph.from_networkx(graph, weights=[weight])
+    hierarchy = ContractionHierarchy.build(csr, weight)
+    filename = get_hierarchy_filename(weight, city_name)
+    hierarchy.save(filename)
+    logger.info("Saved contraction hierarchy to %s", os.path.abspath(filename))
+    return hierarchy
+
+
+def load_contraction_hierarchy(city_name: str | None = None, weight: str = "flow_time (s)") -> ContractionHierarchy:
+    return ContractionHierarchy.load(get_hierarchy_filename(weight, city_name))
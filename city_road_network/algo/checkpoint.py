@@ -0,0 +1,93 @@
+import glob
+import hashlib
+import os
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+
+from city_road_network.algo.paths import PATH_COLUMNS, PathSet
+from city_road_network.utils.utils import get_data_subdir, get_logger
+
+logger = get_logger(__name__)
+
+STATE_FILENAME = "state.npz"
+CHECKPOINT_SUBDIR = "checkpoint"
+
+
+def get_checkpoint_dir(city_name: str | None = None, name: str = "simulation") -> str:
+    return os.path.join(get_data_subdir(city_name), "checkpoints", name)
+
+
+def get_input_key(*arrays: np.ndarray, **params) -> str:
+    """Fingerprint of simulation inputs, a checkpoint is only resumed by a run with the same inputs."""
+    digest = hashlib.blake2b(digest_size=16)
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(f"{array.dtype.str}{array.shape}".encode())
+        digest.update(array.tobytes())
+    digest.update(repr(sorted(params.items())).encode())
+    return digest.hexdigest()
+
+
+@dataclass(frozen=True)
+class CheckpointState:
+    chunk_size: int
+    n_done: int
+    passes: np.ndarray
+
+
+class SimulationCheckpoint:
+    """Chunks of trips finished by a simulation run and the edge flow state after them.
+
+    Paths of every finished chunk go to a file of their own, unless a durable `PathSink` keeps them, then the small
+    state file is replaced atomically, so a run killed at any moment leaves the checkpoint of its last finished chunk.
+    Chunks are consecutive parts of the run's trip cells, the first ``n_done`` of them are skipped on resume.
+
+    Files go to the ``checkpoint`` subdirectory of ``directory``, so that it may be shared with other data, e.g. be
+    the city data directory. Clearing removes only files of the checkpoint.
+    """
+
+    def __init__(self, directory: str, key: str) -> None:
+        self.directory = os.path.join(directory, CHECKPOINT_SUBDIR)
+        self.key = key
+
+    def get_chunk_filename(self, index: int) -> str:
+        return os.path.join(self.directory, f"chunk_{index:05d}.npz")
+
+    def get_filenames(self) -> list[str]:
+        """Files of the checkpoint: chunk paths, the state and its unfinished replacement."""
+        names = ("chunk_*.npz", STATE_FILENAME, f"tmp_{STATE_FILENAME}")
+        return sorted(filename for name in names for filename in glob.glob(os.path.join(self.directory, name)))
+
+    def clear(self):
+        Path(self.directory).mkdir(parents=True, exist_ok=True)
+        for filename in self.get_filenames():
+            os.remove(filename)
+
+    def save(self, index: int, paths: PathSet | None, passes: np.ndarray, chunk_size: int):
+        """Records chunk ``index`` as finished, all chunks before it must have been saved already. ``paths`` are left
+        out when a durable sink keeps them."""
+        if paths is not None:
+            np.savez(self.get_chunk_filename(index), **{name: getattr(paths, name) for name in PATH_COLUMNS})
+        tmp_filename = os.path.join(self.directory, f"tmp_{STATE_FILENAME}")
+        np.savez(tmp_filename, key=self.key, chunk_size=chunk_size, n_done=index + 1, passes=passes)
+        os.replace(tmp_filename, os.path.join(self.directory, STATE_FILENAME))
+
+    def load(self) -> CheckpointState | None:
+        """State of the last finished chunk, ``None`` if there is no checkpoint of a run with the same inputs."""
+        filename = os.path.join(self.directory, STATE_FILENAME)
+        if not os.path.exists(filename):
+            return None
+        with np.load(filename) as data:
+            if str(data["key"]) != self.key:
+                logger.warning("Checkpoint in %s was made for other inputs, ignoring it", self.directory)
+                return None
+            return CheckpointState(int(data["chunk_size"]), int(data["n_done"]), data["passes"])
+
+    def load_paths(self, n_done: int, node_ids: np.ndarray, n: int) -> list[PathSet]:
+        parts = []
+        for index in range(n_done):
+            with np.load(self.get_chunk_filename(index)) as data:
+                parts.append(PathSet(*(data[name] for name in PATH_COLUMNS), node_ids=node_ids, n=n))
+        return parts
@@ -1,11 +1,12 @@
-import copy
 import random
 from dataclasses import dataclass
 from math import exp
 from typing import NamedTuple
 
 import networkx as nx
+import numpy as np
 
+from city_road_network.algo.od_matrix import SparseODMatrix, nonzero_cells
 from city_road_network.utils.utils import get_logger
 
 logger = get_logger(__name__)
@@ -28,58 +29,145 @@ def yield_zone_pairs(n: int, *rest):
             yield i, j, *rest
 
 
-def add_passes_count(graph: nx.MultiDiGraph, trip_mat: list[list[list[TimedPath]]]):
-    g = copy.deepcopy(graph)
+def add_passes_count(graph: nx.MultiDiGraph, trip_mat: list[list[list[TimedPath]]], weight: str = "flow_time (s)"):
+    """Returns a copy of ``graph`` with passes of the paths added. Of parallel edges the cheapest by ``weight`` is
+    counted, as routing on ``weight`` would have taken it."""
+    g = graph.copy()
     for i in range(len(trip_mat)):
         for j in range(len(trip_mat)):
             for path_tuple in trip_mat[i][j]:
                 path = path_tuple.path
                 for k in range(len(path) - 1):
-                    start_node = path[k]
-                    end_node = path[k + 1]
-                    g[start_node][end_node][0]["passes_count"] += 1
+                    edges = g[path[k]][path[k + 1]]
+                    key = min(edges, key=lambda key: edges[key].get(weight, 1))
+                    edges[key]["passes_count"] += 1
     for start_id, end_id, key, edge_data in g.edges(data=True, keys=True):
-        g[start_id][end_id][key]["capacity_occupied"] = edge_data["passes_count"] / edge_data["capacity (veh/h)"]
+        edge_data["capacity_occupied"] = edge_data["passes_count"] / edge_data["capacity (veh/h)"]
     return g
 
 
 def recalculate_flow_time(graph: nx.MultiDiGraph):
-    g = copy.deepcopy(graph)
+    g = graph.copy()
     for start_id, end_id, key, edge_data in g.edges(data=True, keys=True):
         ffs = edge_data["maxspeed (km/h)"]
         occ = edge_data["passes_count"]
         cap = edge_data["capacity (veh/h)"]
 
         speed = max(ffs * exp(-0.5 * (occ / cap) ** 2), ffs / 10)
-        g[start_id][end_id][key]["cur_speed (km/h)"] = speed
-        g[start_id][end_id][key]["flow_time (s)"] = int((edge_data["length (km)"] / speed) * 3600)
+        edge_data["cur_speed (km/h)"] = speed
+        edge_data["flow_time (s)"] = int((edge_data["length (km)"] / speed) * 3600)
     return g
 
 
+class ZoneIndex:
+    """Graph nodes grouped by zone, built once so that endpoints can be drawn without scanning the graph.
+
+    Nodes are positions in ``graph.nodes`` order. Nodes of zone ``zones[k]`` are ``nodes[offsets[k]:offsets[k + 1]]``.
+    Zones are keyed by ``str(zone)``, the same way `filter_nodes` compares them.
+    """
+
+    def __init__(self, zones: list[str], offsets: np.ndarray, nodes: np.ndarray, node_ids: np.ndarray) -> None:
+        self.zones = zones
+        self.offsets = offsets
+        self.nodes = nodes
+        self.node_ids = node_ids
+        self.zone_positions = {zone: k for k, zone in enumerate(zones)}
+
+    @classmethod
+    def from_graph(cls, graph: nx.MultiDiGraph, mask: np.ndarray | None = None) -> "ZoneIndex":
+        """Indexes graph nodes, or only those selected by boolean ``mask`` over ``graph.nodes``, e.g. routable ones."""
+        node_zones = np.array([str(zone) for _, zone in graph.nodes(data="zone")])
+        positions = np.arange(len(node_zones), dtype=np.int32)
+        if mask is not None:
+            node_zones, positions = node_zones[mask], positions[mask]
+        zones, inverse = np.unique(node_zones, return_inverse=True)
+        offsets = np.zeros(len(zones) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(inverse, minlength=len(zones)), out=offsets[1:])
+        nodes = positions[np.argsort(inverse, kind="stable")]
+        return cls(zones.tolist(), offsets, nodes, np.asarray(list(graph.nodes)))
+
+    def zone_sizes(self, n: int) -> np.ndarray:
+        """Number of indexed nodes of zones ``0..n-1``."""
+        return np.array([len(self.get_nodes(str(zone))) for zone in range(n)], dtype=np.int64)
+
+    def find_unroutable_pairs(self, trip_mat: np.ndarray | SparseODMatrix) -> list[tuple[int, int]]:
+        """OD cells with trips that can't get a path: an end zone has no indexed nodes, or trips stay within a zone
+        that has a single node, so every path would be empty."""
+        sizes = self.zone_sizes(trip_mat.shape[0])
+        rows, cols, values = nonzero_cells(trip_mat)
+        empty = sizes == 0
+        unroutable = (values > 0) & (empty[rows] | empty[cols] | ((rows == cols) & (sizes[rows] == 1)))
+        return list(zip(rows[unroutable].tolist(), cols[unroutable].tolist()))
+
+    def get_nodes(self, zone_id: str) -> np.ndarray:
+        k = self.zone_positions.get(zone_id)
+        if k is None:
+            return self.nodes[:0]
+        return self.nodes[self.offsets[k] : self.offsets[k + 1]]
+
+    def sample(self, zone_id: str, rng: np.random.Generator) -> int:
+        k = self.zone_positions.get(zone_id)
+        if k is None:
+            raise ValueError(f"Zone {zone_id} has no nodes")
+        start = self.offsets[k]
+        return int(self.nodes[start + rng.integers(self.offsets[k + 1] - start)])
+
+    def sample_many(self, zone_id: str, rng: np.random.Generator, size: int) -> np.ndarray:
+        k = self.zone_positions.get(zone_id)
+        if k is None:
+            raise ValueError(f"Zone {zone_id} has no nodes")
+        start = self.offsets[k]
+        return self.nodes[start + rng.integers(self.offsets[k + 1] - start, size=size)]
+
+
 def filter_nodes(graph: nx.MultiDiGraph, zone_id: str):
     nodes = [node for node, data in graph.nodes(data=True) if zone_id == str(data["zone"])]
     return nodes
 
 
-def get_random_node(graph: nx.MultiDiGraph, zone_id: str):
-    return random.choice(filter_nodes(graph, zone_id))
-
-
-def get_nodes_pair(graph: nx.MultiDiGraph, o_zone: int, d_zone: int, path_starts_ends=None, path_idx=None):
+def get_random_node(
+    graph: nx.MultiDiGraph, zone_id: str, zone_index: ZoneIndex = None, rng: np.random.Generator = None
+):
+    if zone_index is None:
+        return random.choice(filter_nodes(graph, zone_id))
+    if rng is None:
+        rng = np.random.default_rng()
+    return zone_index.node_ids[zone_index.sample(zone_id, rng)]
+
+
+def get_nodes_pair(
+    graph: nx.MultiDiGraph,
+    o_zone: int,
+    d_zone: int,
+    path_starts_ends=None,
+    path_idx=None,
+    zone_index: ZoneIndex = None,
+    rng: np.random.Generator = None,
+):
     if path_starts_ends is None:
-        u = get_random_node(graph, str(o_zone))
-        v = get_random_node(graph, str(d_zone))
+        u = get_random_node(graph, str(o_zone), zone_index, rng)
+        v = get_random_node(graph, str(d_zone), zone_index, rng)
         return u, v
     return path_starts_ends[o_zone][d_zone][path_idx]
 
 
 def build_paths(
-    graph: nx.MultiDiGraph, o_zone: int, d_zone: int, count: int, weight: str, path_starts_ends, max_iter: int = 100_000
+    graph: nx.MultiDiGraph,
+    o_zone: int,
+    d_zone: int,
+    count: int,
+    weight: str,
+    path_starts_ends,
+    max_iter: int = 100_000,
+    zone_index: ZoneIndex = None,
 ) -> list[TimedPath]:
+    if zone_index is None and path_starts_ends is None:
+        zone_index = ZoneIndex.from_graph(graph)
+    rng = np.random.default_rng()
     paths = []
     i = 0
     while len(paths) != count:
-        u, v = get_nodes_pair(graph, o_zone, d_zone, path_starts_ends, path_idx=len(paths))
+        u, v = get_nodes_pair(graph, o_zone, d_zone, path_starts_ends, len(paths), zone_index, rng)
 
         try:
             path_cost, path = nx.single_source_dijkstra(graph, u, v, weight=weight)
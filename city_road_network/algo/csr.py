@@ -0,0 +1,375 @@
+from collections.abc import Iterable
+from functools import cached_property
+from heapq import heappop, heappush
+from math import asin, inf, sin, sqrt
+
+import networkx as nx
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+
+from city_road_network.utils.utils import get_logger
+
+logger = get_logger(__name__)
+
+EARTH_RADIUS_M = 6_371_009  # same mean radius osmnx uses for edge lengths
+HEURISTIC_SAFETY = 0.99  # keeps A* admissible against rounding and lengths measured on the ellipsoid
+
+
+class CSRGraph:
+    """Compact array representation of a road graph.
+
+    Nodes are numbered ``0..n-1`` in the iteration order of the source graph, ``node_ids`` maps them back to the
+    original OSM ids. Outgoing edges of node ``i`` occupy slots ``indptr[i]:indptr[i + 1]`` of ``indices`` (sorted by
+    target). Parallel edges of a MultiDiGraph share one slot holding the cheapest of them for every weight column;
+    ``edge_ids[weight]`` keeps the position of that edge in ``graph.edges(keys=True)``. ``node_coords`` holds
+    ``(lat, lon)`` per node when the source graph has them, they enable goal-directed search.
+    """
+
+    def __init__(
+        self,
+        node_ids: np.ndarray,
+        indptr: np.ndarray,
+        indices: np.ndarray,
+        edge_slots: np.ndarray,
+        edge_weights: dict[str, np.ndarray] | None = None,
+        node_coords: np.ndarray | None = None,
+    ) -> None:
+        self.node_ids = node_ids
+        self.node_coords = node_coords
+        self.indptr = indptr
+        self.indices = indices
+        self.edge_slots = edge_slots
+        self.edge_weights = {}
+        self.weights = {}
+        self.edge_ids = {}
+        self.settled = 0  # nodes settled by searches so far, for instrumentation
+        for name, values in (edge_weights or {}).items():
+            self.set_edge_weight(name, values)
+
+    @classmethod
+    def from_networkx(cls, graph: nx.MultiDiGraph, weights: Iterable[str] = ()) -> "CSRGraph":
+        node_ids = list(graph.nodes)
+        node_index = {node: i for i, node in enumerate(node_ids)}
+        n_nodes = len(node_ids)
+        n_edges = graph.number_of_edges()
+        weights = list(weights)
+
+        edge_src = np.empty(n_edges, dtype=np.int64)
+        edge_dst = np.empty(n_edges, dtype=np.int64)
+        columns = {name: np.empty(n_edges, dtype=np.float64) for name in weights}
+        for e, (u, v, edge_data) in enumerate(graph.edges(data=True)):
+            edge_src[e] = node_index[u]
+            edge_dst[e] = node_index[v]
+            for name, column in columns.items():
+                column[e] = edge_data.get(name, 1)
+
+        node_coords = None
+        if all("lat" in node_data and "lon" in node_data for _, node_data in graph.nodes(data=True)):
+            node_coords = np.array(
+                [(node_data["lat"], node_data["lon"]) for _, node_data in graph.nodes(data=True)], dtype=np.float64
+            ).reshape(n_nodes, 2)
+
+        slot_keys, edge_slots = np.unique(edge_src * n_nodes + edge_dst, return_inverse=True)
+        indices = (slot_keys % max(n_nodes, 1)).astype(np.int32)
+        indptr = np.zeros(n_nodes + 1, dtype=np.int32)
+        np.cumsum(np.bincount(slot_keys // max(n_nodes, 1), minlength=n_nodes), out=indptr[1:])
+        return cls(np.asarray(node_ids), indptr, indices, edge_slots.astype(np.int32), columns, node_coords)
+
+    def to_arrays(self) -> dict[str, np.ndarray]:
+        arrays = {
+            "node_ids": self.node_ids,
+            "indptr": self.indptr,
+            "indices": self.indices,
+            "edge_slots": self.edge_slots,
+        }
+        if self.node_coords is not None:
+            arrays["node_coords"] = self.node_coords
+        for name in self.weights:
+            arrays[f"edge_weights:{name}"] = self.edge_weights[name]
+            arrays[f"weights:{name}"] = self.weights[name]
+            arrays[f"edge_ids:{name}"] = self.edge_ids[name]
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays: dict[str, np.ndarray]) -> "CSRGraph":
+        """Inverse of `to_arrays`. Arrays are used as is, so views of shared memory stay shared."""
+        csr = cls(
+            arrays["node_ids"],
+            arrays["indptr"],
+            arrays["indices"],
+            arrays["edge_slots"],
+            node_coords=arrays.get("node_coords"),
+        )
+        for key, array in arrays.items():
+            kind, _, name = key.partition(":")
+            if kind in ("edge_weights", "weights", "edge_ids"):
+                getattr(csr, kind)[name] = array
+        return csr
+
+    @property
+    def n_nodes(self) -> int:
+        return len(self.indptr) - 1
+
+    @property
+    def n_edges(self) -> int:
+        return len(self.edge_slots)
+
+    @cached_property
+    def node_list(self) -> list:
+        return self.node_ids.tolist()
+
+    @cached_property
+    def node_index(self) -> dict:
+        return {node: i for i, node in enumerate(self.node_list)}
+
+    def set_edge_weight(self, name: str, values: np.ndarray):
+        """Sets weight column for original edges and collapses parallel edges to the cheapest one."""
+        values = np.asarray(values, dtype=np.float64)
+        order = np.lexsort((values, self.edge_slots))
+        sorted_slots = self.edge_slots[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = sorted_slots[1:] != sorted_slots[:-1]
+        chosen = order[first]
+        if name in self.weights:
+            self.edge_weights[name][:] = values
+            self.weights[name][:] = values[chosen]
+            self.edge_ids[name][:] = chosen
+        else:
+            self.edge_weights[name] = values.copy()
+            self.weights[name] = values[chosen]
+            self.edge_ids[name] = chosen.astype(np.int32)
+
+    @cached_property
+    def reverse(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Incoming adjacency ``(indptr, sources, slots)``, ``slots`` point back to forward slots for weights."""
+        rows = np.repeat(np.arange(self.n_nodes, dtype=np.int32), np.diff(self.indptr))
+        slots = np.lexsort((rows, self.indices)).astype(np.int32)
+        indptr = np.zeros(self.n_nodes + 1, dtype=np.int32)
+        np.cumsum(np.bincount(self.indices, minlength=self.n_nodes), out=indptr[1:])
+        return indptr, rows[slots], slots
+
+    @cached_property
+    def _coords_rad(self) -> tuple[list[float], list[float], list[float]]:
+        lat = np.radians(self.node_coords[:, 0])
+        return lat.tolist(), np.cos(lat).tolist(), np.radians(self.node_coords[:, 1]).tolist()
+
+    def great_circle(self, u: int, v: int) -> float:
+        """Haversine distance between nodes in meters."""
+        lat, cos_lat, lon = self._coords_rad
+        h = sin((lat[v] - lat[u]) / 2) ** 2 + cos_lat[u] * cos_lat[v] * sin((lon[v] - lon[u]) / 2) ** 2
+        return 2 * EARTH_RADIUS_M * asin(min(1.0, sqrt(h)))
+
+    def heuristic_scale(
+        self, weight: str, length_weight: str = "length (m)", lower_bounds: np.ndarray | None = None
+    ) -> float:
+        """Factor turning great-circle meters into a lower bound of ``weight``.
+
+        For lengths it is 1. For other weights it is ``1 / v_max``, where ``v_max`` is the highest ``length / weight``
+        ratio over all edges, so ``weight >= great-circle distance / v_max`` holds for every edge. ``lower_bounds`` of
+        weights per edge, in ``graph.edges(keys=True)`` order, replace current weights, e.g. free-flow times that
+        congestion only increases. Edges with positive length and zero bound make the bound degenerate to 0, i.e. plain
+        Dijkstra, which is logged.
+        """
+        if self.node_coords is None:
+            return 0.0
+        if weight == length_weight:
+            return HEURISTIC_SAFETY
+        if length_weight not in self.edge_weights:
+            return 0.0
+        lengths = self.edge_weights[length_weight]
+        values = self.edge_weights[weight] if lower_bounds is None else np.asarray(lower_bounds, dtype=np.float64)
+        moving = lengths > 0
+        if not moving.any():
+            return 0.0
+        degenerate = values[moving] <= 0
+        if degenerate.any():
+            logger.warning(
+                "%s edges with positive length have no positive %s, A* falls back to Dijkstra", degenerate.sum(), weight
+            )
+            return 0.0
+        return HEURISTIC_SAFETY / float((lengths[moving] / values[moving]).max())
+
+    @cached_property
+    def strong_components(self) -> np.ndarray:
+        """Strongly connected component label per node."""
+        adjacency = csr_matrix(
+            (np.ones(len(self.indices), dtype=np.int8), self.indices, self.indptr), shape=(self.n_nodes, self.n_nodes)
+        )
+        _, labels = connected_components(adjacency, directed=True, connection="strong")
+        return labels
+
+    def giant_component(self) -> np.ndarray:
+        """Mask of nodes in the largest strongly connected component, any of them can reach any other."""
+        labels = self.strong_components
+        if not len(labels):
+            return np.zeros(0, dtype=bool)
+        return labels == np.bincount(labels).argmax()
+
+    @cached_property
+    def slot_keys(self) -> np.ndarray:
+        """Sorted ``source * n_nodes + target`` key per slot."""
+        rows = np.repeat(np.arange(self.n_nodes, dtype=np.int64), np.diff(self.indptr))
+        return rows * self.n_nodes + self.indices
+
+    def find_slots(self, sources: np.ndarray, targets: np.ndarray) -> np.ndarray:
+        """Slots of edges ``sources[k] -> targets[k]``.
+
+        :raises ValueError: if some of the edges are not in the graph.
+        """
+        keys = np.asarray(sources, dtype=np.int64) * self.n_nodes + targets
+        slots = np.searchsorted(self.slot_keys, keys)
+        missing = slots >= len(self.slot_keys)
+        missing[~missing] = self.slot_keys[slots[~missing]] != keys[~missing]
+        if missing.any():
+            k = np.flatnonzero(missing)[0]
+            raise ValueError(f"Edge {sources[k]} -> {targets[k]} is not in the graph")
+        return slots
+
+    def path_to_ids(self, path: list[int]) -> list:
+        node_list = self.node_list
+        return [node_list[node] for node in path]
+
+    def dijkstra(self, source: int, target: int, weight: str) -> tuple[float, list[int]]:
+        """Point-to-point Dijkstra over node indices. Stops as soon as ``target`` is settled.
+
+        :raises nx.NetworkXNoPath: if ``target`` is not reachable from ``source``.
+        """
+        dist, pred = self._dijkstra(source, {target}, weight)
+        if target not in pred:
+            raise nx.NetworkXNoPath(f"Node {target} not reachable from {source}")
+        return dist[target], unwind_path(pred, target)
+
+    def dijkstra_many(self, source: int, targets: Iterable[int], weight: str) -> dict[int, tuple[float, list[int]]]:
+        """One-to-many Dijkstra. Stops once every target is settled, unreachable targets are left out of the result."""
+        targets = set(targets)
+        dist, pred = self._dijkstra(source, targets, weight)
+        return {target: (dist[target], unwind_path(pred, target)) for target in targets if target in pred}
+
+    def astar(self, source: int, target: int, weight: str, scale: float) -> tuple[float, list[int]]:
+        """A* with ``scale * great_circle(node, target)`` as the potential. ``scale`` comes from `heuristic_scale`.
+
+        :raises nx.NetworkXNoPath: if ``target`` is not reachable from ``source``.
+        """
+        if not scale:
+            return self.dijkstra(source, target, weight)
+        indptr = self.indptr.data
+        indices = self.indices.data
+        weights = self.weights[weight].data
+        great_circle = self.great_circle
+
+        potential = {source: scale * great_circle(source, target)}
+        dist = {source: 0.0}
+        parent = {source: -1}
+        pred = {}
+        heap = [(potential[source], source)]
+        while heap:
+            _, u = heappop(heap)
+            if u in pred:
+                continue
+            pred[u] = parent[u]
+            if u == target:
+                self.settled += len(pred)
+                return dist[target], unwind_path(pred, target)
+            d = dist[u]
+            for e in range(indptr[u], indptr[u + 1]):
+                v = indices[e]
+                nd = d + weights[e]
+                if nd < dist.get(v, inf):
+                    dist[v] = nd
+                    parent[v] = u
+                    if v not in potential:
+                        potential[v] = scale * great_circle(v, target)
+                    heappush(heap, (nd + potential[v], v))
+        self.settled += len(pred)
+        raise nx.NetworkXNoPath(f"Node {target} not reachable from {source}")
+
+    def bidirectional_dijkstra(self, source: int, target: int, weight: str) -> tuple[float, list[int]]:
+        """Alternates forward search from ``source`` and backward search from ``target`` until they meet.
+
+        :raises nx.NetworkXNoPath: if ``target`` is not reachable from ``source``.
+        """
+        if source == target:
+            return 0.0, [source]
+        rindptr, rsources, rslots = self.reverse
+        weights = self.weights[weight].data
+        adjacency = (
+            (self.indptr.data, self.indices.data, None),
+            (rindptr.data, rsources.data, rslots.data),
+        )
+        dists = ({source: 0.0}, {target: 0.0})
+        parents = ({source: -1}, {target: -1})
+        settled = (set(), set())
+        heaps = ([(0.0, source)], [(0.0, target)])
+        best = inf
+        meeting = -1
+        side = 0
+        while heaps[0] and heaps[1]:
+            if heaps[0][0][0] + heaps[1][0][0] >= best:
+                break
+            side = 0 if heaps[0][0][0] <= heaps[1][0][0] else 1
+            d, u = heappop(heaps[side])
+            if u in settled[side]:
+                continue
+            settled[side].add(u)
+            indptr, neighbours, slots = adjacency[side]
+            dist, other_dist, parent = dists[side], dists[1 - side], parents[side]
+            for e in range(indptr[u], indptr[u + 1]):
+                v = neighbours[e]
+                nd = d + weights[e if slots is None else slots[e]]
+                if nd < dist.get(v, inf):
+                    dist[v] = nd
+                    parent[v] = u
+                    heappush(heaps[side], (nd, v))
+                if v in other_dist and nd + other_dist[v] < best and dist[v] == nd:
+                    best = nd + other_dist[v]
+                    meeting = v
+        self.settled += len(settled[0]) + len(settled[1])
+        if meeting == -1:
+            raise nx.NetworkXNoPath(f"Node {target} not reachable from {source}")
+        path = unwind_path(parents[0], meeting)
+        node = parents[1][meeting]
+        while node != -1:
+            path.append(node)
+            node = parents[1][node]
+        return best, path
+
+    def _dijkstra(self, source: int, targets: set[int], weight: str) -> tuple[dict[int, float], dict[int, int]]:
+        """Runs Dijkstra until all ``targets`` are settled. Returned ``pred`` only contains settled nodes."""
+        indptr = self.indptr.data
+        indices = self.indices.data
+        weights = self.weights[weight].data
+
+        remaining = len(targets)
+        dist = {source: 0.0}
+        parent = {source: -1}
+        pred = {}
+        heap = [(0.0, source)]
+        while heap and remaining:
+            d, u = heappop(heap)
+            if u in pred:
+                continue
+            pred[u] = parent[u]
+            if u in targets:
+                remaining -= 1
+                if not remaining:
+                    break
+            for e in range(indptr[u], indptr[u + 1]):
+                v = indices[e]
+                nd = d + weights[e]
+                if nd < dist.get(v, inf):
+                    dist[v] = nd
+                    parent[v] = u
+                    heappush(heap, (nd, v))
+        self.settled += len(pred)
+        return dist, pred
+
+
+def unwind_path(pred: dict[int, int], target: int) -> list[int]:
+    path = [target]
+    node = pred[target]
+    while node != -1:
+        path.append(node)
+        node = pred[node]
+    path.reverse()
+    return path
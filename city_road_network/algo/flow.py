@@ -0,0 +1,106 @@
+from dataclasses import dataclass
+
+import networkx as nx
+import numpy as np
+
+from city_road_network.algo.csr import CSRGraph
+from city_road_network.algo.paths import PathSet
+
+FLOW_TIME = "flow_time (s)"
+
+
+@dataclass(frozen=True)
+class FlowDifference:
+    max_abs: float
+    mean_abs: float
+    relative_l1: float
+
+
+def flow_difference(reference: np.ndarray, other: np.ndarray) -> FlowDifference:
+    """How far edge volumes ``other`` are from ``reference``. ``relative_l1`` is the sum of absolute differences over
+    the sum of reference volumes."""
+    diff = np.abs(np.asarray(other, dtype=np.float64) - reference)
+    if not len(diff):
+        return FlowDifference(0.0, 0.0, 0.0)
+    total = float(np.abs(reference).sum())
+    return FlowDifference(float(diff.max()), float(diff.mean()), float(diff.sum()) / total if total else 0.0)
+
+
+def speed_decay(maxspeed: np.ndarray, passes: np.ndarray, capacity: np.ndarray) -> np.ndarray:
+    """Current speed of edges, ``ffs * exp(-0.5 * (occ / cap) ** 2)`` but not less than a tenth of ``ffs``."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.maximum(maxspeed * np.exp(-0.5 * (passes / capacity) ** 2), maxspeed / 10)
+
+
+class EdgeFlowState:
+    """Traffic state of a road graph as arrays over its edges, in ``graph.edges(keys=True)`` order.
+
+    Replaces `add_passes_count` and `recalculate_flow_time` in simulations: passes are accumulated and flow times are
+    recalculated in place, and the graph is only touched by `to_graph`.
+    """
+
+    def __init__(
+        self,
+        length_km: np.ndarray,
+        maxspeed: np.ndarray,
+        capacity: np.ndarray,
+        flow_time: np.ndarray,
+        passes: np.ndarray | None = None,
+    ) -> None:
+        self.length_km = length_km
+        self.maxspeed = maxspeed
+        self.capacity = capacity
+        self.flow_time = flow_time
+        self.passes = np.zeros(len(length_km), dtype=np.int64) if passes is None else passes
+        self.cur_speed = None
+
+    @classmethod
+    def from_networkx(cls, graph: nx.MultiDiGraph) -> "EdgeFlowState":
+        def column(name, default=np.nan):
+            values = (edge_data.get(name, default) for _, _, edge_data in graph.edges(data=True))
+            return np.fromiter(values, dtype=np.float64, count=graph.number_of_edges())
+
+        passes = column("passes_count", 0).astype(np.int64)
+        return cls(
+            column("length (km)"), column("maxspeed (km/h)"), column("capacity (veh/h)"), column(FLOW_TIME), passes
+        )
+
+    @property
+    def n_edges(self) -> int:
+        return len(self.passes)
+
+    @property
+    def capacity_occupied(self) -> np.ndarray:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return self.passes / self.capacity
+
+    def count_passes(
+        self, paths: PathSet, csr: CSRGraph, weight: str, edge_ids: np.ndarray | None = None
+    ) -> np.ndarray:
+        """Passes per edge of ``paths``. Parallel edges are resolved to the one routing on ``weight`` has used, or by
+        ``edge_ids`` per slot when paths were routed on other weights than the current ones."""
+        if edge_ids is None:
+            edge_ids = csr.edge_ids[weight]
+        sources, targets = paths.edge_pairs()
+        edges = edge_ids[csr.find_slots(sources, targets)]
+        return np.bincount(edges, minlength=self.n_edges)
+
+    def travel_time(self, volumes: np.ndarray) -> np.ndarray:
+        """Flow time in seconds for edge ``volumes``, not truncated."""
+        return self.length_km / speed_decay(self.maxspeed, volumes, self.capacity) * 3600
+
+    def recalculate_flow_time(self) -> np.ndarray:
+        self.cur_speed = speed_decay(self.maxspeed, self.passes, self.capacity)
+        self.flow_time = np.trunc(self.length_km / self.cur_speed * 3600)
+        return self.flow_time
+
+    def to_graph(self, graph: nx.MultiDiGraph) -> nx.MultiDiGraph:
+        """Writes passes, occupied capacity and, once recalculated, speed and flow time onto ``graph`` in place."""
+        columns = {"passes_count": self.passes.tolist(), "capacity_occupied": self.capacity_occupied.tolist()}
+        if self.cur_speed is not None:
+            columns["cur_speed (km/h)"] = self.cur_speed.tolist()
+            columns[FLOW_TIME] = self.flow_time.astype(np.int64).tolist()
+        for e, (_, _, edge_data) in enumerate(graph.edges(data=True)):
+            for name, values in columns.items():
+                edge_data[name] = values[e]
+        return graph
@@ -1,18 +1,48 @@
+from collections.abc import Callable
+from dataclasses import dataclass
+
 import numpy as np
+import shapely
+
+from city_road_network.algo.od_matrix import SparseODMatrix
+from city_road_network.utils.utils import get_logger, wgs84_geod
+
+logger = get_logger(__name__)
+
+EARTH_RADIUS_KM = 6371.0088
+SPHERE_ERROR = 0.01  # relative, haversine distances on the mean sphere are within 0.6% of WGS84 geodesic ones
+
 
-from city_road_network.utils.utils import get_distance
+def get_centroid_coords(zones_gdf) -> tuple[np.ndarray, np.ndarray]:
+    centroids = np.asarray(zones_gdf["centroid"])
+    return shapely.get_x(centroids), shapely.get_y(centroids)
+
+
+def calc_distance_block(lon: np.ndarray, lat: np.ndarray, start: int, stop: int) -> np.ndarray:
+    """Geodesic distances in km from zones ``start..stop-1`` to all zones, one batched `Geod.inv` call."""
+    n = len(lon)
+    lon1, lon2 = np.repeat(lon[start:stop], n), np.tile(lon, stop - start)
+    lat1, lat2 = np.repeat(lat[start:stop], n), np.tile(lat, stop - start)
+    _, _, dist = wgs84_geod.inv(lon1, lat1, lon2, lat2)
+    return (np.asarray(dist) / 1000).reshape(stop - start, n)
+
+
+def calc_spherical_distance_block(lon: np.ndarray, lat: np.ndarray, start: int, stop: int) -> np.ndarray:
+    """Haversine distances in km from zones ``start..stop-1`` to all zones, within `SPHERE_ERROR` of geodesic ones."""
+    lon, lat = np.radians(lon), np.radians(lat)
+    d_lat = lat[np.newaxis, :] - lat[start:stop, np.newaxis]
+    d_lon = lon[np.newaxis, :] - lon[start:stop, np.newaxis]
+    h = (
+        np.sin(d_lat / 2) ** 2
+        + np.cos(lat[start:stop, np.newaxis]) * np.cos(lat[np.newaxis, :]) * np.sin(d_lon / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(h, 1.0)))
 
 
 def calc_distance_mat(zones_gdf):
-    distance_mat = np.zeros([zones_gdf.shape[0], zones_gdf.shape[0]])
-    for i in range(zones_gdf.shape[0]):
-        for j in range(zones_gdf.shape[0]):
-            centroid_i = zones_gdf.iloc[i].centroid
-            centroid_j = zones_gdf.iloc[j].centroid
-            distance_mat[i, j] = get_distance(
-                {"lat": centroid_i.y, "lon": centroid_i.x}, {"lat": centroid_j.y, "lon": centroid_j.x}
-            )
-    return distance_mat
+    """Geodesic distances in km between centroids of all zones."""
+    lon, lat = get_centroid_coords(zones_gdf)
+    return calc_distance_block(lon, lat, 0, len(lon))
 
 
 def calc_friction_mat(
@@ -21,35 +51,23 @@ def calc_friction_mat(
     b=-0.02,
     c=-0.123,
 ):
-    friction_mat = np.ones((d_mat.shape[0], d_mat.shape[1]))
-    for i in range(d_mat.shape[0]):
-        for j in range(d_mat.shape[1]):
-            distance = d_mat[i, j]
-            if distance != 0:
-                friction_mat[i, j] = a * (distance**b) * (np.exp(c * distance))
-            else:
-                friction_mat[i, j] = 0
+    with np.errstate(divide="ignore"):
+        friction_mat = a * (d_mat**b) * np.exp(c * d_mat)
+    friction_mat[d_mat == 0] = 0
     return friction_mat
 
 
 def calc_attraction_friction(attractions, f_mat):
-    attraction_friction_mat = np.zeros([f_mat.shape[0], f_mat.shape[0]])
-    for i in range(f_mat.shape[0]):
-        for j in range(f_mat.shape[1]):
-            attraction_friction_mat[i, j] = attractions[j] * f_mat[i, j]
-    return attraction_friction_mat
+    return np.asarray(attractions)[np.newaxis, :] * f_mat
 
 
 def calc_total_attraction_friction(attraction_friction_mat):
-    return np.array([attraction_friction_mat[i].sum() for i in range(attraction_friction_mat.shape[0])])
+    return attraction_friction_mat.sum(axis=1)
 
 
 def calc_trip_mat(f_mat, attr_f_mat, p_array, a_array):
-    trip_mat = np.ones((f_mat.shape[0], f_mat.shape[0]))
-    for i in range(f_mat.shape[0]):
-        for j in range(f_mat.shape[0]):
-            trip_mat[i][j] = float(p_array[i] * a_array[j] * f_mat[i, j] / max(0.000001, attr_f_mat[i]))
-    return trip_mat
+    p_array, a_array = np.asarray(p_array, dtype=np.float64), np.asarray(a_array, dtype=np.float64)
+    return p_array[:, np.newaxis] * a_array[np.newaxis, :] * f_mat / np.maximum(0.000001, attr_f_mat)[:, np.newaxis]
 
 
 def get_prod_error(trip_mat: np.array, prod_expected: np.array) -> float:
@@ -68,11 +86,7 @@ def correct_results(trip_mat, given_attr, given_prod, f_mat, a_list, max_iter=10
     if (prod_error < eps) and (attr_error < eps):
         return trip_mat
     for iteration in range(1, max_iter):
-        corrected_attr = np.zeros(trip_mat.shape[0])
-        for i in range(trip_mat.shape[0]):
-            actual_total_attr = trip_mat[:, i].sum()
-            expected_total_attr = given_attr[i]
-            corrected_attr[i] = a_list[iteration - 1][i] * expected_total_attr / actual_total_attr
+        corrected_attr = a_list[iteration - 1] * given_attr / trip_mat.sum(axis=0)
         a_list.append(corrected_attr)
         attr_f_mat = calc_attraction_friction(corrected_attr, f_mat)
         total_attr_f_mat = calc_total_attraction_friction(attr_f_mat)
@@ -85,14 +99,183 @@ def correct_results(trip_mat, given_attr, given_prod, f_mat, a_list, max_iter=10
     raise Exception("Didn't find satisfying result")
 
 
-def run_gravity_model(zones_gdf):
+@dataclass(frozen=True)
+class BalancingResult:
+    """Trips ``T[i, j] = row_factors[i] * col_factors[j] * f[i, j]`` matching productions and attractions.
+
+    ``prod_errors`` and ``attr_errors`` are mean squared errors of row and column sums after every iteration, as in
+    `get_prod_error` and `get_attr_error`.
+    """
+
+    trip_mat: np.ndarray | SparseODMatrix
+    row_factors: np.ndarray
+    col_factors: np.ndarray
+    prod_errors: np.ndarray
+    attr_errors: np.ndarray
+    converged: bool
+
+    @property
+    def iterations(self) -> int:
+        return len(self.prod_errors)
+
+
+def _dot_rows(f_mat: np.ndarray | SparseODMatrix, x: np.ndarray) -> np.ndarray:
+    """``f_mat @ x``"""
+    if isinstance(f_mat, SparseODMatrix):
+        return np.bincount(f_mat.rows, weights=f_mat.values * x[f_mat.cols], minlength=f_mat.n)
+    return f_mat @ x
+
+
+def _dot_cols(f_mat: np.ndarray | SparseODMatrix, x: np.ndarray) -> np.ndarray:
+    """``x @ f_mat``"""
+    if isinstance(f_mat, SparseODMatrix):
+        return np.bincount(f_mat.cols, weights=f_mat.values * x[f_mat.rows], minlength=f_mat.n)
+    return x @ f_mat
+
+
+def _safe_divide(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    return np.divide(a, b, out=np.zeros_like(a), where=b > 0)
+
+
+def balance_trip_mat(
+    f_mat: np.ndarray | SparseODMatrix,
+    productions,
+    attractions,
+    max_iter: int = 100,
+    eps: float = 10e-4,
+    omega: float = 1.0,
+    col_factors: np.ndarray | None = None,
+) -> BalancingResult:
+    """Doubly-constrained Furness balancing of friction ``f_mat``, dense or sparse.
+
+    Every iteration makes rows match ``productions`` and then moves column factors towards matching ``attractions``,
+    which takes two products of ``f_mat`` with a vector. ``omega`` over-relaxes the column update in log space,
+    ``b = b * (b_furness / b) ** omega``, 1 is plain Furness and values up to about 1.8 need fewer iterations when
+    convergence is slow. ``col_factors`` of a previous result warm-start balancing, e.g. after a few zones changed.
+    """
+    productions = np.asarray(productions, dtype=np.float64)
+    attractions = np.asarray(attractions, dtype=np.float64)
+    b = np.ones(len(attractions)) if col_factors is None else np.asarray(col_factors, dtype=np.float64).copy()
+    prod_errors, attr_errors = np.zeros(max_iter), np.zeros(max_iter)
+    iterations = 0
+    converged = False
+    f_b = _dot_rows(f_mat, b)
+    while iterations < max_iter and not converged:
+        a = _safe_divide(productions, f_b)
+        a_f = _dot_cols(f_mat, a)
+        target = _safe_divide(attractions, a_f)
+        if omega == 1.0:
+            b = target
+        else:
+            b = np.where((b > 0) & (target > 0), b * _safe_divide(target, b) ** omega, target)
+        f_b = _dot_rows(f_mat, b)
+        prod_errors[iterations] = np.square(productions - a * f_b).mean()
+        attr_errors[iterations] = np.square(attractions - b * a_f).mean()
+        converged = prod_errors[iterations] < eps and attr_errors[iterations] < eps
+        iterations += 1
+    if isinstance(f_mat, SparseODMatrix):
+        trip_mat = SparseODMatrix(f_mat.rows, f_mat.cols, a[f_mat.rows] * b[f_mat.cols] * f_mat.values, f_mat.n)
+    else:
+        trip_mat = a[:, np.newaxis] * f_mat * b[np.newaxis, :]
+    return BalancingResult(trip_mat, a, b, prod_errors[:iterations], attr_errors[:iterations], converged)
+
+
+def check_balancing(result: BalancingResult) -> BalancingResult:
+    if not result.converged:
+        logger.warning(
+            "Balancing didn't converge in %s iterations: production error %.3g, attraction error %.3g",
+            result.iterations,
+            result.prod_errors[-1],
+            result.attr_errors[-1],
+        )
+    return result
+
+
+def run_gravity_model(
+    zones_gdf,
+    friction: Callable[[np.ndarray], np.ndarray] = calc_friction_mat,
+    impedance_mat: np.ndarray | None = None,
+    furness: bool = False,
+):
+    """``friction`` turns impedance into friction, e.g. ``CalibrationResult.friction_mat`` of a calibrated model.
+    Impedance is straight-line distance between zone centroids in km, unless ``impedance_mat`` is given, e.g. network
+    distances ``calc_skims(graph, n)[LENGTH_WEIGHT] / 1000``. Unconnected zones have infinite impedance and no trips.
+
+    Trips are balanced by `correct_results`. With ``furness`` `balance_trip_mat` balances them instead, it converges to
+    the same matrix within ``eps``, so rounded trips may differ by one, and only warns if it doesn't converge."""
     prod_array = np.array(zones_gdf["production"])
     attr_array = np.array(zones_gdf["poi_attraction"])
+    if impedance_mat is None:
+        impedance_mat = calc_distance_mat(zones_gdf)
+    friction_mat = friction(impedance_mat)
+    if furness:
+        return check_balancing(balance_trip_mat(friction_mat, prod_array, attr_array)).trip_mat.round()
     attr_correction_list = [attr_array]
-    distance_mat = calc_distance_mat(zones_gdf)
-    friction_mat = calc_friction_mat(distance_mat)
     attr_f_mat = calc_attraction_friction(attr_array, friction_mat)
     total_attr_f_mat = calc_total_attraction_friction(attr_f_mat)
     trip_mat = calc_trip_mat(friction_mat, total_attr_f_mat, prod_array, attr_array)
     corrected_trip_mat = correct_results(trip_mat, attr_array, prod_array, friction_mat, attr_correction_list)
     return corrected_trip_mat.round()
+
+
+def calc_sparse_friction_mat(zones_gdf, cutoff_km: float | None = None, block_size: int = 1024) -> SparseODMatrix:
+    """Nonzero friction between zones not farther than ``cutoff_km`` apart. Distances are calculated for
+    ``block_size`` origin zones at a time, so no dense ``n x n`` matrix is built. With a cutoff, geodesic distances are
+    only calculated for pairs whose spherical distance is within the cutoff plus `SPHERE_ERROR`."""
+    lon, lat = get_centroid_coords(zones_gdf)
+    n = len(lon)
+    rows, cols, values = [], [], []
+    for start in range(0, n, block_size):
+        stop = min(n, start + block_size)
+        if cutoff_km is None:
+            distance_block = calc_distance_block(lon, lat, start, stop)
+            block_rows, block_cols = np.nonzero(distance_block >= 0)
+            distances = distance_block[block_rows, block_cols]
+        else:
+            approx = calc_spherical_distance_block(lon, lat, start, stop)
+            block_rows, block_cols = np.nonzero(approx <= cutoff_km * (1 + SPHERE_ERROR))
+            _, _, distances = wgs84_geod.inv(
+                lon[block_rows + start], lat[block_rows + start], lon[block_cols], lat[block_cols]
+            )
+            distances = np.asarray(distances) / 1000
+            close = distances <= cutoff_km
+            block_rows, block_cols, distances = block_rows[close], block_cols[close], distances[close]
+        friction = calc_friction_mat(distances)
+        nonzero = friction != 0
+        rows.append(block_rows[nonzero] + start)
+        cols.append(block_cols[nonzero])
+        values.append(friction[nonzero].astype(np.float32))
+    return SparseODMatrix(np.concatenate(rows), np.concatenate(cols), np.concatenate(values), n)
+
+
+def correct_sparse_results(f_mat: SparseODMatrix, given_attr, given_prod, max_iter=100, eps=10e-4) -> SparseODMatrix:
+    """`calc_trip_mat` and `correct_results` over nonzero cells of ``f_mat``."""
+    rows, cols, n = f_mat.rows, f_mat.cols, f_mat.n
+    friction = f_mat.values.astype(np.float64)
+    given_attr = np.asarray(given_attr, dtype=np.float64)
+    given_prod = np.asarray(given_prod, dtype=np.float64)
+    attr = given_attr
+    for _ in range(max_iter):
+        total_attr_f = np.bincount(rows, weights=attr[cols] * friction, minlength=n)
+        trips = given_prod[rows] * attr[cols] * friction / np.maximum(0.000001, total_attr_f)[rows]
+        productions = np.bincount(rows, weights=trips, minlength=n)
+        attractions = np.bincount(cols, weights=trips, minlength=n)
+        prod_error = np.square(given_prod - productions).mean()
+        attr_error = np.square(given_attr - attractions).mean()
+        if (prod_error < eps) and (attr_error < eps):
+            return SparseODMatrix(rows, cols, trips, n)
+        attr = np.divide(attr * given_attr, attractions, out=attr.copy(), where=attractions > 0)
+    raise Exception("Didn't find satisfying result")
+
+
+def run_sparse_gravity_model(
+    zones_gdf, cutoff_km: float | None = None, block_size: int = 1024, furness: bool = False
+) -> SparseODMatrix:
+    """`run_gravity_model` for many zones: friction is kept for zone pairs within ``cutoff_km`` only, in float32, and
+    rounded trips come as a `SparseODMatrix` without zero cells."""
+    prod_array = np.array(zones_gdf["production"])
+    attr_array = np.array(zones_gdf["poi_attraction"])
+    friction_mat = calc_sparse_friction_mat(zones_gdf, cutoff_km, block_size)
+    if furness:
+        return check_balancing(balance_trip_mat(friction_mat, prod_array, attr_array)).trip_mat.round()
+    return correct_sparse_results(friction_mat, attr_array, prod_array).round()
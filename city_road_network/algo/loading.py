@@ -0,0 +1,228 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import networkx as nx
+import numpy as np
+
+import city_road_network.algo.simulation as simulation
+from city_road_network.algo.assignment import (
+    AssignmentIteration,
+    all_or_nothing,
+    line_search,
+    relative_gap,
+    zone_all_or_nothing,
+)
+from city_road_network.algo.flow import FLOW_TIME
+from city_road_network.algo.od_matrix import (
+    SparseODMatrix,
+    crop_trip_mat,
+    nonzero_cells,
+)
+from city_road_network.algo.simulation import (
+    BaseSimulation,
+    get_matrix_size,
+    iter_path_cells,
+)
+from city_road_network.utils.utils import get_logger
+
+logger = get_logger(__name__)
+
+LOADING_ORIGINS = ("node", "zone")
+
+
+# workers run in processes set up by `BaseSimulation.worker_pool`, which holds the simulation in that module
+def _load_pairs_worker(task: tuple[np.ndarray, np.ndarray, np.ndarray]) -> tuple[np.ndarray, np.ndarray]:
+    return simulation._worker_simulation.load_pairs(*task)
+
+
+def _load_zones_worker(task: tuple[np.ndarray, np.ndarray]) -> tuple[np.ndarray, np.ndarray]:
+    return simulation._worker_simulation.load_zones(*task)
+
+
+class AllOrNothingLoading(BaseSimulation):
+    """Edge volumes of loading all trips onto shortest paths for current weights, without building paths.
+
+    With ``origins="node"`` trip endpoints are drawn the way simulations draw them and one shortest path tree is grown
+    per distinct origin node. With ``origins="zone"`` one tree is grown per origin zone from all of its nodes and trips
+    are spread evenly over nodes of destination zones. Demand is pushed up the trees from destinations, so memory
+    depends on the graph size and not on the number of trips.
+    """
+
+    def __init__(self, graph: nx.MultiDiGraph, weight: str = FLOW_TIME, origins: str = "node") -> None:
+        if origins not in LOADING_ORIGINS:
+            raise ValueError(f"Unknown origins '{origins}'. Expected one of {LOADING_ORIGINS}")
+        super().__init__(graph, weight, engine="csr")
+        self.origins = origins
+
+    def check_trip_mat(self, trip_mat: np.ndarray):
+        # zone loading drops unconnected zone pairs with a warning, trips within a zone just carry no flow
+        if self.origins == "node":
+            super().check_trip_mat(trip_mat)
+
+    def load_pairs(self, origins: np.ndarray, targets: np.ndarray, counts: np.ndarray):
+        if self.shared is not None:
+            self.sync_weights()
+        return all_or_nothing(self.csr, self.weight, origins, targets, counts)
+
+    def load_zones(self, zones: np.ndarray, trips: np.ndarray):
+        if self.shared is not None:
+            self.sync_weights()
+        zone_nodes = [self.zone_index.get_nodes(str(zone)) for zone in range(trips.shape[1])]
+        return zone_all_or_nothing(self.csr, self.weight, zone_nodes, zones, trips)
+
+    def draw_endpoints(self, o_zones: np.ndarray, d_zones: np.ndarray, rng: np.random.Generator):
+        starts = np.empty(len(o_zones), dtype=np.int32)
+        ends = np.empty(len(d_zones), dtype=np.int32)
+        for zones, nodes in ((o_zones, starts), (d_zones, ends)):
+            for zone in np.unique(zones):
+                trips = np.flatnonzero(zones == zone)
+                nodes[trips] = self.zone_index.sample_many(str(zone), rng, len(trips))
+        return starts, ends
+
+    def load(self, executor: ProcessPoolExecutor, demand, n_tasks: int) -> tuple[np.ndarray, np.ndarray]:
+        """Loads demand, node pairs with counts or a trip matrix, in the pool. Returns volumes and costs."""
+        volumes = np.zeros(self.csr.n_edges)
+        if self.origins == "zone":
+            costs = np.full(demand.shape, np.inf)
+            zones = np.flatnonzero(demand.sum(axis=1))
+            tasks = [(chunk, demand[chunk]) for chunk in np.array_split(zones, max(1, min(n_tasks, len(zones))))]
+            for (chunk, _), (task_volumes, task_costs) in zip(tasks, executor.map(_load_zones_worker, tasks)):
+                volumes += task_volumes
+                costs[chunk] = task_costs
+            return volumes, costs
+
+        origins, targets, counts = demand
+        groups = np.flatnonzero(np.r_[True, origins[1:] != origins[:-1]])
+        bounds = np.append(groups[:: -(-len(groups) // n_tasks)], len(origins))
+        tasks = [(origins[a:b], targets[a:b], counts[a:b]) for a, b in zip(bounds[:-1], bounds[1:])]
+        costs = []
+        for task_volumes, task_costs in executor.map(_load_pairs_worker, tasks):
+            volumes += task_volumes
+            costs.append(task_costs)
+        return volumes, np.concatenate(costs) if costs else np.empty(0)
+
+    def shortest_travel_time(self, demand, costs: np.ndarray) -> float:
+        counts = demand if self.origins == "zone" else demand[2]
+        loaded = counts > 0
+        return float(costs[loaded] @ counts[loaded])
+
+    def prepare_demand(self, executor, trip_mat, old_paths, n_tasks, max_redraws, seed=None):
+        """Builds demand and makes the first loading. Node pairs that can't be routed are redrawn, or dropped when
+        endpoints are fixed by ``old_paths``. Unroutable zone pairs are dropped. Endpoints are drawn with ``seed``, a
+        fresh one without it."""
+        if self.origins == "zone":
+            if trip_mat is None:
+                raise ValueError("Zone origins need trip_mat")
+            if isinstance(trip_mat, SparseODMatrix):
+                trip_mat = trip_mat.to_dense()
+            demand = trip_mat.astype(np.float64)
+            volumes, costs = self.load(executor, demand, n_tasks)
+            failed = (demand > 0) & ~np.isfinite(costs)
+            if failed.any():
+                logger.warning("Dropping %s trips between unconnected zones", demand[failed].sum())
+                demand[failed] = 0
+            return demand, volumes, costs
+
+        if trip_mat is not None:
+            if seed is None:
+                seed = np.random.SeedSequence().entropy
+            logger.info("Drawing trip endpoints with seed %s", seed)
+            rng = np.random.default_rng(seed)
+            rows, cols, trip_counts = nonzero_cells(trip_mat)
+            trip_counts = trip_counts.astype(np.int64)
+            o_zones, d_zones = np.repeat(rows, trip_counts), np.repeat(cols, trip_counts)
+            starts, ends = self.draw_endpoints(o_zones, d_zones, rng)
+        elif old_paths is not None:
+            node_index = self.csr.node_index
+            pairs = [(node_index[u], node_index[v]) for _, _, cell in iter_path_cells(old_paths) for u, v in cell]
+            starts, ends = np.array(pairs, dtype=np.int32).reshape(-1, 2).T
+        else:
+            raise ValueError("One of trip_mat, old_paths must be provided")
+
+        for _ in range(max_redraws + 1):
+            keys, inverse, counts = np.unique(
+                starts.astype(np.int64) * self.csr.n_nodes + ends, return_inverse=True, return_counts=True
+            )
+            demand = keys // self.csr.n_nodes, keys % self.csr.n_nodes, counts
+            volumes, costs = self.load(executor, demand, n_tasks)
+            failed = ~(costs[inverse] > 0) | ~np.isfinite(costs[inverse])
+            if not failed.any():
+                return demand, volumes, costs
+            if trip_mat is None:
+                logger.warning("Dropping %s trips with unreachable or empty paths", failed.sum())
+                starts, ends = starts[~failed], ends[~failed]
+            else:
+                starts[failed], ends[failed] = self.draw_endpoints(o_zones[failed], d_zones[failed], rng)
+        raise ValueError(f"Failed to find paths for {failed.sum()} trips..")
+
+    def run(self, trip_mat=None, old_paths=None, n=None, max_workers=None, max_redraws=100, seed=None):
+        if max_workers is None:
+            max_workers = os.cpu_count()
+        n = get_matrix_size(n, trip_mat, old_paths)
+        if trip_mat is not None:
+            trip_mat = crop_trip_mat(trip_mat, n)
+            self.check_trip_mat(trip_mat)
+
+        start = time.time()
+        with self.worker_pool(max_workers) as executor:
+            _, volumes, _ = self.prepare_demand(executor, trip_mat, old_paths, max_workers * 4, max_redraws, seed)
+        logger.info("Loading finished in %.1f s", time.time() - start)
+
+        self.flow.passes = volumes
+        self.graph = self.flow.to_graph(self.graph)
+        return volumes, self.graph
+
+
+class FrankWolfeAssignment(AllOrNothingLoading):
+    """User-equilibrium assignment of trips with the Frank-Wolfe algorithm.
+
+    Every iteration loads all trips onto shortest paths for current flow times (see `AllOrNothingLoading`) and moves
+    edge volumes towards that loading with the step minimizing the Beckmann objective of the speed decay used by
+    `recalculate_flow_time`. Stops when relative gap drops to ``target_gap``.
+    """
+
+    def __init__(self, graph: nx.MultiDiGraph, origins: str = "node") -> None:
+        super().__init__(graph, FLOW_TIME, origins)
+
+    def run(
+        self,
+        trip_mat=None,
+        old_paths=None,
+        n=None,
+        max_workers=None,
+        target_gap=1e-4,
+        max_iterations=100,
+        max_redraws=100,
+        seed=None,
+    ) -> tuple[list[AssignmentIteration], nx.MultiDiGraph]:
+        if max_workers is None:
+            max_workers = os.cpu_count()
+        n = get_matrix_size(n, trip_mat, old_paths)
+        if trip_mat is not None:
+            trip_mat = crop_trip_mat(trip_mat, n)
+            self.check_trip_mat(trip_mat)
+
+        n_tasks = max_workers * 4
+        iterations = []
+        start = time.time()
+        with self.worker_pool(max_workers) as executor:
+            self.set_weight_values(self.flow.travel_time(np.zeros(self.csr.n_edges)))
+            demand, volumes, _ = self.prepare_demand(executor, trip_mat, old_paths, n_tasks, max_redraws, seed)
+            for iteration in range(1, max_iterations + 1):
+                times = self.flow.travel_time(volumes)
+                self.set_weight_values(times)
+                loaded, costs = self.load(executor, demand, n_tasks)
+                gap = relative_gap(times, volumes, self.shortest_travel_time(demand, costs))
+                step = 0.0 if gap <= target_gap else line_search(self.flow.travel_time, volumes, loaded)
+                iterations.append(AssignmentIteration(iteration, gap, step, float(times @ volumes)))
+                logger.info("Iteration %s: relative gap %.3e, step %.3f", iteration, gap, step)
+                if gap <= target_gap:
+                    break
+                volumes += step * (loaded - volumes)
+        logger.info("Assignment finished in %.1f s", time.time() - start)
+
+        self.flow.passes = volumes
+        self.flow.recalculate_flow_time()
+        self.graph = self.flow.to_graph(self.graph)
+        return iterations, self.graph
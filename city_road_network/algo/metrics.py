@@ -0,0 +1,138 @@
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import IO
+
+
+@dataclass(frozen=True)
+class BatchMetrics:
+    """What a worker did for one batch. ``searches`` counts routed endpoint draws, ``found`` the paths built from
+    them, the rest failed and were redrawn. ``cached`` paths were served by the route cache without a search.
+    ``settled`` is ``None`` for routers that don't report it."""
+
+    batch: int
+    chunk: int
+    worker: int
+    started: float
+    seconds: float
+    paths: int
+    searches: int
+    found: int
+    settled: int | None
+    cached: int = 0
+
+    @property
+    def paths_per_second(self) -> float:
+        return self.paths / self.seconds if self.seconds > 0 else 0.0
+
+
+@dataclass
+class SimulationMetrics:
+    """Throughput of a simulation run, collected as batches complete.
+
+    ``parent_seconds`` is time the parent process spent per phase, e.g. counting passes or recalculating flow times,
+    while workers route. With ``filename`` every batch is appended to it as a JSON line, followed by a summary line
+    when the run finishes.
+    """
+
+    simulation: str
+    max_workers: int
+    filename: str | None = None
+    seed: int | None = None
+    batches: list[BatchMetrics] = field(default_factory=list)
+    parent_seconds: dict[str, float] = field(default_factory=lambda: defaultdict(float))
+    started: float = field(default_factory=time.time)
+    wall_seconds: float = 0.0
+    _file: IO | None = field(default=None, repr=False)
+
+    def __post_init__(self):
+        if self.filename is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+            self._file = open(self.filename, "a")
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_file"] = None
+        return state
+
+    def write(self, record: dict):
+        if self._file is not None:
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+
+    def add_batch(self, batch: BatchMetrics):
+        self.batches.append(batch)
+        self.write({"type": "batch", **asdict(batch)})
+
+    @contextmanager
+    def timer(self, phase: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.parent_seconds[phase] += time.perf_counter() - start
+
+    def finish(self):
+        self.wall_seconds = time.time() - self.started
+        self.write({"type": "summary", **self.summary()})
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @property
+    def paths(self) -> int:
+        return sum(batch.paths for batch in self.batches)
+
+    @property
+    def searches(self) -> int:
+        return sum(batch.searches for batch in self.batches)
+
+    @property
+    def found(self) -> int:
+        return sum(batch.found for batch in self.batches)
+
+    @property
+    def cached(self) -> int:
+        return sum(batch.cached for batch in self.batches)
+
+    @property
+    def worker_seconds(self) -> float:
+        return sum(batch.seconds for batch in self.batches)
+
+    @property
+    def paths_per_second(self) -> float:
+        return self.paths / self.wall_seconds if self.wall_seconds > 0 else 0.0
+
+    @property
+    def settled_per_search(self) -> float | None:
+        settled = [batch.settled for batch in self.batches if batch.settled is not None]
+        if not settled or len(settled) < len(self.batches):
+            return None
+        return sum(settled) / self.searches if self.searches else 0.0
+
+    @property
+    def worker_utilization(self) -> float:
+        """Share of the run's wall time ``max_workers`` workers spent building paths."""
+        if self.wall_seconds <= 0:
+            return 0.0
+        return self.worker_seconds / (self.max_workers * self.wall_seconds)
+
+    def summary(self) -> dict:
+        return {
+            "simulation": self.simulation,
+            "max_workers": self.max_workers,
+            "seed": self.seed,
+            "batches": len(self.batches),
+            "paths": self.paths,
+            "wall_seconds": self.wall_seconds,
+            "paths_per_second": self.paths_per_second,
+            "searches": self.searches,
+            "found": self.found,
+            "cached": self.cached,
+            "settled_per_search": self.settled_per_search,
+            "worker_utilization": self.worker_utilization,
+            "parent_seconds": dict(self.parent_seconds),
+        }
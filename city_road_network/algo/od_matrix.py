@@ -0,0 +1,94 @@
+import os
+from collections.abc import Iterator
+
+import numpy as np
+
+DENSE_TRIP_MAT_FILENAME = "trip_mat.npy"
+SPARSE_TRIP_MAT_FILENAME = "trip_mat.npz"
+
+
+class SparseODMatrix:
+    """Nonzero cells of an ``n x n`` OD matrix: ``values[k]`` trips go from zone ``rows[k]`` to zone ``cols[k]``.
+
+    Cells are in row-major order without duplicates. Values are float32, which holds trip counts exactly up to
+    ``2 ** 24`` per cell.
+    """
+
+    def __init__(self, rows: np.ndarray, cols: np.ndarray, values: np.ndarray, n: int) -> None:
+        self.rows = np.asarray(rows, dtype=np.int32)
+        self.cols = np.asarray(cols, dtype=np.int32)
+        self.values = np.asarray(values, dtype=np.float32)
+        self.n = n
+
+    @classmethod
+    def from_dense(cls, trip_mat: np.ndarray) -> "SparseODMatrix":
+        rows, cols = np.nonzero(trip_mat)
+        return cls(rows, cols, trip_mat[rows, cols], trip_mat.shape[0])
+
+    def to_dense(self) -> np.ndarray:
+        trip_mat = np.zeros(self.shape)
+        trip_mat[self.rows, self.cols] = self.values
+        return trip_mat
+
+    @classmethod
+    def load(cls, filename: str) -> "SparseODMatrix":
+        with np.load(filename) as data:
+            return cls(data["rows"], data["cols"], data["values"], int(data["n"]))
+
+    def save(self, filename: str):
+        np.savez(filename, rows=self.rows, cols=self.cols, values=self.values, n=self.n)
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        return self.n, self.n
+
+    @property
+    def nnz(self) -> int:
+        return len(self.values)
+
+    def sum(self, axis: int | None = None):
+        """Like ``np.ndarray.sum``: all trips, or trips per column (``axis=0``) or per row (``axis=1``)."""
+        if axis is None:
+            return self.values.sum(dtype=np.float64)
+        return np.bincount(self.rows if axis == 1 else self.cols, weights=self.values, minlength=self.n)
+
+    def crop(self, n: int) -> "SparseODMatrix":
+        """Cells between the first ``n`` zones."""
+        if n >= self.n:
+            return self
+        kept = (self.rows < n) & (self.cols < n)
+        return SparseODMatrix(self.rows[kept], self.cols[kept], self.values[kept], n)
+
+    def round(self) -> "SparseODMatrix":
+        """Rounded trips, cells rounded to zero are dropped."""
+        values = np.rint(self.values)
+        kept = values > 0
+        return SparseODMatrix(self.rows[kept], self.cols[kept], values[kept], self.n)
+
+
+def nonzero_cells(trip_mat: np.ndarray | SparseODMatrix) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Rows, columns and values of nonzero cells, row-major."""
+    if isinstance(trip_mat, SparseODMatrix):
+        return trip_mat.rows, trip_mat.cols, trip_mat.values
+    rows, cols = np.nonzero(trip_mat)
+    return rows, cols, trip_mat[rows, cols]
+
+
+def iter_od_cells(trip_mat: np.ndarray | SparseODMatrix) -> Iterator[tuple[int, int, int]]:
+    """Yields ``(i, j, trips)`` of nonzero cells, row-major."""
+    rows, cols, values = nonzero_cells(trip_mat)
+    yield from zip(rows.tolist(), cols.tolist(), values.astype(np.int64).tolist())
+
+
+def crop_trip_mat(trip_mat: np.ndarray | SparseODMatrix, n: int) -> np.ndarray | SparseODMatrix:
+    if isinstance(trip_mat, SparseODMatrix):
+        return trip_mat.crop(n)
+    return trip_mat[:n, :n]
+
+
+def load_trip_mat(directory: str) -> np.ndarray | SparseODMatrix:
+    """Trip matrix saved to ``directory``, the sparse one if there is one."""
+    filename = os.path.join(directory, SPARSE_TRIP_MAT_FILENAME)
+    if os.path.exists(filename):
+        return SparseODMatrix.load(filename)
+    return np.load(os.path.join(directory, DENSE_TRIP_MAT_FILENAME))
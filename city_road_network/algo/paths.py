@@ -0,0 +1,214 @@
+from collections.abc import Iterable, Iterator
+
+import numpy as np
+
+from city_road_network.algo.common import PathNT, TimedPath
+from city_road_network.algo.od_matrix import SparseODMatrix
+
+PATH_COLUMNS = ("nodes", "offsets", "travel_times", "o_zones", "d_zones")  # arrays of a PathSet saved to files
+
+
+class PathSet:
+    """Columnar storage of built paths.
+
+    Nodes of path ``k`` are ``nodes[offsets[k]:offsets[k + 1]]`` (indices of the simulation's CSR graph), its travel
+    time is ``travel_times[k]`` and it goes from zone ``o_zones[k]`` to zone ``d_zones[k]``. ``node_ids`` maps node
+    indices back to OSM ids, workers leave it out and the parent attaches it when results are combined.
+
+    For compatibility with code written for nested ``n x n`` lists of `TimedPath`, ``paths[i][j]`` returns the paths of
+    OD cell ``(i, j)`` as a list of `TimedPath` with OSM ids, and ``len(paths)`` is the number of zones.
+    """
+
+    def __init__(
+        self,
+        nodes: np.ndarray,
+        offsets: np.ndarray,
+        travel_times: np.ndarray,
+        o_zones: np.ndarray,
+        d_zones: np.ndarray,
+        node_ids: np.ndarray | None = None,
+        n: int | None = None,
+    ) -> None:
+        self.nodes = nodes
+        self.offsets = offsets
+        self.travel_times = travel_times
+        self.o_zones = o_zones
+        self.d_zones = d_zones
+        self.node_ids = node_ids
+        if n is None:
+            n = int(max(o_zones.max(initial=-1), d_zones.max(initial=-1))) + 1
+        self.n = n
+        self._cells = None
+
+    @classmethod
+    def empty(cls, node_ids: np.ndarray | None = None, n: int = 0) -> "PathSet":
+        return cls(
+            np.empty(0, dtype=np.int32),
+            np.zeros(1, dtype=np.int64),
+            np.empty(0, dtype=np.float64),
+            np.empty(0, dtype=np.int32),
+            np.empty(0, dtype=np.int32),
+            node_ids,
+            n,
+        )
+
+    @classmethod
+    def from_cells(cls, cells: Iterable[tuple[int, int, list[PathNT]]], node_ids=None, n=None) -> "PathSet":
+        """Packs ``(o_zone, d_zone, paths)`` triples, paths are given as node indices."""
+        lengths, nodes, travel_times, o_zones, d_zones = [], [], [], [], []
+        for o_zone, d_zone, paths in cells:
+            for path in paths:
+                lengths.append(len(path.path))
+                nodes.extend(path.path)
+                travel_times.append(path.travel_time)
+            o_zones.extend([o_zone] * len(paths))
+            d_zones.extend([d_zone] * len(paths))
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return cls(
+            np.array(nodes, dtype=np.int32),
+            offsets,
+            np.array(travel_times, dtype=np.float64),
+            np.array(o_zones, dtype=np.int32),
+            np.array(d_zones, dtype=np.int32),
+            node_ids,
+            n,
+        )
+
+    @classmethod
+    def from_nested(cls, paths: list[list[list[TimedPath]]], node_index: dict, node_ids: np.ndarray) -> "PathSet":
+        """Converts nested lists of `TimedPath` with OSM ids, e.g. results pickled by older versions."""
+        cells = (
+            (i, j, [PathNT([node_index[node] for node in p.path], p.travel_time) for p in cell])
+            for i, row in enumerate(paths)
+            for j, cell in enumerate(row)
+        )
+        return cls.from_cells(cells, node_ids, len(paths))
+
+    @classmethod
+    def concat(cls, parts: Iterable["PathSet"], node_ids: np.ndarray | None = None, n: int | None = None) -> "PathSet":
+        parts = [part for part in parts if part.n_paths]
+        if not parts:
+            return cls.empty(node_ids, n or 0)
+        lengths = np.concatenate([np.diff(part.offsets) for part in parts])
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        if node_ids is None:
+            node_ids = parts[0].node_ids
+        if n is None:
+            n = max(part.n for part in parts)
+        return cls(
+            np.concatenate([part.nodes for part in parts]),
+            offsets,
+            np.concatenate([part.travel_times for part in parts]),
+            np.concatenate([part.o_zones for part in parts]),
+            np.concatenate([part.d_zones for part in parts]),
+            node_ids,
+            n,
+        )
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_cells"] = None
+        return state
+
+    @property
+    def n_paths(self) -> int:
+        return len(self.travel_times)
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def path(self, k: int) -> np.ndarray:
+        return self.nodes[self.offsets[k] : self.offsets[k + 1]]
+
+    def take(self, indices: np.ndarray) -> "PathSet":
+        """Paths at ``indices``, in that order."""
+        indices = np.asarray(indices, dtype=np.int64)
+        starts, ends = self.offsets[indices], self.offsets[indices + 1]
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(ends - starts, out=offsets[1:])
+        positions = np.repeat(starts - offsets[:-1], ends - starts) + np.arange(offsets[-1])
+        return PathSet(
+            self.nodes[positions],
+            offsets,
+            self.travel_times[indices],
+            self.o_zones[indices],
+            self.d_zones[indices],
+            self.node_ids,
+            self.n,
+        )
+
+    def edge_pairs(self) -> tuple[np.ndarray, np.ndarray]:
+        """Sources and targets of all consecutive node pairs of all paths."""
+        inner = np.ones(max(len(self.nodes) - 1, 0), dtype=bool)
+        inner[self.offsets[1:-1] - 1] = False
+        return self.nodes[:-1][inner], self.nodes[1:][inner]
+
+    def _get_cells(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Path positions grouped by OD cell, the keys ``i * n + j`` of non-empty cells and bounds of their groups.
+        Only cells that have paths are indexed, so memory doesn't grow with ``n * n``."""
+        if self._cells is None:
+            keys = self.o_zones.astype(np.int64) * self.n + self.d_zones
+            order = np.argsort(keys, kind="stable")
+            cell_keys, starts = np.unique(keys[order], return_index=True)
+            self._cells = order, cell_keys, np.append(starts, len(order))
+        return self._cells
+
+    def cell_indices(self, i: int, j: int) -> np.ndarray:
+        """Positions of paths of OD cell ``(i, j)`` in the order they were added."""
+        order, cell_keys, bounds = self._get_cells()
+        key = i * self.n + j
+        k = np.searchsorted(cell_keys, key)
+        if k == len(cell_keys) or cell_keys[k] != key:
+            return order[:0]
+        return order[bounds[k] : bounds[k + 1]]
+
+    def cell_counts(self) -> SparseODMatrix:
+        """Number of paths of every non-empty OD cell."""
+        _, cell_keys, bounds = self._get_cells()
+        return SparseODMatrix(cell_keys // self.n, cell_keys % self.n, np.diff(bounds), self.n)
+
+    def iter_cells(self) -> Iterator[tuple[int, int, np.ndarray]]:
+        """Yields ``(i, j, path positions)`` for non-empty OD cells."""
+        order, cell_keys, bounds = self._get_cells()
+        for k, key in enumerate(cell_keys.tolist()):
+            yield key // self.n, key % self.n, order[bounds[k] : bounds[k + 1]]
+
+    def get_timed_paths(self, indices: Iterable[int]) -> list[TimedPath]:
+        nodes = self.nodes if self.node_ids is None else self.node_ids[self.nodes]
+        return [
+            TimedPath(nodes[self.offsets[k] : self.offsets[k + 1]].tolist(), float(self.travel_times[k]))
+            for k in indices
+        ]
+
+    def __len__(self) -> int:
+        return self.n
+
+    def __getitem__(self, i: int) -> "PathRow":
+        if not -self.n <= i < self.n:
+            raise IndexError(i)
+        return PathRow(self, i % self.n)
+
+    def __iter__(self) -> Iterator["PathRow"]:
+        return (PathRow(self, i) for i in range(self.n))
+
+
+class PathRow:
+    """Row ``i`` of the nested-list view of a `PathSet`."""
+
+    def __init__(self, paths: PathSet, i: int) -> None:
+        self.paths = paths
+        self.i = i
+
+    def __len__(self) -> int:
+        return self.paths.n
+
+    def __getitem__(self, j: int) -> list[TimedPath]:
+        if not -self.paths.n <= j < self.paths.n:
+            raise IndexError(j)
+        return self.paths.get_timed_paths(self.paths.cell_indices(self.i, j % self.paths.n))
+
+    def __iter__(self) -> Iterator[list[TimedPath]]:
+        return (self[j] for j in range(self.paths.n))
@@ -0,0 +1,151 @@
+from dataclasses import dataclass
+from functools import cached_property
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components, dijkstra
+
+from city_road_network.algo.assignment import get_csgraph
+from city_road_network.algo.csr import CSRGraph
+from city_road_network.algo.paths import PathSet
+
+COST_TOLERANCE = 1e-9  # relative, a detour must be cheaper than the current path by more than this
+
+
+@dataclass(frozen=True)
+class EdgeModification:
+    """Change of one edge, given by ``(u, v, key)`` OSM ids as in ``graph.edges(keys=True)``.
+
+    A closed edge can't be used anymore. ``maxspeed`` (km/h) and ``capacity`` (veh/h) replace the edge's values,
+    ``None`` keeps them.
+    """
+
+    edge: tuple[int, int, int]
+    closed: bool = False
+    maxspeed: float | None = None
+    capacity: float | None = None
+
+
+class EdgeUsageIndex:
+    """Edges used by every path of a `PathSet`, and paths using every edge.
+
+    Edges of path ``k`` are ``path_edges[offsets[k]:offsets[k + 1]]``, positions in ``graph.edges(keys=True)`` order.
+    """
+
+    def __init__(self, path_edges: np.ndarray, offsets: np.ndarray, n_edges: int) -> None:
+        self.path_edges = path_edges
+        self.offsets = offsets
+        self.n_edges = n_edges
+
+    @classmethod
+    def from_paths(
+        cls, paths: PathSet, csr: CSRGraph, weight: str, edge_ids: np.ndarray | None = None
+    ) -> "EdgeUsageIndex":
+        """Parallel edges are resolved as by `EdgeFlowState.count_passes`."""
+        if edge_ids is None:
+            edge_ids = csr.edge_ids[weight]
+        sources, targets = paths.edge_pairs()
+        offsets = np.zeros(paths.n_paths + 1, dtype=np.int64)
+        np.cumsum(np.maximum(paths.lengths - 1, 0), out=offsets[1:])
+        return cls(edge_ids[csr.find_slots(sources, targets)].astype(np.int32), offsets, csr.n_edges)
+
+    @classmethod
+    def concat(cls, parts: list["EdgeUsageIndex"]) -> "EdgeUsageIndex":
+        lengths = np.concatenate([np.diff(part.offsets) for part in parts])
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return cls(np.concatenate([part.path_edges for part in parts]), offsets, parts[0].n_edges)
+
+    def save(self, filename: str):
+        np.savez(filename, path_edges=self.path_edges, offsets=self.offsets, n_edges=self.n_edges)
+
+    @classmethod
+    def load(cls, filename: str) -> "EdgeUsageIndex":
+        with np.load(filename) as data:
+            return cls(data["path_edges"], data["offsets"], int(data["n_edges"]))
+
+    @property
+    def n_paths(self) -> int:
+        return len(self.offsets) - 1
+
+    @cached_property
+    def path_of_edge(self) -> np.ndarray:
+        """Path of every entry of ``path_edges``."""
+        return np.repeat(np.arange(self.n_paths, dtype=np.int64), np.diff(self.offsets))
+
+    @cached_property
+    def _by_edge(self) -> tuple[np.ndarray, np.ndarray]:
+        order = np.argsort(self.path_edges, kind="stable")
+        return order, np.searchsorted(self.path_edges[order], np.arange(self.n_edges + 1))
+
+    def paths_using(self, edges: np.ndarray) -> np.ndarray:
+        """Sorted positions of paths using any of ``edges``."""
+        order, bounds = self._by_edge
+        entries = [order[bounds[e] : bounds[e + 1]] for e in np.asarray(edges)]
+        if not entries:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(self.path_of_edge[np.concatenate(entries)])
+
+    def path_costs(self, edge_weights: np.ndarray) -> np.ndarray:
+        """Cost of every path for weights per edge."""
+        return np.bincount(self.path_of_edge, weights=edge_weights[self.path_edges], minlength=self.n_paths)
+
+    def take(self, indices: np.ndarray) -> "EdgeUsageIndex":
+        indices = np.asarray(indices, dtype=np.int64)
+        starts, ends = self.offsets[indices], self.offsets[indices + 1]
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(ends - starts, out=offsets[1:])
+        entries = np.repeat(starts - offsets[:-1], ends - starts) + np.arange(offsets[-1])
+        return EdgeUsageIndex(self.path_edges[entries], offsets, self.n_edges)
+
+    def count_passes(self, indices: np.ndarray | None = None) -> np.ndarray:
+        """Passes per edge of all paths, or of paths at ``indices``."""
+        index = self if indices is None else self.take(indices)
+        return np.bincount(index.path_edges, minlength=self.n_edges)
+
+
+def find_detour_candidates(
+    csr: CSRGraph,
+    weight: str,
+    edges: np.ndarray,
+    sources: np.ndarray,
+    targets: np.ndarray,
+    costs: np.ndarray,
+) -> np.ndarray:
+    """Mask of trips ``sources[k] -> targets[k]`` costing ``costs[k]`` that would get cheaper through one of ``edges``.
+
+    A trip can only gain from an improved edge ``a -> b`` if ``dist(source, a) + w(a, b) + dist(b, target)`` is less
+    than its cost, distances are taken for current weights. Searches from and to the edges stop at the highest cost.
+    """
+    candidates = np.zeros(len(sources), dtype=bool)
+    if not len(edges) or not len(sources):
+        return candidates
+    slot_sources = np.repeat(np.arange(csr.n_nodes, dtype=np.int32), np.diff(csr.indptr))
+    slots = np.flatnonzero(np.isin(csr.edge_ids[weight], edges))
+    if not len(slots):
+        return candidates
+    graph = get_csgraph(csr, weight)
+    limit = float(costs.max())
+    to_edges = dijkstra(graph.T.tocsr(), indices=slot_sources[slots], limit=limit)
+    from_edges = dijkstra(graph, indices=csr.indices[slots], limit=limit)
+    for k, slot in enumerate(slots):
+        detour = to_edges[k, sources] + csr.weights[weight][slot] + from_edges[k, targets]
+        candidates |= detour < costs * (1 - COST_TOLERANCE)
+    return candidates
+
+
+def find_reachable(csr: CSRGraph, weight: str, sources: np.ndarray, targets: np.ndarray) -> np.ndarray:
+    """Mask of pairs ``sources[k] -> targets[k]`` connected by edges of finite ``weight``."""
+    finite = np.isfinite(csr.weights[weight])
+    rows = np.repeat(np.arange(csr.n_nodes, dtype=np.int32), np.diff(csr.indptr))
+    graph = csr_matrix(
+        (np.ones(finite.sum(), dtype=np.int8), (rows[finite], csr.indices[finite])), shape=(csr.n_nodes, csr.n_nodes)
+    )
+    _, labels = connected_components(graph, directed=True, connection="strong")
+    reachable = labels[sources] == labels[targets]
+    unknown = np.flatnonzero(~reachable)
+    if len(unknown):
+        origins, inverse = np.unique(sources[unknown], return_inverse=True)
+        dist = dijkstra(graph, indices=origins, unweighted=True)
+        reachable[unknown] = np.isfinite(dist[inverse, targets[unknown]])
+    return reachable
@@ -0,0 +1,77 @@
+import hashlib
+import os
+import sqlite3
+
+import numpy as np
+
+from city_road_network.algo.common import PathNT
+from city_road_network.algo.csr import CSRGraph
+from city_road_network.utils.utils import get_data_subdir
+
+BUSY_TIMEOUT_S = 60.0  # workers of a pool write to the same database
+
+
+def get_route_cache_filename(city_name: str | None = None) -> str:
+    return os.path.join(get_data_subdir(city_name), "routes.sqlite")
+
+
+def get_graph_fingerprint(csr: CSRGraph, weight: str) -> str:
+    """Identifies shortest paths of a graph: node ids, topology and routing weights of ``weight``."""
+    digest = hashlib.blake2b(digest_size=16)
+    for array in (csr.node_ids, csr.indptr, csr.indices, csr.weights[weight]):
+        array = np.ascontiguousarray(array)
+        digest.update(array.dtype.str.encode())
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+class RouteCache:
+    """Routed ``(u, v) -> (cost, path)`` in an SQLite file, per graph fingerprint, see `get_graph_fingerprint`.
+
+    Nodes are indices of the simulation's CSR graph, the fingerprint covers their order. Every process opens its own
+    connection on first use, new routes are written by `flush`.
+    """
+
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        self.connection = None
+        self.pending = []
+
+    def __getstate__(self):
+        return {"filename": self.filename, "connection": None, "pending": []}
+
+    def connect(self) -> sqlite3.Connection:
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.filename, timeout=BUSY_TIMEOUT_S)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS routes "
+                "(fingerprint TEXT, u INTEGER, v INTEGER, cost REAL, path BLOB, PRIMARY KEY (fingerprint, u, v))"
+            )
+        return self.connection
+
+    def get(self, fingerprint: str, u: int, v: int) -> PathNT | None:
+        row = (
+            self.connect()
+            .execute("SELECT cost, path FROM routes WHERE fingerprint = ? AND u = ? AND v = ?", (fingerprint, u, v))
+            .fetchone()
+        )
+        if row is None:
+            return None
+        return PathNT(np.frombuffer(row[1], dtype=np.int32).tolist(), row[0])
+
+    def put(self, fingerprint: str, u: int, v: int, path: PathNT):
+        self.pending.append((fingerprint, u, v, path.travel_time, np.asarray(path.path, dtype=np.int32).tobytes()))
+
+    def flush(self):
+        if not self.pending:
+            return
+        with self.connect() as connection:
+            connection.executemany("INSERT OR IGNORE INTO routes VALUES (?, ?, ?, ?, ?)", self.pending)
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
@@ -0,0 +1,172 @@
+from collections.abc import Iterable
+from heapq import heappop, heappush
+from math import inf
+
+import networkx as nx
+import numpy as np
+
+from city_road_network.algo.ch import ContractionHierarchy
+from city_road_network.algo.csr import CSRGraph
+
+ENGINES = ("networkx", "csr", "ch")
+SEARCHES = ("dijkstra", "astar", "bidirectional")
+
+
+class NetworkxRouter:
+    def __init__(
+        self, graph: nx.MultiDiGraph, csr: CSRGraph, weight: str, search: str = "dijkstra", scale: float | None = None
+    ) -> None:
+        self.graph = graph
+        self.csr = csr
+        self.weight = weight
+        self.search = search
+        if scale is None:
+            scale = csr.heuristic_scale(weight) if search == "astar" else 0.0
+        self.scale = scale
+
+    @property
+    def settled(self) -> None:
+        """networkx doesn't report how many nodes its searches settle."""
+        return None
+
+    def heuristic(self, u, v) -> float:
+        node_index = self.csr.node_index
+        return self.scale * self.csr.great_circle(node_index[u], node_index[v])
+
+    def shortest_path(self, u: int, v: int) -> tuple[float, list[int]]:
+        node_list = self.csr.node_list
+        if self.search == "astar":
+            path = nx.astar_path(self.graph, node_list[u], node_list[v], heuristic=self.heuristic, weight=self.weight)
+            path_cost = nx.path_weight(self.graph, path, self.weight)
+        elif self.search == "bidirectional":
+            path_cost, path = nx.bidirectional_dijkstra(self.graph, node_list[u], node_list[v], weight=self.weight)
+        else:
+            path_cost, path = nx.single_source_dijkstra(self.graph, node_list[u], node_list[v], weight=self.weight)
+        node_index = self.csr.node_index
+        return path_cost, [node_index[node] for node in path]
+
+    def shortest_paths(self, u: int, targets: Iterable[int]) -> dict[int, tuple[float, list[int]]]:
+        """One-to-many Dijkstra over the networkx graph. Stops once every target is settled, unreachable targets are
+        left out of the result. Parallel edges cost the least of their weights, missing weights count as 1."""
+        node_list = self.csr.node_list
+        node_index = self.csr.node_index
+        weight = self.weight
+        adj = self.graph.adj
+        targets = set(targets)
+        remaining = {node_list[v] for v in targets}
+        source = node_list[u]
+        dist = {source: 0.0}
+        parent = {source: None}
+        pred = {}
+        heap = [(0.0, 0, source)]
+        counter = 1
+        while heap and remaining:
+            d, _, node = heappop(heap)
+            if node in pred:
+                continue
+            pred[node] = parent[node]
+            remaining.discard(node)
+            for neighbor, edges in adj[node].items():
+                nd = d + min(data.get(weight, 1) for data in edges.values())
+                if nd < dist.get(neighbor, inf):
+                    dist[neighbor] = nd
+                    parent[neighbor] = node
+                    heappush(heap, (nd, counter, neighbor))
+                    counter += 1
+
+        found = {}
+        for v in targets:
+            node = node_list[v]
+            if node not in pred:
+                continue
+            path = []
+            while node is not None:
+                path.append(node_index[node])
+                node = pred[node]
+            path.reverse()
+            found[v] = (dist[node_list[v]], path)
+        return found
+
+
+class CSRRouter:
+    def __init__(
+        self, graph: nx.MultiDiGraph, csr: CSRGraph, weight: str, search: str = "dijkstra", scale: float | None = None
+    ) -> None:
+        self.csr = csr
+        self.weight = weight
+        self.search = search
+        if scale is None:
+            scale = csr.heuristic_scale(weight) if search == "astar" else 0.0
+        self.scale = scale
+
+    @property
+    def settled(self) -> int:
+        return self.csr.settled
+
+    def shortest_path(self, u: int, v: int) -> tuple[float, list[int]]:
+        if self.search == "astar":
+            return self.csr.astar(u, v, self.weight, self.scale)
+        if self.search == "bidirectional":
+            return self.csr.bidirectional_dijkstra(u, v, self.weight)
+        return self.csr.dijkstra(u, v, self.weight)
+
+    def shortest_paths(self, u: int, targets: Iterable[int]) -> dict[int, tuple[float, list[int]]]:
+        return self.csr.dijkstra_many(u, targets, self.weight)
+
+
+class CHRouter:
+    """Answers queries with a contraction hierarchy. Re-customizes it on first use if graph weights have changed."""
+
+    def __init__(self, csr: CSRGraph, weight: str, hierarchy: ContractionHierarchy) -> None:
+        self.csr = csr
+        self.weight = weight
+        self.hierarchy = hierarchy
+        self.customized = False
+
+    @property
+    def settled(self) -> int:
+        return self.hierarchy.settled
+
+    def customize(self):
+        weights = self.csr.weights[self.weight]
+        if not np.array_equal(self.hierarchy.base_weights, weights):
+            self.hierarchy.customize(weights)
+        self.customized = True
+
+    def shortest_path(self, u: int, v: int) -> tuple[float, list[int]]:
+        if not self.customized:
+            self.customize()
+        return self.hierarchy.query(u, v)
+
+    def shortest_paths(self, u: int, targets: Iterable[int]) -> dict[int, tuple[float, list[int]]]:
+        found = {}
+        for v in set(targets):
+            try:
+                found[v] = self.shortest_path(u, v)
+            except nx.NetworkXNoPath:
+                pass
+        return found
+
+
+def get_router(
+    engine: str,
+    graph: nx.MultiDiGraph,
+    csr: CSRGraph,
+    weight: str,
+    search: str = "dijkstra",
+    hierarchy: ContractionHierarchy | None = None,
+    scale: float | None = None,
+):
+    """Router of ``engine`` answering ``search`` queries. A* uses ``scale``, see `CSRGraph.heuristic_scale`, which by
+    default is derived from current weights."""
+    if search not in SEARCHES:
+        raise ValueError(f"Unknown search '{search}'. Expected one of {SEARCHES}")
+    if engine == "networkx":
+        return NetworkxRouter(graph, csr, weight, search, scale)
+    if engine == "csr":
+        return CSRRouter(graph, csr, weight, search, scale)
+    if engine == "ch":
+        if search != "dijkstra":
+            raise ValueError(f"Search '{search}' is not supported by the ch engine, it answers hierarchy queries only")
+        return CHRouter(csr, weight, hierarchy)
+    raise ValueError(f"Unknown engine '{engine}'. Expected one of {ENGINES}")
@@ -0,0 +1,146 @@
+import os
+from dataclasses import dataclass
+
+import networkx as nx
+import numpy as np
+import pandas as pd
+
+from city_road_network.algo.ch import ContractionHierarchy
+from city_road_network.algo.flow import FLOW_TIME, EdgeFlowState, flow_difference
+from city_road_network.algo.metrics import SimulationMetrics
+from city_road_network.algo.od_matrix import SparseODMatrix, crop_trip_mat
+from city_road_network.algo.rerouting import EdgeModification
+from city_road_network.algo.scheduling import BatchScheduler, ZoneCostModel
+from city_road_network.algo.simulation import (
+    NaiveSimulation,
+    _measured_build_paths_worker,
+    get_matrix_size,
+    iter_trip_cells,
+)
+from city_road_network.algo.sinks import EdgeCountSink
+from city_road_network.utils.utils import get_logger
+
+logger = get_logger(__name__)
+
+
+@dataclass(frozen=True)
+class Scenario:
+    """Variant of the base network, edges are closed or get other maxspeed or capacity, see `EdgeModification`."""
+
+    name: str
+    modifications: tuple[EdgeModification, ...] = ()
+
+
+@dataclass(frozen=True)
+class ScenarioResults:
+    """``summary`` has a row per scenario, ``edge_flows`` has passes per edge, indexed by ``(u, v, key)``, in a column
+    per scenario."""
+
+    summary: pd.DataFrame
+    edge_flows: pd.DataFrame
+
+
+class ScenarioRunner:
+    """Routes the same trips on variants of one base network.
+
+    The base graph is copied and turned into arrays once, all scenarios are routed by one worker pool attached to
+    these arrays in shared memory, a scenario only rewrites routing weights of the edges it modifies. Trips draw the
+    same endpoints in every scenario, so that flows differ by the network only.
+    """
+
+    def __init__(
+        self,
+        graph: nx.MultiDiGraph,
+        weight: str = FLOW_TIME,
+        engine: str = "csr",
+        routing: str = "point",
+        search: str = "dijkstra",
+        hierarchy: ContractionHierarchy | None = None,
+    ) -> None:
+        self.simulation = NaiveSimulation(graph, weight, engine, routing, search, hierarchy)
+        flow = self.simulation.flow
+        self.base_flow = EdgeFlowState(
+            flow.length_km, flow.maxspeed.copy(), flow.capacity.copy(), flow.flow_time.copy()
+        )
+        self.base_values = self.simulation.csr.edge_weights[weight].copy()
+
+    def reset(self, edges: np.ndarray):
+        """Restores the base network on ``edges`` and clears passes."""
+        simulation = self.simulation
+        base = self.base_flow
+        simulation.flow = EdgeFlowState(
+            base.length_km, base.maxspeed.copy(), base.capacity.copy(), base.flow_time.copy()
+        )
+        if not len(edges):
+            return
+        all_edges = list(simulation.graph.edges(keys=True))
+        for e in edges:
+            edge_data = simulation.graph.edges[all_edges[e]]
+            edge_data["maxspeed (km/h)"] = float(base.maxspeed[e])
+            edge_data["capacity (veh/h)"] = float(base.capacity[e])
+            edge_data[simulation.weight] = float(self.base_values[e])
+        simulation.set_weight_values(self.base_values)
+
+    def run(
+        self,
+        trip_mat: np.ndarray | SparseODMatrix,
+        scenarios: list[Scenario],
+        n=None,
+        max_workers=None,
+        batch_size=1000,
+        target_seconds=2.0,
+        seed=None,
+    ) -> ScenarioResults:
+        """Routes ``trip_mat`` for every scenario. Flows are compared to the first scenario, put ``Scenario("base")``
+        first to compare with the unmodified network.
+
+        Travel time is ``passes @ travel_time(passes)`` of `EdgeFlowState`, i.e. of speeds decayed by the scenario's
+        flows, in vehicle hours.
+        """
+        if max_workers is None:
+            max_workers = os.cpu_count()
+        simulation = self.simulation
+        n = get_matrix_size(n, trip_mat)
+        trip_mat = crop_trip_mat(trip_mat, n)
+        simulation.check_trip_mat(trip_mat)
+        simulation.set_nodes_getter(trip_mat, None, seed)
+        cells = list(iter_trip_cells(trip_mat))
+        cost_model = ZoneCostModel.from_zone_index(simulation.zone_index, simulation.csr.node_coords, n)
+
+        flows = {}
+        rows = []
+        edges = np.empty(0, dtype=np.int64)
+        with simulation.worker_pool(max_workers) as executor:
+            scheduler = BatchScheduler(
+                executor, _measured_build_paths_worker, max_workers, cost_model, target_seconds, batch_size
+            )
+            for scenario in scenarios:
+                self.reset(edges)
+                edges = simulation.apply_modifications(list(scenario.modifications))
+                simulation.metrics = SimulationMetrics(f"scenario {scenario.name}", max_workers)
+                simulation.metrics.seed = simulation.nodes_getter.seed
+                sink = EdgeCountSink()
+                sink.open(simulation.csr.node_ids, n, 0, [], np.zeros_like(simulation.flow.passes))
+                for _, passes in simulation.iter_chunks(scheduler, [cells], sink, lookahead=None):
+                    simulation.flow.passes += passes
+                simulation.metrics.finish()
+                flow = simulation.flow
+                flows[scenario.name] = flow.passes.copy()
+                difference = flow_difference(flows[scenarios[0].name], flow.passes)
+                rows.append(
+                    {
+                        "scenario": scenario.name,
+                        "modified_edges": len(edges),
+                        "paths": simulation.metrics.paths,
+                        "vehicle_km": float(flow.passes @ flow.length_km),
+                        "vehicle_hours": float(flow.passes @ flow.travel_time(flow.passes)) / 3600,
+                        "max_abs_flow_change": difference.max_abs,
+                        "relative_l1": difference.relative_l1,
+                        "wall_seconds": simulation.metrics.wall_seconds,
+                    }
+                )
+                logger.info("Scenario %s routed in %.1f s", scenario.name, simulation.metrics.wall_seconds)
+        self.reset(edges)
+
+        index = pd.MultiIndex.from_tuples(list(simulation.graph.edges(keys=True)), names=["u", "v", "key"])
+        return ScenarioResults(pd.DataFrame(rows).set_index("scenario"), pd.DataFrame(flows, index=index))
@@ -0,0 +1,161 @@
+import math
+import time
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import Executor
+from dataclasses import dataclass
+
+import numpy as np
+
+from city_road_network.algo.common import ZoneIndex
+from city_road_network.algo.csr import EARTH_RADIUS_M
+
+TRIP_OVERHEAD_KM = 1.0  # cost of a trip between nodes of the same zone, in km of centroid distance
+INITIAL_WAVES = 8  # batches per worker before throughput is measured
+PREFETCH = 2  # batches in flight per worker, so that none waits for the parent
+TAIL_SHRINK = 10  # smallest batch at the end of the run, as a fraction of the regular one
+
+
+@dataclass(frozen=True)
+class TripCell:
+    """Trips of one OD cell. ``starts_ends`` holds fixed endpoints as OSM ids, ``None`` means draw them randomly.
+    ``start`` is the position of the first trip among all trips of the cell."""
+
+    o_zone: int
+    d_zone: int
+    count: int
+    starts_ends: list[tuple[int, int]] | None = None
+    start: int = 0
+
+    def take(self, start: int, count: int) -> "TripCell":
+        if self.starts_ends is None:
+            return TripCell(self.o_zone, self.d_zone, count, start=self.start + start)
+        return TripCell(self.o_zone, self.d_zone, count, self.starts_ends[start : start + count], self.start + start)
+
+
+def split_cells(cells: Iterable[TripCell], size: int) -> Iterator[list[TripCell]]:
+    """Groups cells into consecutive parts of ``size`` trips, the last one may be smaller."""
+    part, free = [], size
+    for cell in cells:
+        start = 0
+        while start < cell.count:
+            count = min(free, cell.count - start)
+            part.append(cell.take(start, count))
+            start += count
+            free -= count
+            if free == 0:
+                yield part
+                part, free = [], size
+    if part:
+        yield part
+
+
+class ZoneCostModel:
+    """Estimates routing cost of a trip from great-circle distance between centroids of its zones.
+
+    Dijkstra work grows with the distance between endpoints, so a cross-city trip costs many times an intra-zone
+    one. Without node coordinates all trips cost the same.
+    """
+
+    def __init__(self, centroids: np.ndarray | None) -> None:
+        self.centroids = centroids
+
+    @classmethod
+    def from_zone_index(cls, zone_index: ZoneIndex, node_coords: np.ndarray | None, n: int) -> "ZoneCostModel":
+        if node_coords is None:
+            return cls(None)
+        centroids = np.full((n, 2), np.nan)
+        for zone in range(n):
+            nodes = zone_index.get_nodes(str(zone))
+            if len(nodes):
+                centroids[zone] = np.radians(node_coords[nodes].mean(axis=0))
+        return cls(centroids)
+
+    def trip_cost(self, o_zone: int, d_zone: int) -> float:
+        if self.centroids is None:
+            return TRIP_OVERHEAD_KM
+        (lat1, lon1), (lat2, lon2) = self.centroids[o_zone], self.centroids[d_zone]
+        h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+        distance_km = 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(h))) / 1000
+        if math.isnan(distance_km):
+            return TRIP_OVERHEAD_KM
+        return TRIP_OVERHEAD_KM + distance_km
+
+
+class BatchScheduler:
+    """Batch sizes for feeding a process pool with ``fn``, see `BaseSimulation.iter_chunks`.
+
+    Batch size is a cost budget: cells are merged or split so that a batch takes about ``target_seconds`` at the
+    throughput measured on finished batches. Towards the end of the run the budget shrinks with the remaining work so
+    that all workers finish at about the same time.
+    """
+
+    def __init__(
+        self,
+        executor: Executor,
+        fn: Callable,
+        max_workers: int,
+        cost_model: ZoneCostModel,
+        target_seconds: float = 2.0,
+        max_batch_size: int | None = None,
+    ) -> None:
+        self.executor = executor
+        self.fn = fn
+        self.max_workers = max_workers
+        self.cost_model = cost_model
+        self.target_seconds = target_seconds
+        self.max_batch_size = max_batch_size
+        self.seconds_per_unit = None
+        self.total = 0.0
+        self.remaining = 0.0
+
+    def update_throughput(self, cost: float, seconds: float, smoothing: float = 0.3):
+        if cost <= 0 or seconds <= 0:
+            return
+        measured = seconds / cost
+        if self.seconds_per_unit is None:
+            self.seconds_per_unit = measured
+        else:
+            self.seconds_per_unit += smoothing * (measured - self.seconds_per_unit)
+
+    def start(self, cells: list[TripCell]):
+        """Sets the amount of work the budget tail is computed from."""
+        self.total = sum(cell.count * self.cost_model.trip_cost(cell.o_zone, cell.d_zone) for cell in cells)
+        self.remaining = self.total
+
+    def budget(self) -> float:
+        if self.seconds_per_unit is None:
+            budget = self.total / (self.max_workers * INITIAL_WAVES)
+        else:
+            budget = self.target_seconds / self.seconds_per_unit
+        tail = self.remaining / (self.max_workers * PREFETCH)
+        return min(budget, max(tail, budget / TAIL_SHRINK))
+
+    def iter_batches(self, cells: Iterable[TripCell], make_batch: Callable) -> Iterator[tuple[list, float]]:
+        """Yields batches of ``make_batch(cell)`` items with their estimated cost."""
+        batch, batch_cost, batch_size = [], 0.0, 0
+        budget = self.budget()
+        for cell in cells:
+            trip_cost = self.cost_model.trip_cost(cell.o_zone, cell.d_zone)
+            start = 0
+            while start < cell.count:
+                count = max(1, min(cell.count - start, math.ceil((budget - batch_cost) / trip_cost)))
+                if self.max_batch_size is not None:
+                    count = min(count, self.max_batch_size - batch_size)
+                batch.append(make_batch(cell.take(start, count)))
+                start += count
+                batch_cost += count * trip_cost
+                batch_size += count
+                if batch_cost >= budget or batch_size == self.max_batch_size:
+                    self.remaining -= batch_cost
+                    yield batch, batch_cost
+                    batch, batch_cost, batch_size = [], 0.0, 0
+                    budget = self.budget()
+        if batch:
+            self.remaining -= batch_cost
+            yield batch, batch_cost
+
+
+def timed(fn: Callable, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
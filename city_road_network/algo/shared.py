@@ -0,0 +1,54 @@
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+
+class SharedArrays:
+    """Named numpy arrays living in shared memory.
+
+    The owning process creates blocks and copies arrays into them. Pickling only transfers block names, shapes and
+    dtypes, unpickling attaches to the same blocks, so worker processes get zero-copy views of the arrays.
+    """
+
+    def __init__(self, arrays: dict[str, np.ndarray] | None = None) -> None:
+        self.blocks = {}
+        self.arrays = {}
+        self.owner = True
+        for name, array in (arrays or {}).items():
+            self.add(name, array)
+
+    def add(self, name: str, array: np.ndarray) -> np.ndarray:
+        array = np.asarray(array)
+        if array.dtype.hasobject:
+            raise ValueError(f"Array '{name}' of dtype {array.dtype} can't be placed in shared memory")
+        block = SharedMemory(create=True, size=max(array.nbytes, 1))
+        view = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+        view[...] = array
+        self.blocks[name] = block
+        self.arrays[name] = view
+        return view
+
+    @property
+    def descriptor(self) -> dict[str, tuple[str, tuple[int, ...], str]]:
+        return {name: (self.blocks[name].name, view.shape, view.dtype.str) for name, view in self.arrays.items()}
+
+    def __getstate__(self):
+        return self.descriptor
+
+    def __setstate__(self, descriptor):
+        self.blocks = {}
+        self.arrays = {}
+        self.owner = False
+        for name, (block_name, shape, dtype) in descriptor.items():
+            block = SharedMemory(name=block_name)
+            self.blocks[name] = block
+            self.arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+
+    def close(self):
+        """Releases the blocks. The owner also unlinks them, so no views of the arrays may outlive this call."""
+        self.arrays = {}
+        for block in self.blocks.values():
+            block.close()
+            if self.owner:
+                block.unlink()
+        self.blocks = {}
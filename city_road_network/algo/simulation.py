@@ -1,47 +1,78 @@
 import copy
+import math
 import os
 import time
+from collections import defaultdict
 from collections.abc import Generator, Iterator
-from concurrent.futures import ProcessPoolExecutor
-from dataclasses import dataclass
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import contextmanager
+from dataclasses import dataclass, replace
 from functools import partial
 from itertools import islice
 
 import networkx as nx
 import numpy as np
 
-from city_road_network.algo.common import (
-    TimedPath,
-    add_passes_count,
-    recalculate_flow_time,
+from city_road_network.algo.ch import ContractionHierarchy
+from city_road_network.algo.checkpoint import SimulationCheckpoint, get_input_key
+from city_road_network.algo.common import PathNT, TimedPath, ZoneIndex
+from city_road_network.algo.csr import CSRGraph
+from city_road_network.algo.flow import FLOW_TIME, EdgeFlowState, speed_decay
+from city_road_network.algo.metrics import BatchMetrics, SimulationMetrics
+from city_road_network.algo.od_matrix import (
+    SparseODMatrix,
+    crop_trip_mat,
+    iter_od_cells,
 )
+from city_road_network.algo.paths import PathSet
+from city_road_network.algo.rerouting import (
+    EdgeModification,
+    EdgeUsageIndex,
+    find_detour_candidates,
+    find_reachable,
+)
+from city_road_network.algo.route_cache import RouteCache, get_graph_fingerprint
+from city_road_network.algo.routing import get_router
+from city_road_network.algo.scheduling import (
+    PREFETCH,
+    BatchScheduler,
+    TripCell,
+    ZoneCostModel,
+    split_cells,
+    timed,
+)
+from city_road_network.algo.shared import SharedArrays
+from city_road_network.algo.sinks import MemorySink, PathSink
 from city_road_network.utils.utils import get_logger
 
 logger = get_logger(__name__)
 
+ROUTING_MODES = ("point", "one_to_many")
+WEIGHT_SLOT_KINDS = ("edge_weights", "weights", "edge_ids")
+LENGTH_WEIGHT = "length (m)"
+TRIP_BLOCK = 1024  # trips of an OD cell whose endpoints are drawn from one stream, see `RandomNodesGetter`
+
 
 @dataclass(frozen=True)
 class BatchPaths:
     o_zone: int
     d_zone: int
     count: int
+    start: int = 0  # position of the batch's first trip among trips of its OD cell
 
 
 @dataclass(frozen=True)
 class BatchFixedPaths(BatchPaths):
-    starts_ends: Iterator[tuple[int, int]]
-
+    starts_ends: Iterator[tuple[int, int]] = ()
 
-@dataclass(frozen=True)
-class BuiltPaths:
-    o_zone: int
-    d_zone: int
-    paths: list[TimedPath]
 
-
-def calc_total_paths(trip_mat: np.array = None, old_paths: list[list[list[TimedPath]]] = None) -> int:
+def calc_total_paths(
+    trip_mat: np.ndarray | SparseODMatrix = None, old_paths: PathSet | list[list[list[TimedPath]]] = None
+) -> int:
     if trip_mat is not None:
-        return trip_mat.sum()
+        return int(trip_mat.sum())
+    if isinstance(old_paths, PathSet):
+        return old_paths.n_paths
     total_paths = 0
     for row in old_paths:
         for cell in row:
@@ -58,54 +89,79 @@ def chunked(iterable, n):
     return iterator
 
 
-def yield_batches(trip_mat: np.array, batch_size=1000) -> Generator[list[BatchPaths], None, None]:
-    trip_iter = np.ndenumerate(trip_mat)
+def yield_batches(trip_mat: np.ndarray | SparseODMatrix, batch_size=1000) -> Generator[list[BatchPaths], None, None]:
     lst = []
     cur_cap = batch_size
-    while True:
-        try:
-            (i, j), v = next(trip_iter)
-            remainder = v
-            while remainder:
-                cur_cut = min(cur_cap, remainder)
-                remainder -= cur_cut
-                cur_cap -= cur_cut
-                lst.append(BatchPaths(i, j, int(cur_cut)))
-                if cur_cap == 0:
-                    yield lst
-                    cur_cap = batch_size
-                    lst = []
-        except StopIteration:
-            if lst:
+    for i, j, v in iter_od_cells(trip_mat):
+        remainder = v
+        while remainder:
+            cur_cut = min(cur_cap, remainder)
+            remainder -= cur_cut
+            cur_cap -= cur_cut
+            lst.append(BatchPaths(i, j, int(cur_cut)))
+            if cur_cap == 0:
                 yield lst
-            return
+                cur_cap = batch_size
+                lst = []
+    if lst:
+        yield lst
+
+
+def iter_path_cells(paths: PathSet | list[list[list[TimedPath]]]) -> Iterator[tuple[int, int, list[tuple[int, int]]]]:
+    """Yields ``(i, j, starts_ends)`` per OD cell with path endpoints as OSM node ids."""
+    if isinstance(paths, PathSet):
+        node_ids = paths.node_ids
+        starts = node_ids[paths.nodes[paths.offsets[:-1]]]
+        ends = node_ids[paths.nodes[paths.offsets[1:] - 1]]
+        for i, j, indices in paths.iter_cells():
+            yield i, j, list(zip(starts[indices].tolist(), ends[indices].tolist()))
+        return
+    for i, row in enumerate(paths):
+        for j, cell in enumerate(row):
+            yield i, j, [(x.path[0], x.path[-1]) for x in cell]
 
 
 def yield_starts_ends(
-    paths: list[list[list[TimedPath]]], batch_size=1000
+    paths: PathSet | list[list[list[TimedPath]]], batch_size=1000
 ) -> Generator[list[BatchFixedPaths], None, None]:
     lst = []
     cur_cap = batch_size
-    for i, row in enumerate(paths):
-        for j, cell in enumerate(row):
-            v = len(cell)
-            slice_start = 0
-            remainder = v
-            while remainder:
-                cur_cut = min(cur_cap, remainder)
-                remainder -= cur_cut
-                cur_cap -= cur_cut
-                starts_ends = iter([(x.path[0], x.path[-1]) for x in cell[slice_start : slice_start + cur_cut]])
-                lst.append(BatchFixedPaths(i, j, int(cur_cut), starts_ends))
-                slice_start = cur_cut
-                if cur_cap == 0:
-                    yield lst
-                    cur_cap = batch_size
-                    lst = []
+    for i, j, cell in iter_path_cells(paths):
+        v = len(cell)
+        slice_start = 0
+        remainder = v
+        while remainder:
+            cur_cut = min(cur_cap, remainder)
+            remainder -= cur_cut
+            cur_cap -= cur_cut
+            starts_ends = iter(cell[slice_start : slice_start + cur_cut])
+            lst.append(BatchFixedPaths(i, j, int(cur_cut), slice_start, starts_ends))
+            slice_start += cur_cut
+            if cur_cap == 0:
+                yield lst
+                cur_cap = batch_size
+                lst = []
     if lst:
         yield lst
 
 
+def iter_trip_cells(trip_mat: np.ndarray | SparseODMatrix = None, old_paths=None) -> Iterator[TripCell]:
+    if trip_mat is not None:
+        for i, j, v in iter_od_cells(trip_mat):
+            yield TripCell(i, j, v)
+    elif old_paths is not None:
+        for i, j, starts_ends in iter_path_cells(old_paths):
+            yield TripCell(i, j, len(starts_ends), starts_ends)
+    else:
+        raise ValueError("One of trip_mat, old_paths must be provided")
+
+
+def to_batch(cell: TripCell) -> BatchPaths:
+    if cell.starts_ends is None:
+        return BatchPaths(cell.o_zone, cell.d_zone, cell.count, cell.start)
+    return BatchFixedPaths(cell.o_zone, cell.d_zone, cell.count, cell.start, iter(cell.starts_ends))
+
+
 def validate_weight(graph, weight):
     edge_attrs = next(iter(graph.edges(data=True)))[2]
     if weight not in edge_attrs:
@@ -123,107 +179,725 @@ def get_matrix_size(n=None, trip_mat=None, old_paths=None):
 
 
 class RandomNodesGetter:
-    @staticmethod
-    def filter_nodes(graph: nx.MultiDiGraph, zone_id: str):
-        nodes = [node for node, data in graph.nodes(data=True) if zone_id == str(data["zone"])]
-        return nodes
+    """Draws endpoints uniformly from zone nodes. Yields node indices of the simulation's CSR graph.
+
+    Trips of OD cell ``(i, j)`` are drawn in blocks of `TRIP_BLOCK`, block ``b`` takes origins and destinations from
+    child streams ``(i, j, b, 0)`` and ``(i, j, b, 1)`` of the run seed, at once. Trip ``k`` that has to redraw takes
+    its own stream ``(i, j, b, 2 + k % TRIP_BLOCK)``. So a run seed reproduces the trips however they are split into
+    batches. Without ``seed`` a fresh one is drawn.
+    """
+
+    def __init__(self, zone_index: ZoneIndex, seed: int | None = None) -> None:
+        self.zone_index = zone_index
+        self.seed = np.random.SeedSequence().entropy if seed is None else seed
+
+    def get_rng(self, *spawn_key: int) -> np.random.Generator:
+        return np.random.default_rng(np.random.SeedSequence(self.seed, spawn_key=spawn_key))
+
+    def iter_draws(self, first: tuple[int, int], o_zone: int, d_zone: int, k: int) -> Iterator[tuple[int, int]]:
+        yield first
+        rng = self.get_rng(o_zone, d_zone, k // TRIP_BLOCK, 2 + k % TRIP_BLOCK)
+        while True:
+            yield self.zone_index.sample(str(o_zone), rng), self.zone_index.sample(str(d_zone), rng)
+
+    def iter_trips(self, bp: BatchPaths) -> Iterator[Iterator[tuple[int, int]]]:
+        """Yields endless endpoint draws per trip of the batch, the first routable one makes the trip."""
+        stop = bp.start + bp.count
+        for block_start in range(bp.start - bp.start % TRIP_BLOCK, stop, TRIP_BLOCK):
+            block = block_start // TRIP_BLOCK
+            first, last = max(bp.start, block_start) - block_start, min(stop, block_start + TRIP_BLOCK) - block_start
+            # a shorter draw from the same stream is a prefix of the full block
+            starts, ends = (
+                self.zone_index.sample_many(str(zone), self.get_rng(bp.o_zone, bp.d_zone, block, side), last)[first:]
+                for side, zone in enumerate((bp.o_zone, bp.d_zone))
+            )
+            for k, u, v in zip(range(block_start + first, block_start + last), starts.tolist(), ends.tolist()):
+                yield self.iter_draws((u, v), bp.o_zone, bp.d_zone, k)
 
-    @staticmethod
-    def get_random_node(graph: nx.MultiDiGraph, zone_id: str):
-        return np.random.RandomState().choice(RandomNodesGetter.filter_nodes(graph, zone_id))
 
-    @staticmethod
-    def get_nodes_pair(graph: nx.MultiDiGraph, bp: BatchPaths):
-        u = RandomNodesGetter.get_random_node(graph, str(bp.o_zone))
-        v = RandomNodesGetter.get_random_node(graph, str(bp.d_zone))
-        return u, v
+class FixedNodesGetter:
+    """Replays endpoints of previously built paths. Yields node indices of the simulation's CSR graph."""
 
+    def __init__(self, node_index: dict) -> None:
+        self.node_index = node_index
 
-class FixedNodesGetter:
-    def get_nodes_pair(self, graph: nx.MultiDiGraph, bp: BatchFixedPaths, *args, **kwargs):
-        return next(bp.starts_ends)
+    def iter_trips(self, bp: BatchFixedPaths) -> Iterator[Iterator[tuple[int, int]]]:
+        for u, v in bp.starts_ends:
+            yield iter([(self.node_index[u], self.node_index[v])])
 
 
 class BaseSimulation:
-    def __init__(self, graph: nx.MultiDiGraph, weight: str) -> None:
+    def __init__(
+        self,
+        graph: nx.MultiDiGraph,
+        weight: str,
+        engine: str = "networkx",
+        routing: str = "point",
+        search: str = "dijkstra",
+        hierarchy: ContractionHierarchy | None = None,
+        route_cache: RouteCache | str | None = None,
+    ) -> None:
+        """``route_cache`` is a `RouteCache` or its file, see `get_route_cache_filename`. Routes found by workers are
+        stored there per fingerprint of the graph and current weights, and reused by later batches and runs."""
+        if routing not in ROUTING_MODES:
+            raise ValueError(f"Unknown routing mode '{routing}'. Expected one of {ROUTING_MODES}")
         g = copy.deepcopy(graph)
         validate_weight(g, weight)
         for s, e, edge_data in g.edges(data=True):
             edge_data["passes_count"] = 0
         self.graph = g
+        self.flow = EdgeFlowState.from_networkx(g)
         self.weight = weight
+        self.engine = engine
+        self.routing = routing
+        self.search = search
+        weights = [weight]
+        if search == "astar" and weight != LENGTH_WEIGHT and LENGTH_WEIGHT in next(iter(g.edges(data=True)))[2]:
+            weights.append(LENGTH_WEIGHT)
+        self.csr = CSRGraph.from_networkx(g, weights=weights)
+        if engine == "ch":
+            if hierarchy is None:
+                hierarchy = ContractionHierarchy.build(self.csr, weight)
+            elif not hierarchy.matches(self.csr):
+                raise ValueError("Contraction hierarchy was built for a different graph")
+        self.hierarchy = hierarchy
+        self.route_cache = RouteCache(route_cache) if isinstance(route_cache, str) else route_cache
+        self.update_heuristic_scale()
+        self.router = self.make_router()
+        routable = self.csr.giant_component()
+        if not routable.all():
+            logger.info(
+                "%s of %s nodes are outside the largest strongly connected component, they won't be trip endpoints",
+                (~routable).sum(),
+                len(routable),
+            )
+        self.zone_index = ZoneIndex.from_graph(g, routable)
         self.nodes_getter = None
-
-    def set_nodes_getter(self, trip_mat, old_paths):
+        self.shared = None
+        self.weights_version = 0
+        self.slot_version = None
+        self.searches = 0
+        self.found = 0
+        self.cached = 0
+        self.metrics = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.shared is not None:
+            # workers rebuild these from shared memory blocks
+            state["csr"] = None
+            state["router"] = None
+            state["flow"] = None
+            state["metrics"] = None
+            if self.engine != "networkx":
+                state["graph"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.csr is None:
+            self.csr = CSRGraph.from_arrays(self.shared.arrays)
+            self.router = self.make_router()
+
+    def make_router(self):
+        self.route_fingerprint = None
+        return get_router(
+            self.engine, self.graph, self.csr, self.weight, self.search, self.hierarchy, self.heuristic_scale
+        )
+
+    def update_heuristic_scale(self):
+        """Bounds flow times for A* by free-flow times, which congestion only increases, so that the bound holds for
+        all recalculations and short edges whose flow times are truncated to 0 don't turn A* into Dijkstra. Whole
+        second truncation may still cut a flow time below its free-flow time by less than a second, a path found by A*
+        is then at most that much per edge longer. Other weights are bounded by their current values."""
+        self.heuristic_scale = None
+        if self.search == "astar" and self.weight == FLOW_TIME:
+            free_flow_time = self.flow.travel_time(np.zeros(self.flow.n_edges))
+            self.heuristic_scale = self.csr.heuristic_scale(self.weight, lower_bounds=free_flow_time)
+
+    def set_weight_values(self, values: np.ndarray):
+        """Sets routing weight per edge, in ``graph.edges(keys=True)`` order."""
+        self.csr.set_edge_weight(self.weight, values)
+        if self.engine == "networkx":
+            self._copy_weights_to_graph()
+        self.publish_weights()
+
+    def publish_weights(self):
+        self.router = self.make_router()
+        if self.shared is not None:
+            self.weights_version += 1
+            self.shared.arrays["weights_version"][0] = self.weights_version
+
+    def _copy_weights_to_graph(self):
+        values = self.csr.edge_weights[self.weight].tolist()
+        for (_, _, edge_data), value in zip(self.graph.edges(data=True), values):
+            edge_data[self.weight] = value
+
+    def publish_weight_slot(self, version: int):
+        """Copies current routing weights to the ring buffer slot of ``version``."""
+        slots = self.shared.arrays["slots:weights"]
+        for kind in WEIGHT_SLOT_KINDS:
+            self.shared.arrays[f"slots:{kind}"][version % len(slots)] = getattr(self.csr, kind)[self.weight]
+
+    def get_weight_slot(self, version: int) -> dict[str, np.ndarray]:
+        slot = version % len(self.shared.arrays["slots:weights"])
+        return {kind: self.shared.arrays[f"slots:{kind}"][slot] for kind in WEIGHT_SLOT_KINDS}
+
+    def use_weight_slot(self, version: int):
+        """Switches routing to weights of ``version`` published by the parent process to the ring buffer."""
+        if version == self.slot_version:
+            return
+        for kind, array in self.get_weight_slot(version).items():
+            getattr(self.csr, kind)[self.weight] = array
+        if self.engine == "networkx":
+            self._copy_weights_to_graph()
+        self.router = self.make_router()
+        self.slot_version = version
+
+    def sync_weights(self):
+        """Picks up weights published by the parent process.
+
+        The networkx engine copies them onto its own graph, the ch engine re-customizes its hierarchy on next query.
+        """
+        version = int(self.shared.arrays["weights_version"][0])
+        if version == self.weights_version:
+            return
+        if self.engine == "networkx":
+            self._copy_weights_to_graph()
+        self.router = self.make_router()
+        self.weights_version = version
+
+    @contextmanager
+    def worker_pool(self, max_workers: int, weight_slots: int = 0) -> Generator[ProcessPoolExecutor, None, None]:
+        """Process pool whose workers receive the simulation once and attach to graph arrays in shared memory.
+
+        ``weight_slots`` allocates a ring buffer of routing weights, so that tasks can route on an older version of
+        weights while the parent publishes a new one. Slot 0 holds current weights as version 0.
+        """
+        self.shared = SharedArrays(self.csr.to_arrays())
+        self.shared.add("weights_version", np.array([self.weights_version], dtype=np.int64))
+        if weight_slots:
+            for kind in WEIGHT_SLOT_KINDS:
+                array = getattr(self.csr, kind)[self.weight]
+                self.shared.add(f"slots:{kind}", np.broadcast_to(array, (weight_slots, *array.shape)))
+        self.csr = CSRGraph.from_arrays(self.shared.arrays)
+        self.router = self.make_router()
+        try:
+            with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(self,)) as executor:
+                yield executor
+        finally:
+            self.csr = CSRGraph.from_arrays({k: v.copy() for k, v in self.csr.to_arrays().items()})
+            self.router = self.make_router()
+            shared, self.shared = self.shared, None
+            shared.close()
+
+    def check_trip_mat(self, trip_mat: np.ndarray):
+        """Fails before any routing if some zone pairs of ``trip_mat`` can't get paths.
+
+        :raises ValueError: listing the unroutable zone pairs.
+        """
+        unroutable = self.zone_index.find_unroutable_pairs(trip_mat)
+        if unroutable:
+            shown = ", ".join(f"{i}->{j}" for i, j in unroutable[:20])
+            more = f" and {len(unroutable) - 20} more" if len(unroutable) > 20 else ""
+            raise ValueError(f"No paths possible for {len(unroutable)} zone pairs with trips: {shown}{more}")
+
+    def open_run(
+        self,
+        sink: PathSink,
+        checkpoint_dir: str | None,
+        resume: bool,
+        chunk_size: int,
+        trip_mat,
+        old_paths,
+        n: int,
+        seed: int | None = None,
+    ) -> tuple[SimulationCheckpoint | None, int, int]:
+        """Opens ``sink`` and the checkpoint of a run, returns the checkpoint, chunk size and number of finished chunks.
+
+        Without ``resume`` an existing checkpoint is cleared. When resuming, the flow state is restored and the chunk
+        size of the checkpointed run is kept, so that chunks are split the same way whatever ``max_workers`` is.
+        """
+        no_passes = np.zeros_like(self.flow.passes)
+        if checkpoint_dir is None:
+            if resume:
+                raise ValueError("resume requires checkpoint_dir")
+            sink.open(self.csr.node_ids, n, 0, [], no_passes)
+            return None, chunk_size, 0
+        if isinstance(trip_mat, SparseODMatrix):
+            inputs = (trip_mat.rows, trip_mat.cols, trip_mat.values)
+        elif trip_mat is not None:
+            inputs = (trip_mat,)
+        else:
+            if not isinstance(old_paths, PathSet):
+                old_paths = PathSet.from_nested(old_paths, self.csr.node_index, self.csr.node_ids)
+            inputs = (old_paths.node_ids[old_paths.nodes], old_paths.offsets, old_paths.o_zones, old_paths.d_zones)
+        key = get_input_key(
+            *inputs,
+            self.flow.passes,
+            n=n,
+            weight=self.weight,
+            simulation=type(self).__name__,
+            edges=self.flow.n_edges,
+            seed=seed,
+        )
+        checkpoint = SimulationCheckpoint(checkpoint_dir, key)
+        state = checkpoint.load() if resume else None
+        if state is None:
+            checkpoint.clear()
+            sink.open(self.csr.node_ids, n, 0, [], no_passes)
+            return checkpoint, chunk_size, 0
+        logger.info("Resuming from %s finished chunks in %s", state.n_done, checkpoint_dir)
+        parts = [] if sink.durable else checkpoint.load_paths(state.n_done, self.csr.node_ids, n)
+        sink.open(self.csr.node_ids, n, state.n_done, parts, state.passes - self.flow.passes)
+        self.flow.passes = state.passes.copy()
+        return checkpoint, state.chunk_size, state.n_done
+
+    def save_checkpoint(self, checkpoint: SimulationCheckpoint | None, sink: PathSink, index: int, chunk_size: int):
+        if checkpoint is not None:
+            with self.metrics.timer("checkpoint"):
+                paths = None if sink.durable else sink.get_chunk(index)
+                checkpoint.save(index, paths, self.flow.passes, chunk_size)
+
+    def finish_run(self):
+        with self.metrics.timer("to_graph"):
+            self.graph = self.flow.to_graph(self.graph)
+        self.metrics.finish()
+        logger.info(
+            "Finished in %.1f s: %s paths, %.0f paths/s, worker utilization %.0f%%",
+            self.metrics.wall_seconds,
+            self.metrics.paths,
+            self.metrics.paths_per_second,
+            self.metrics.worker_utilization * 100,
+        )
+
+    def iter_chunks(
+        self,
+        scheduler: BatchScheduler,
+        chunks: list[list[TripCell]],
+        sink: PathSink,
+        lookahead: int | None,
+        first: int = 0,
+        slots: bool = False,
+    ) -> Iterator[tuple[int, np.ndarray]]:
+        """Routes ``chunks`` numbered from ``first``, passes paths of every batch to ``sink`` as soon as it is done and
+        yields ``(index, passes per edge)`` of each chunk, in order, once all its batches are done.
+
+        Batches of chunk ``j`` are only submitted after ``j - lookahead`` chunks were yielded, ``None`` means no limit.
+        With ``lookahead=0`` chunks are separated by a barrier and the scheduler budget shrinks at the end of each.
+        With ``slots`` batches route on weights version ``first + k`` from the ring buffer of `worker_pool`, ``k``
+        being the number of chunks yielded when they were submitted, so the consumer publishes version ``index + 1``
+        before asking for the next chunk. A version must then stay in the buffer for ``lookahead`` more chunks, which
+        holds for ``lookahead + 1`` slots.
+        """
+        if lookahead != 0:
+            scheduler.start([cell for chunk in chunks for cell in chunk])
+        batches = [scheduler.iter_batches(chunk, to_batch) for chunk in chunks]
+        chunk_passes = {}
+        in_flight = [0] * len(chunks)
+        pending = {}
+        current = done = 0
+        started = -1
+
+        def submit():
+            nonlocal current, started
+            while len(pending) < scheduler.max_workers * PREFETCH and current < len(chunks):
+                if lookahead is not None and current > done + lookahead:
+                    return
+                if lookahead == 0 and started < current:
+                    scheduler.start(chunks[current])
+                    started = current
+                item = next(batches[current], None)
+                if item is None:
+                    current += 1
+                    continue
+                batch, cost = item
+                version = first + done if slots else None
+                pending[scheduler.executor.submit(scheduler.fn, batch, version)] = current, version, cost
+                in_flight[current] += 1
+
+        submit()
+        while done < len(chunks):
+            if done < current and not in_flight[done]:
+                yield first + done, chunk_passes.pop(done, np.zeros(self.flow.n_edges, dtype=np.int64))
+                done += 1
+                submit()
+                continue
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                chunk, version, cost = pending.pop(future)
+                result, batch_metrics = future.result()
+                scheduler.update_throughput(cost, batch_metrics.seconds)
+                self.metrics.add_batch(replace(batch_metrics, batch=len(self.metrics.batches), chunk=first + chunk))
+                logger.info(
+                    "Processed batch %s: %s paths in %.2f s",
+                    len(self.metrics.batches),
+                    result.n_paths,
+                    batch_metrics.seconds,
+                )
+                in_flight[chunk] -= 1
+                edge_ids = None if version is None else self.get_weight_slot(version)["edge_ids"]
+                with self.metrics.timer("count_passes"):
+                    passes = self.flow.count_passes(result, self.csr, self.weight, edge_ids)
+                chunk_passes[chunk] = chunk_passes.get(chunk, 0) + passes
+                with self.metrics.timer("sink"):
+                    sink.add(first + chunk, result, passes)
+            submit()
+
+    def set_nodes_getter(self, trip_mat, old_paths, seed=None):
         if trip_mat is not None:
-            self.nodes_getter = RandomNodesGetter()
+            self.nodes_getter = RandomNodesGetter(self.zone_index, seed)
+            logger.info("Drawing trip endpoints with seed %s", self.nodes_getter.seed)
         elif old_paths is not None:
-            self.nodes_getter = FixedNodesGetter()
+            self.nodes_getter = FixedNodesGetter(self.csr.node_index)
         else:
             raise ValueError("One of trip_mat, old_paths must be provided")
 
-    def _build_paths(self, bp: BatchPaths, max_iter: int = 100_000) -> list[TimedPath]:
+    def get_route_fingerprint(self) -> str:
+        if self.route_fingerprint is None:
+            self.route_fingerprint = get_graph_fingerprint(self.csr, self.weight)
+        return self.route_fingerprint
+
+    def route(self, u: int, v: int) -> PathNT | None:
+        """Shortest path from ``u`` to ``v`` for current weights, ``None`` if there is none or it costs nothing."""
+        if self.route_cache is not None:
+            path = self.route_cache.get(self.get_route_fingerprint(), u, v)
+            if path is not None:
+                self.cached += 1
+                return path
+        try:
+            path_cost, path = self.router.shortest_path(u, v)
+        except (nx.NetworkXNoPath, nx.NodeNotFound):
+            return None
+        if not (path and path_cost) or not math.isfinite(path_cost):
+            return None
+        path = PathNT(path, path_cost)
+        if self.route_cache is not None:
+            self.route_cache.put(self.get_route_fingerprint(), u, v, path)
+        return path
+
+    def route_many(self, u: int, targets: set[int]) -> dict[int, PathNT]:
+        """`route` to all ``targets`` with one search for those not in the cache."""
+        built = {}
+        if self.route_cache is not None:
+            fingerprint = self.get_route_fingerprint()
+            for v in targets:
+                path = self.route_cache.get(fingerprint, u, v)
+                if path is not None:
+                    built[v] = path
+            self.cached += len(built)
+        missing = targets - built.keys()
+        if not missing:
+            return built
+        for v, (path_cost, path) in self.router.shortest_paths(u, missing).items():
+            if path and path_cost and math.isfinite(path_cost):
+                built[v] = PathNT(path, path_cost)
+                if self.route_cache is not None:
+                    self.route_cache.put(fingerprint, u, v, built[v])
+        return built
+
+    def _build_paths(self, bp: BatchPaths, max_iter: int = 100_000) -> list[PathNT]:
         paths = []
         i = 0
-        while len(paths) != bp.count:
-            u, v = self.nodes_getter.get_nodes_pair(self.graph, bp)
-
-            try:
-                path_cost, path = nx.single_source_dijkstra(self.graph, u, v, weight=self.weight)
-            except Exception:
-                path = None
-
-            if path and path_cost:
-                paths.append(TimedPath(path, path_cost))
-
-            i += 1
-            if i > max_iter:
-                raise ValueError(f"Failed to find required number {bp.count} of paths..")
+        for draws in self.nodes_getter.iter_trips(bp):
+            for u, v in draws:
+                i += 1
+                if i > max_iter:
+                    raise ValueError(f"Failed to find required number {bp.count} of paths..")
+                path = self.route(u, v)
+                if path is not None:
+                    paths.append(path)
+                    break
+            else:
+                raise ValueError(f"No path between replayed endpoints of a trip from zone {bp.o_zone} to {bp.d_zone}")
         assert len(paths) == bp.count
+        self.searches += i
+        self.found += len(paths)
+        return paths
+
+    def _build_paths_by_origin(self, batches: list[BatchPaths], max_iter: int = 100_000) -> list[list[PathNT]]:
+        """Builds paths for the whole batch with one search per distinct origin node.
+
+        Endpoints are drawn for every trip of the batch, regrouped by origin, and each origin's search stops once all
+        its destinations are settled. Repeated (u, v) draws share one path. Failed draws are redrawn in next rounds.
+        """
+        draws = [list(self.nodes_getter.iter_trips(bp)) for bp in batches]
+        paths = [[None] * bp.count for bp in batches]
+        attempts = [0] * len(batches)
+        missing = [list(range(bp.count)) for bp in batches]
+        while True:
+            requests = defaultdict(list)
+            for k, bp in enumerate(batches):
+                attempts[k] += len(missing[k])
+                self.searches += len(missing[k])
+                if attempts[k] > max_iter:
+                    raise ValueError(f"Failed to find required number {bp.count} of paths..")
+                for trip in missing[k]:
+                    u, v = next(draws[k][trip], (None, None))
+                    if u is None:
+                        raise ValueError(
+                            f"No path between replayed endpoints of a trip from zone {bp.o_zone} to {bp.d_zone}"
+                        )
+                    requests[u].append((k, trip, v))
+            if not requests:
+                break
+            for u, origin_requests in requests.items():
+                built = self.route_many(u, {v for _, _, v in origin_requests})
+                for k, trip, v in origin_requests:
+                    if v in built:
+                        paths[k][trip] = built[v]
+                        self.found += 1
+            missing = [[trip for trip, path in enumerate(batch_paths) if path is None] for batch_paths in paths]
         return paths
 
-    def build_paths(self, batches: list[BatchPaths]) -> list[BuiltPaths]:
-        all_paths = []
-        for batch in batches:
-            paths = self._build_paths(batch)
-            all_paths.append(BuiltPaths(batch.o_zone, batch.d_zone, paths))
-        return all_paths
+    def build_paths(self, batches: list[BatchPaths], version: int | None = None) -> PathSet:
+        """Builds paths of the batches. Nodes are CSR indices, the caller attaches ``node_ids`` when combining.
+
+        ``version`` selects weights from the ring buffer of `worker_pool`, otherwise the latest weights are used.
+        """
+        if version is not None:
+            self.use_weight_slot(version)
+        elif self.shared is not None:
+            self.sync_weights()
+        if self.routing == "one_to_many":
+            all_paths = self._build_paths_by_origin(batches)
+        else:
+            all_paths = [self._build_paths(batch) for batch in batches]
+        if self.route_cache is not None:
+            self.route_cache.flush()
+        return PathSet.from_cells((batch.o_zone, batch.d_zone, paths) for batch, paths in zip(batches, all_paths))
+
+    def measure_build_paths(
+        self, batches: list[BatchPaths], version: int | None = None
+    ) -> tuple[PathSet, BatchMetrics]:
+        """`build_paths` with what it took, batch and chunk numbers are left for the parent to fill in."""
+        searches, found, cached, settled = self.searches, self.found, self.cached, self.router.settled
+        started = time.time()
+        paths, seconds = timed(self.build_paths, batches, version)
+        if settled is not None:
+            settled = self.router.settled - settled
+        metrics = BatchMetrics(
+            -1,
+            -1,
+            os.getpid(),
+            started,
+            seconds,
+            paths.n_paths,
+            self.searches - searches,
+            self.found - found,
+            settled,
+            self.cached - cached,
+        )
+        return paths, metrics
+
+    def get_edge_positions(self, edges: list[tuple[int, int, int]]) -> np.ndarray:
+        """Positions of ``(u, v, key)`` edges in ``graph.edges(keys=True)`` order.
+
+        :raises ValueError: if some of the edges are not in the graph.
+        """
+        positions = {edge: e for e, edge in enumerate(self.graph.edges(keys=True))}
+        missing = [edge for edge in edges if tuple(edge) not in positions]
+        if missing:
+            raise ValueError(f"Edges are not in the graph: {missing[:20]}")
+        return np.array([positions[tuple(edge)] for edge in edges], dtype=np.int64)
+
+    def apply_modifications(self, modifications: list[EdgeModification]) -> np.ndarray:
+        """Applies ``modifications`` to the graph, the flow state and routing weights. Returns positions of modified
+        edges. Closed edges get infinite weight, flow times of changed edges are recalculated for their passes if the
+        simulation recalculates them, otherwise they are free flow times."""
+        edges = self.get_edge_positions([modification.edge for modification in modifications])
+        for e, modification in zip(edges, modifications):
+            if modification.maxspeed is not None:
+                self.flow.maxspeed[e] = modification.maxspeed
+            if modification.capacity is not None:
+                self.flow.capacity[e] = modification.capacity
+        values = self.csr.edge_weights[self.weight].copy()
+        if self.weight == FLOW_TIME:
+            if self.flow.cur_speed is None:
+                values[edges] = self.flow.length_km[edges] / self.flow.maxspeed[edges] * 3600
+            else:
+                speed = speed_decay(self.flow.maxspeed[edges], self.flow.passes[edges], self.flow.capacity[edges])
+                self.flow.cur_speed[edges] = speed
+                values[edges] = np.trunc(self.flow.length_km[edges] / speed * 3600)
+            self.flow.flow_time[edges] = values[edges]
+        values[edges[[modification.closed for modification in modifications]]] = np.inf
+        self.update_heuristic_scale()
+        for e, modification in zip(edges, modifications):
+            edge_data = self.graph.edges[modification.edge]
+            edge_data["maxspeed (km/h)"] = float(self.flow.maxspeed[e])
+            edge_data["capacity (veh/h)"] = float(self.flow.capacity[e])
+            edge_data[self.weight] = float(values[e])
+        self.set_weight_values(values)
+        return edges
+
+    def reroute(
+        self,
+        paths: PathSet,
+        modifications: list[EdgeModification],
+        index: EdgeUsageIndex | None = None,
+        max_workers=None,
+        batch_size=1000,
+        target_seconds=2.0,
+    ) -> tuple[PathSet, nx.MultiDiGraph, EdgeUsageIndex]:
+        """Updates paths of a finished run for edge ``modifications``, rerouting only trips they may affect.
+
+        Trips using an edge that got slower or closed are rerouted, and so are trips that could get cheaper through an
+        improved edge, see `find_detour_candidates`. Passes of rerouted trips are moved from old paths to new ones, other
+        trips keep their paths. ``index`` is the `EdgeUsageIndex` of ``paths``, it is built if not given.
+
+        The simulation must hold the flow state of ``paths``, e.g. be the one that built them, a simulation without
+        passes takes them from ``index``. Flow times aren't recalculated for new passes. Modifications stay applied, so
+        what-ifs can be chained.
+
+        Returns new paths, kept ones first, the graph with updated passes and occupied capacity, and the index of new
+        paths. Trips whose endpoints got disconnected are dropped.
+        """
+        if max_workers is None:
+            max_workers = os.cpu_count()
+        if not isinstance(paths, PathSet):
+            paths = PathSet.from_nested(paths, self.csr.node_index, self.csr.node_ids)
+        if index is None:
+            index = EdgeUsageIndex.from_paths(paths, self.csr, self.weight)
+        elif index.n_paths != paths.n_paths:
+            raise ValueError(f"Edge usage index has {index.n_paths} paths, expected {paths.n_paths}")
+        if not self.flow.passes.any():
+            self.flow.passes = index.count_passes()
+        self.metrics = SimulationMetrics("reroute", max_workers)
+
+        old_values = self.csr.edge_weights[self.weight].copy()
+        edges = self.apply_modifications(modifications)
+        new_values = self.csr.edge_weights[self.weight]
+        selected = np.zeros(paths.n_paths, dtype=bool)
+        selected[index.paths_using(edges[new_values[edges] > old_values[edges]])] = True
+        sources = paths.nodes[paths.offsets[:-1]]
+        targets = paths.nodes[paths.offsets[1:] - 1]
+        rest = np.flatnonzero(~selected)
+        with self.metrics.timer("find_detours"):
+            selected[rest] = find_detour_candidates(
+                self.csr,
+                self.weight,
+                edges[new_values[edges] < old_values[edges]],
+                sources[rest],
+                targets[rest],
+                index.path_costs(new_values)[rest],
+            )
+        kept = np.flatnonzero(~selected)
+        selected = np.flatnonzero(selected)
+        self.flow.passes -= index.count_passes(selected)
+        reachable = find_reachable(self.csr, self.weight, sources[selected], targets[selected])
+        if not reachable.all():
+            logger.warning("Dropping %s trips whose endpoints got disconnected", (~reachable).sum())
+        logger.info("Rerouting %s of %s trips", reachable.sum(), paths.n_paths)
+
+        old_paths = paths.take(selected[reachable])
+        self.set_nodes_getter(None, old_paths)
+        sink = MemorySink()
+        sink.open(self.csr.node_ids, paths.n, 0, [], np.zeros_like(self.flow.passes))
+        cells = list(iter_trip_cells(old_paths=old_paths))
+        if cells:
+            cost_model = ZoneCostModel.from_zone_index(self.zone_index, self.csr.node_coords, paths.n)
+            with self.worker_pool(max_workers) as executor:
+                scheduler = BatchScheduler(
+                    executor, _measured_build_paths_worker, max_workers, cost_model, target_seconds, batch_size
+                )
+                for _, passes in self.iter_chunks(scheduler, [cells], sink, lookahead=None):
+                    self.flow.passes += passes
+        rerouted = sink.result()
+        self.finish_run()
+        new_index = EdgeUsageIndex.concat(
+            [index.take(kept), EdgeUsageIndex.from_paths(rerouted, self.csr, self.weight)]
+        )
+        return PathSet.concat([paths.take(kept), rerouted], paths.node_ids, paths.n), self.graph, new_index
+
+
+_worker_simulation: BaseSimulation | None = None
+
+
+def _init_worker(simulation: BaseSimulation):
+    global _worker_simulation
+    _worker_simulation = simulation
+
+
+def _measured_build_paths_worker(batches: list[BatchPaths], version: int | None = None) -> tuple[PathSet, BatchMetrics]:
+    return _worker_simulation.measure_build_paths(batches, version)
 
 
 class NaiveSimulation(BaseSimulation):
-    def __init__(self, graph: nx.MultiDiGraph, weight: str) -> None:
-        super().__init__(graph, weight)
-        self.nodes_getter = RandomNodesGetter()
-
-    def run(self, trip_mat=None, old_paths=None, n=None, max_workers=None, batch_size=1000):
+    def __init__(
+        self,
+        graph: nx.MultiDiGraph,
+        weight: str,
+        engine: str = "networkx",
+        routing: str = "point",
+        search: str = "dijkstra",
+        hierarchy: ContractionHierarchy | None = None,
+        route_cache: RouteCache | str | None = None,
+    ) -> None:
+        super().__init__(graph, weight, engine, routing, search, hierarchy, route_cache)
+        self.nodes_getter = RandomNodesGetter(self.zone_index)
+
+    def run(
+        self,
+        trip_mat=None,
+        old_paths=None,
+        n=None,
+        max_workers=None,
+        batch_size=1000,
+        target_seconds=2.0,
+        checkpoint_dir=None,
+        resume=False,
+        n_checkpoints=20,
+        sink=None,
+        metrics_file=None,
+        seed=None,
+    ):
+        """Builds paths for all trips. Batches hold up to ``batch_size`` trips and are sized to take about
+        ``target_seconds`` each, see `BatchScheduler`.
+
+        With ``checkpoint_dir`` (see `get_checkpoint_dir`) finished work is saved there ``n_checkpoints`` times during
+        the run, and ``resume=True`` continues from the last checkpoint of a run with the same inputs.
+
+        Paths of finished batches go to ``sink``, `MemorySink` by default, and ``sink.result()`` is returned in place of
+        paths. With `ColumnarFileSink` or `EdgeCountSink` memory doesn't grow with the number of trips.
+
+        Throughput is collected in ``self.metrics``, see `SimulationMetrics`, and appended to ``metrics_file`` as JSON
+        lines if it is given.
+
+        Trip endpoints are drawn from streams derived from ``seed``, so runs with the same seed and inputs draw the same
+        trips. Without it a fresh seed is drawn and logged.
+        """
         if max_workers is None:
             max_workers = os.cpu_count()
+        self.metrics = SimulationMetrics(type(self).__name__, max_workers, metrics_file)
 
         n = get_matrix_size(n, trip_mat, old_paths)
-        self.set_nodes_getter(trip_mat, old_paths)
-
-        if trip_mat is not None:
-            trip_mat = trip_mat[:n, :n]
+        self.set_nodes_getter(trip_mat, old_paths, seed)
+        self.metrics.seed = getattr(self.nodes_getter, "seed", None)
 
         if trip_mat is not None:
-            batches = yield_batches(trip_mat, batch_size=batch_size)
-        if old_paths is not None:
-            batches = yield_starts_ends(old_paths, batch_size=batch_size)
-
-        c = 0
-        mat = [[list() for _ in range(n)] for _ in range(n)]
-        start = time.time()
-        with ProcessPoolExecutor(max_workers=max_workers) as executor:
-            for result in executor.map(self.build_paths, batches):
-                c += 1
-                logger.info("processed batch", c)
-                for built_paths in result:
-                    mat[built_paths.o_zone][built_paths.d_zone].extend(built_paths.paths)
-
-        logger.info("finished in", time.time() - start)
-
-        self.graph = add_passes_count(self.graph, mat)
-        return mat, self.graph
+            trip_mat = crop_trip_mat(trip_mat, n)
+            self.check_trip_mat(trip_mat)
+
+        cells = list(iter_trip_cells(trip_mat, old_paths))
+        total = sum(cell.count for cell in cells)
+        chunk_size = max(1, math.ceil(total / n_checkpoints)) if checkpoint_dir is not None else max(1, total)
+        sink = MemorySink() if sink is None else sink
+        checkpoint, chunk_size, n_done = self.open_run(
+            sink, checkpoint_dir, resume, chunk_size, trip_mat, old_paths, n, seed
+        )
+        chunks = list(islice(split_cells(cells, chunk_size), n_done, None))
+        cost_model = ZoneCostModel.from_zone_index(self.zone_index, self.csr.node_coords, n)
+
+        with self.worker_pool(max_workers) as executor:
+            scheduler = BatchScheduler(
+                executor, _measured_build_paths_worker, max_workers, cost_model, target_seconds, batch_size
+            )
+            for index, passes in self.iter_chunks(scheduler, chunks, sink, lookahead=None, first=n_done):
+                self.flow.passes += passes
+                self.save_checkpoint(checkpoint, sink, index, chunk_size)
+
+        self.finish_run()
+        return sink.result(), self.graph
 
 
 class SmarterSimulation(BaseSimulation):
@@ -231,39 +905,74 @@ class SmarterSimulation(BaseSimulation):
         total_paths = calc_total_paths(trip_mat, old_paths)
         per_iteration = total_paths // n_recalc
         batch_size = per_iteration // max_workers
-        return batch_size
-
-    def run(self, trip_mat=None, old_paths=None, n=None, max_workers=None, n_recalc=20):
+        return max(1, batch_size)
+
+    def run(
+        self,
+        trip_mat=None,
+        old_paths=None,
+        n=None,
+        max_workers=None,
+        n_recalc=20,
+        target_seconds=2.0,
+        staleness=0,
+        checkpoint_dir=None,
+        resume=False,
+        sink=None,
+        metrics_file=None,
+        seed=None,
+    ):
+        """Routes trips in ``n_recalc`` chunks, folding each into the flow state before weights are updated.
+
+        With ``staleness=0`` every chunk waits for the previous one to be folded, so it is routed on weights updated
+        with all previous chunks. With ``staleness=s`` batches of up to ``s`` next chunks are already routing while the
+        parent folds finished chunks, on weights that miss at most ``s`` updates. Workers don't idle at chunk
+        boundaries, the price is that edge flows differ slightly from the barrier mode, see `flow_difference`.
+
+        With ``checkpoint_dir`` (see `get_checkpoint_dir`) every folded chunk is saved there together with the flow
+        state, and ``resume=True`` continues from the last checkpoint of a run with the same inputs. Paths go to ``sink``
+        as in `NaiveSimulation.run`, and so are metrics and ``seed``.
+        """
         if max_workers is None:
             max_workers = os.cpu_count()
+        self.metrics = SimulationMetrics(type(self).__name__, max_workers, metrics_file)
 
         n = get_matrix_size(n, trip_mat, old_paths)
-        self.set_nodes_getter(trip_mat, old_paths)
+        self.set_nodes_getter(trip_mat, old_paths, seed)
+        self.metrics.seed = getattr(self.nodes_getter, "seed", None)
 
         if trip_mat is not None:
-            trip_mat = trip_mat[:n, :n]
+            trip_mat = crop_trip_mat(trip_mat, n)
+            self.check_trip_mat(trip_mat)
 
         batch_size = self.calc_batch_size(trip_mat, old_paths, max_workers, n_recalc)
-
-        if trip_mat is not None:
-            batches = yield_batches(trip_mat, batch_size=batch_size)
-        if old_paths is not None:
-            batches = yield_starts_ends(old_paths, batch_size=batch_size)
-        chunks = chunked(batches, max_workers)
-
-        c = 0
-        mat = [[list() for _ in range(n)] for _ in range(n)]
-        start = time.time()
-        with ProcessPoolExecutor(max_workers=max_workers) as executor:
-            for chunk in chunks:
-                mat_iter = [[list() for _ in range(n)] for _ in range(n)]
-                for result in executor.map(self.build_paths, chunk):
-                    c += 1
-                    logger.info("processed batch", c)
-                    for built_paths in result:
-                        mat[built_paths.o_zone][built_paths.d_zone].extend(built_paths.paths)
-                        mat_iter[built_paths.o_zone][built_paths.d_zone].extend(built_paths.paths)
-                self.graph = recalculate_flow_time(add_passes_count(self.graph, mat_iter))
-                logger.info("Processed chunk...")
-        logger.info("finished in", time.time() - start)
-        return mat, self.graph
+        sink = MemorySink() if sink is None else sink
+        checkpoint, chunk_size, n_done = self.open_run(
+            sink, checkpoint_dir, resume, batch_size * max_workers, trip_mat, old_paths, n, seed
+        )
+        if n_done:
+            self.fold_passes(np.zeros_like(self.flow.passes))
+        chunks = list(islice(split_cells(iter_trip_cells(trip_mat, old_paths), chunk_size), n_done, None))
+        cost_model = ZoneCostModel.from_zone_index(self.zone_index, self.csr.node_coords, n)
+
+        with self.worker_pool(max_workers, weight_slots=staleness + 1 if staleness else 0) as executor:
+            scheduler = BatchScheduler(
+                executor, _measured_build_paths_worker, max_workers, cost_model, target_seconds, batch_size
+            )
+            for index, passes in self.iter_chunks(scheduler, chunks, sink, staleness, n_done, slots=staleness > 0):
+                self.fold_passes(passes)
+                if staleness:
+                    self.publish_weight_slot(index + 1)
+                self.save_checkpoint(checkpoint, sink, index, chunk_size)
+                logger.info("Processed chunk %s of %s", index + 1, n_done + len(chunks))
+        self.finish_run()
+        return sink.result(), self.graph
+
+    def fold_passes(self, passes: np.ndarray):
+        """Adds passes of a finished chunk to the flow state and updates routing weights."""
+        self.flow.passes += passes
+        with self.metrics.timer("recalculate_flow_time"):
+            self.flow.recalculate_flow_time()
+        if self.weight == FLOW_TIME:
+            with self.metrics.timer("set_weights"):
+                self.set_weight_values(self.flow.flow_time)
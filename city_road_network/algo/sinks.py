@@ -0,0 +1,133 @@
+import glob
+import os
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from collections.abc import Iterator
+from pathlib import Path
+
+import numpy as np
+
+from city_road_network.algo.paths import PATH_COLUMNS, PathSet
+
+NODE_IDS_FILENAME = "node_ids.npy"
+
+
+class PathSink(ABC):
+    """Receives paths of a simulation run batch by batch, as batches complete.
+
+    ``chunk`` is the index of the run's chunk a batch belongs to, see `BaseSimulation.iter_chunks`. ``passes`` are the
+    passes per edge of the batch. A durable sink keeps what it received when the process dies, so a resumed run only
+    asks it to drop batches of unfinished chunks, otherwise checkpoints save paths of finished chunks for it.
+    """
+
+    durable = False
+
+    def open(self, node_ids: np.ndarray, n: int, n_done: int, parts: list[PathSet], passes: np.ndarray):
+        """Called before a run. ``n_done`` chunks are already finished, ``parts`` are their paths unless the sink is
+        durable, ``passes`` are their passes per edge."""
+
+    @abstractmethod
+    def add(self, chunk: int, paths: PathSet, passes: np.ndarray):
+        """Called with paths of every finished batch."""
+
+    def result(self):
+        """What ``run()`` returns in place of paths."""
+
+
+class MemorySink(PathSink):
+    """Keeps all paths in memory, ``result()`` is a `PathSet` of all of them in chunk order."""
+
+    def __init__(self) -> None:
+        self.node_ids = None
+        self.n = None
+        self.chunks = defaultdict(list)
+
+    def open(self, node_ids, n, n_done, parts, passes):
+        self.node_ids = node_ids
+        self.n = n
+        self.chunks = defaultdict(list, {index: [part] for index, part in enumerate(parts)})
+
+    def add(self, chunk, paths, passes):
+        self.chunks[chunk].append(paths)
+
+    def get_chunk(self, chunk: int) -> PathSet:
+        return PathSet.concat(self.chunks[chunk], self.node_ids, self.n)
+
+    def result(self) -> PathSet:
+        return PathSet.concat(
+            (part for chunk in sorted(self.chunks) for part in self.chunks[chunk]), self.node_ids, self.n
+        )
+
+
+class ColumnarFileSink(PathSink):
+    """Writes every batch to its own ``.npz`` file of `PathSet` columns in ``directory``, nothing stays in memory.
+
+    ``result()`` is the directory, read it back with `read_paths` or `iter_paths`.
+    """
+
+    durable = True
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self.n = None
+        self.counts = defaultdict(int)
+
+    def get_filename(self, chunk: int, seq: int) -> str:
+        return os.path.join(self.directory, f"part_{chunk:05d}_{seq:06d}.npz")
+
+    def open(self, node_ids, n, n_done, parts, passes):
+        Path(self.directory).mkdir(parents=True, exist_ok=True)
+        self.n = n
+        self.counts = defaultdict(int)
+        for filename in get_part_filenames(self.directory):
+            chunk = int(os.path.basename(filename).split("_")[1])
+            if chunk >= n_done:
+                os.remove(filename)
+            else:
+                self.counts[chunk] += 1
+        np.save(os.path.join(self.directory, NODE_IDS_FILENAME), node_ids)
+
+    def add(self, chunk, paths, passes):
+        filename = self.get_filename(chunk, self.counts[chunk])
+        np.savez(filename, n=self.n, **{name: getattr(paths, name) for name in PATH_COLUMNS})
+        self.counts[chunk] += 1
+
+    def result(self) -> str:
+        return self.directory
+
+
+class EdgeCountSink(PathSink):
+    """Drops paths and only accumulates passes per edge, in ``graph.edges(keys=True)`` order."""
+
+    durable = True
+
+    def __init__(self) -> None:
+        self.passes = None
+
+    def open(self, node_ids, n, n_done, parts, passes):
+        self.passes = passes.copy()
+
+    def add(self, chunk, paths, passes):
+        self.passes += passes
+
+    def result(self) -> np.ndarray:
+        return self.passes
+
+
+def get_part_filenames(directory: str) -> list[str]:
+    return sorted(glob.glob(os.path.join(directory, "part_*.npz")))
+
+
+def iter_paths(directory: str) -> Iterator[PathSet]:
+    """Yields paths written by `ColumnarFileSink` part by part, in chunk order."""
+    node_ids = np.load(os.path.join(directory, NODE_IDS_FILENAME), allow_pickle=False)
+    for filename in get_part_filenames(directory):
+        with np.load(filename) as data:
+            yield PathSet(*(data[name] for name in PATH_COLUMNS), node_ids=node_ids, n=int(data["n"]))
+
+
+def read_paths(directory: str) -> PathSet:
+    parts = list(iter_paths(directory))
+    if not parts:
+        return PathSet.empty(np.load(os.path.join(directory, NODE_IDS_FILENAME)))
+    return PathSet.concat(parts)
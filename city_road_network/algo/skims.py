@@ -0,0 +1,140 @@
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import networkx as nx
+import numpy as np
+from scipy.sparse.csgraph import dijkstra
+
+from city_road_network.algo.assignment import get_csgraph
+from city_road_network.algo.common import ZoneIndex
+from city_road_network.algo.csr import CSRGraph
+from city_road_network.algo.flow import FLOW_TIME
+from city_road_network.algo.route_cache import get_graph_fingerprint
+from city_road_network.algo.shared import SharedArrays
+from city_road_network.algo.simulation import LENGTH_WEIGHT
+from city_road_network.utils.utils import get_logger
+
+logger = get_logger(__name__)
+
+SKIM_WEIGHTS = (FLOW_TIME, LENGTH_WEIGHT)
+
+
+def get_zone_centers(csr: CSRGraph, zone_index: ZoneIndex, n: int) -> np.ndarray:
+    """Representative node of each of zones ``0..n-1``, ``-1`` for zones without nodes.
+
+    It is the node nearest to the mean position of the zone's nodes or, for graphs without coordinates, the node with
+    the most edges. A single node per zone keeps skims between adjacent zones from shrinking to the gap at their border,
+    as a search from all nodes of a zone would.
+    """
+    centers = np.full(n, -1, dtype=np.int32)
+    degrees = np.diff(csr.indptr) + np.bincount(csr.indices, minlength=csr.n_nodes)
+    for zone in range(n):
+        nodes = zone_index.get_nodes(str(zone))
+        if not len(nodes):
+            continue
+        if csr.node_coords is None:
+            centers[zone] = nodes[np.argmax(degrees[nodes])]
+            continue
+        coords = csr.node_coords[nodes]
+        offsets = coords - coords.mean(axis=0)
+        offsets[:, 1] *= np.cos(np.radians(coords[:, 0].mean()))
+        centers[zone] = nodes[np.argmin(np.square(offsets).sum(axis=1))]
+    return centers
+
+
+def calc_skim_rows(csr: CSRGraph, weight: str, centers: np.ndarray, origins: np.ndarray) -> np.ndarray:
+    """Rows ``origins`` of the skim matrix of ``weight``.
+
+    The cell of zones ``i`` and ``j`` is the shortest path cost between their `get_zone_centers`, ``inf`` if either
+    zone has no nodes or no path exists. Trips within a zone cost 0.
+    """
+    graph = get_csgraph(csr, weight)
+    skims = np.full((len(origins), len(centers)), np.inf)
+    sources = centers[origins]
+    rows = np.flatnonzero(sources >= 0)
+    targets = np.flatnonzero(centers >= 0)
+    if len(rows) and len(targets):
+        dist = dijkstra(graph, directed=True, indices=sources[rows])
+        skims[np.ix_(rows, targets)] = dist[:, centers[targets]]
+    return skims
+
+
+_worker_state: tuple[CSRGraph, SharedArrays] | None = None
+
+
+def _init_worker(shared: SharedArrays):
+    global _worker_state
+    _worker_state = CSRGraph.from_arrays(shared.arrays), shared
+
+
+def _skim_rows_worker(origins: np.ndarray) -> dict[str, np.ndarray]:
+    csr, shared = _worker_state
+    centers = shared.arrays["zone_centers"]
+    return {weight: calc_skim_rows(csr, weight, centers, origins) for weight in csr.weights}
+
+
+def get_skims_fingerprint(csr: CSRGraph, centers: np.ndarray) -> str:
+    """Identifies skims of a graph: `get_graph_fingerprint` for every weight and the representative node of every
+    zone."""
+    digest = hashlib.blake2b(digest_size=16)
+    for weight in sorted(csr.weights):
+        digest.update(weight.encode())
+        digest.update(get_graph_fingerprint(csr, weight).encode())
+    digest.update(np.ascontiguousarray(centers).tobytes())
+    return digest.hexdigest()
+
+
+def get_skims_filename(cache_dir: str, fingerprint: str) -> str:
+    return os.path.join(cache_dir, f"skims_{fingerprint}.npz")
+
+
+def calc_skims(
+    graph: nx.MultiDiGraph,
+    n: int,
+    weights=SKIM_WEIGHTS,
+    max_workers: int | None = None,
+    cache_dir: str | None = None,
+) -> dict[str, np.ndarray]:
+    """Zone to zone network costs, an ``n x n`` matrix per weight, e.g. travel time in seconds and distance in meters.
+
+    Every weight is minimised separately, so distances are those of the shortest and not of the fastest paths. Paths run
+    between one node per zone, see `get_zone_centers`, taken from the largest strongly connected component where
+    simulations draw trip endpoints. Origin zones are split between ``max_workers`` processes attached to the graph
+    arrays in shared memory. With ``cache_dir``, e.g. ``get_data_subdir(city_name)``, skims are saved there per
+    fingerprint of the graph and its zones, see `get_skims_fingerprint`, and loaded on later calls.
+    """
+    weights = list(weights)
+    csr = CSRGraph.from_networkx(graph, weights=weights)
+    zone_index = ZoneIndex.from_graph(graph, csr.giant_component())
+    centers = get_zone_centers(csr, zone_index, n)
+
+    filename = None
+    if cache_dir is not None:
+        filename = get_skims_filename(cache_dir, get_skims_fingerprint(csr, centers))
+        if os.path.exists(filename):
+            logger.info("Loading skims from %s", filename)
+            with np.load(filename) as data:
+                return {weight: data[weight] for weight in weights}
+
+    if max_workers is None:
+        max_workers = os.cpu_count()
+    tasks = [chunk for chunk in np.array_split(np.arange(n), max(1, min(n, max_workers * 4))) if len(chunk)]
+    skims = {weight: np.full((n, n), np.inf) for weight in weights}
+    shared = SharedArrays(csr.to_arrays())
+    shared.add("zone_centers", centers)
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(shared,)) as executor:
+            for origins, rows in zip(tasks, executor.map(_skim_rows_worker, tasks)):
+                for weight in weights:
+                    skims[weight][origins] = rows[weight]
+    finally:
+        shared.close()
+    unreachable = ~np.isfinite(skims[weights[0]])
+    if unreachable.any():
+        logger.warning("%s of %s zone pairs are not connected", unreachable.sum(), unreachable.size)
+
+    if filename is not None:
+        np.savez(filename, **skims)
+        logger.info("Saved skims to %s", filename)
+    return skims
@@ -0,0 +1,212 @@
+import math
+import os
+from dataclasses import dataclass
+
+import numpy as np
+
+from city_road_network.algo.metrics import SimulationMetrics
+from city_road_network.algo.paths import PathSet
+from city_road_network.algo.rerouting import EdgeUsageIndex
+from city_road_network.algo.scheduling import (
+    BatchScheduler,
+    TripCell,
+    ZoneCostModel,
+    split_cells,
+)
+from city_road_network.algo.simulation import (
+    BaseSimulation,
+    SmarterSimulation,
+    _measured_build_paths_worker,
+    get_matrix_size,
+)
+from city_road_network.algo.sinks import MemorySink, PathSink
+from city_road_network.utils.utils import get_logger
+
+logger = get_logger(__name__)
+
+
+def split_trip_mat(trip_mat: np.ndarray, profile: np.ndarray) -> list[np.ndarray]:
+    """Splits trips of every OD cell into departure slices with ``profile`` shares, rounding cumulative counts so that
+    slices of a cell add up to its rounded total."""
+    shares = np.asarray(profile, dtype=np.float64)
+    cumulative = np.concatenate(([0.0], np.cumsum(shares / shares.sum())))
+    bounds = np.rint(cumulative[:, None, None] * trip_mat[None]).astype(np.int64)
+    return list(np.diff(bounds, axis=0))
+
+
+def carryover_shares(durations: np.ndarray, slice_seconds: float, n_slices: int) -> np.ndarray:
+    """Expected shares of trips' time falling into each of the ``n_slices`` slices after their departure slice, with
+    departures spread evenly over the slice. Row ``k`` is the ``k + 1``-th next slice, a trip of duration ``d`` reaches
+    ``ceil(d / T)`` of them. Past the end of its departure slice falls ``d / 2T`` of a trip shorter than the slice and
+    ``1 - T / 2d`` of a longer one, e.g. a trip of ``2T`` spends 1/4, 1/2 and 1/4 of its time in its departure slice
+    and the next two."""
+    durations = np.asarray(durations, dtype=np.float64)
+
+    def time_before(bound):
+        # departure time integral of the trip's time spent before ``bound``, over departures in ``[0, T]``
+        def integral(y):
+            y = np.maximum(y, 0)
+            return np.where(y <= durations, y**2 / 2, durations**2 / 2 + durations * (y - durations))
+
+        return integral(bound) - integral(bound - slice_seconds)
+
+    bounds = slice_seconds * np.arange(1, n_slices + 2, dtype=np.float64)[:, None]
+    shares = np.diff(time_before(bounds), axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(durations > 0, shares / (slice_seconds * durations), 0.0)
+
+
+class CarryoverSink(PathSink):
+    """Passes batches on to ``sink`` and accumulates volumes that trips of a time slice carry into each of the next
+    ``horizon`` slices, see `carryover_shares`. ``carried[k]`` is for the ``k + 1``-th next slice, it has rows only up
+    to the longest trip. Trip durations are flow times of their edges when they were routed."""
+
+    def __init__(self, sink: PathSink, simulation: BaseSimulation, slice_seconds: float, horizon: int) -> None:
+        self.sink = sink
+        self.simulation = simulation
+        self.slice_seconds = slice_seconds
+        self.horizon = horizon
+        self.carried = []
+        self.durable = sink.durable
+
+    def add(self, chunk, paths, passes):
+        self.sink.add(chunk, paths, passes)
+        simulation = self.simulation
+        index = EdgeUsageIndex.from_paths(paths, simulation.csr, simulation.weight)
+        durations = index.path_costs(simulation.flow.flow_time)
+        if not len(durations):
+            return
+        n_slices = min(self.horizon, math.ceil(durations.max() / self.slice_seconds))
+        shares = carryover_shares(durations, self.slice_seconds, n_slices)
+        for k in range(n_slices):
+            if k == len(self.carried):
+                self.carried.append(np.zeros(index.n_edges))
+            self.carried[k] += np.bincount(
+                index.path_edges, weights=shares[k][index.path_of_edge], minlength=index.n_edges
+            )
+
+    def get_chunk(self, chunk: int) -> PathSet:
+        return self.sink.get_chunk(chunk)
+
+    def result(self):
+        return self.sink.result()
+
+
+@dataclass(frozen=True)
+class TimeSlice:
+    """State of a departure slice once all its trips are routed. ``volumes`` are its ``passes`` plus volumes carried
+    over from earlier slices."""
+
+    index: int
+    trips: int
+    passes: np.ndarray
+    volumes: np.ndarray
+    cur_speed: np.ndarray
+    flow_time: np.ndarray
+
+
+class TimeSlicedSimulation(SmarterSimulation):
+    """Routes a day of trips in departure slices, e.g. hours.
+
+    Every slice starts from the flows still on the road from earlier ones and is routed like a `SmarterSimulation`
+    run in ``n_recalc`` chunks. All slices share one worker pool and one flow state, capacities are scaled to the slice
+    length. States of slices are kept in ``self.slices``.
+    """
+
+    def run(
+        self,
+        trip_mat,
+        profile,
+        daily_scale=24.0,
+        n=None,
+        max_workers=None,
+        n_recalc=4,
+        target_seconds=2.0,
+        sink=None,
+        metrics_file=None,
+        seed=None,
+    ):
+        """Routes ``trip_mat * daily_scale`` trips departing over a day as given by ``profile``, shares of equal slices
+        of the day, see `get_departure_profile`. ``daily_scale`` is 24 for hourly matrices built from `process_zones`.
+
+        The returned graph has daily passes and their average occupied capacity, ``peak_capacity_occupied`` is that of
+        the busiest slice of every edge, and so are speed and flow time. Paths go to ``sink`` as in `NaiveSimulation.run`,
+        and so are metrics and ``seed``.
+        """
+        if max_workers is None:
+            max_workers = os.cpu_count()
+        self.metrics = SimulationMetrics(type(self).__name__, max_workers, metrics_file)
+        n = get_matrix_size(n, trip_mat)
+        trip_mat = trip_mat[:n, :n]
+        self.check_trip_mat(trip_mat)
+        self.set_nodes_getter(trip_mat, None, seed)
+        self.metrics.seed = self.nodes_getter.seed
+
+        slice_mats = split_trip_mat(trip_mat * daily_scale, profile)
+        slice_seconds = 24 * 3600 / len(slice_mats)
+        total = sum(int(slice_mat.sum()) for slice_mat in slice_mats)
+        batch_size = max(1, total // (len(slice_mats) * n_recalc * max_workers))
+        sink = MemorySink() if sink is None else sink
+        sink.open(self.csr.node_ids, n, 0, [], np.zeros_like(self.flow.passes))
+        cost_model = ZoneCostModel.from_zone_index(self.zone_index, self.csr.node_coords, n)
+
+        capacity = self.flow.capacity
+        self.flow.capacity = capacity * slice_seconds / 3600
+        self.flow.passes = np.zeros(self.flow.n_edges)
+        self.slices = []
+        pending = []  # volumes carried into the next slices
+        drawn = np.zeros(trip_mat.shape, dtype=np.int64)
+        first = 0
+        with self.worker_pool(max_workers) as executor:
+            scheduler = BatchScheduler(
+                executor, _measured_build_paths_worker, max_workers, cost_model, target_seconds, batch_size
+            )
+            for k, slice_mat in enumerate(slice_mats):
+                self.flow.passes[:] = 0
+                self.fold_passes(pending.pop(0) if pending else np.zeros(self.flow.n_edges))
+                rows, cols = np.nonzero(slice_mat)
+                cells = [
+                    TripCell(i, j, v, start=start)
+                    for i, j, v, start in zip(
+                        rows.tolist(), cols.tolist(), slice_mat[rows, cols].tolist(), drawn[rows, cols].tolist()
+                    )
+                ]
+                drawn += slice_mat
+                chunks = list(split_cells(cells, max(1, math.ceil(slice_mat.sum() / n_recalc))))
+                slice_sink = CarryoverSink(sink, self, slice_seconds, len(slice_mats) - k - 1)
+                slice_passes = np.zeros(self.flow.n_edges, dtype=np.int64)
+                for _, passes in self.iter_chunks(scheduler, chunks, slice_sink, lookahead=0, first=first):
+                    slice_passes += passes
+                    self.fold_passes(passes)
+                first += len(chunks)
+                self.slices.append(
+                    TimeSlice(
+                        k,
+                        int(slice_mat.sum()),
+                        slice_passes,
+                        self.flow.passes.copy(),
+                        self.flow.cur_speed,
+                        self.flow.flow_time,
+                    )
+                )
+                for j, carried in enumerate(slice_sink.carried):
+                    if j < len(pending):
+                        pending[j] += carried
+                    else:
+                        pending.append(carried)
+                logger.info("Routed slice %s of %s: %s trips", k + 1, len(slice_mats), self.slices[-1].trips)
+
+        volumes = np.stack([time_slice.volumes for time_slice in self.slices])
+        peak = volumes.argmax(axis=0)
+        edges = np.arange(self.flow.n_edges)
+        self.flow.passes = sum(time_slice.passes for time_slice in self.slices)
+        self.flow.capacity = capacity * 24
+        self.flow.cur_speed = np.stack([time_slice.cur_speed for time_slice in self.slices])[peak, edges]
+        self.flow.flow_time = np.stack([time_slice.flow_time for time_slice in self.slices])[peak, edges]
+        self.finish_run()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            peak_occupied = (volumes[peak, edges] / (capacity * slice_seconds / 3600)).tolist()
+        for e, (_, _, edge_data) in enumerate(self.graph.edges(data=True)):
+            edge_data["peak_capacity_occupied"] = peak_occupied[e]
+        self.flow.capacity = capacity
+        return sink.result(), self.graph
@@ -3,6 +3,7 @@ import zipfile
 from pathlib import Path
 from typing import Literal
 
+import numpy as np
 import pandas as pd
 import requests
 
@@ -11,6 +12,9 @@ from city_road_network.utils.utils import get_cache_subdir, get_logger
 
 logger = get_logger(__name__)
 
+VEHICLE_TRIP_MODES = (3, 4, 5, 6)  # TRPTRANS codes of car, SUV, van and pickup truck trips
+KM_PER_MILE = 1.609344
+
 cache_dir = get_cache_subdir()
 nhts_zip_path = os.path.join(cache_dir, "nhts.zip")
 nhts_path = os.path.join(cache_dir, "nhts")
@@ -54,6 +58,51 @@ def get_nhts_dataset(name: Literal["vehpub.csv", "perpub.csv", "hhpub.csv", "tri
     return df
 
 
+def calc_departure_profile(trips_df: pd.DataFrame, n_slices: int = 24) -> np.ndarray:
+    """Shares of private vehicle trips departing in each of ``n_slices`` equal slices of a day.
+
+    :param trips_df: NHTS trips, ``trippub.csv``. Departure time ``STRTTIME`` is ``HHMM``, trips are weighted by
+        ``WTTRDFIN``.
+    :type trips_df: pd.DataFrame
+    :param n_slices: Number of slices, 24 for hours.
+    :type n_slices: int
+    :return: Shares of trips per slice summing up to 1.
+    :rtype: np.ndarray
+    """
+    df = trips_df[(trips_df["STRTTIME"] >= 0) & trips_df["TRPTRANS"].isin(VEHICLE_TRIP_MODES)]
+    minutes = df["STRTTIME"].to_numpy() // 100 * 60 + df["STRTTIME"].to_numpy() % 100
+    slices = np.clip(minutes * n_slices // (24 * 60), 0, n_slices - 1)
+    shares = np.bincount(slices, weights=df["WTTRDFIN"].to_numpy(), minlength=n_slices)
+    return shares / shares.sum()
+
+
+def get_departure_profile(n_slices: int = 24) -> np.ndarray:
+    """Departure profile of NHTS private vehicle trips, see `calc_departure_profile`. Downloads data if not present
+    in cache."""
+    return calc_departure_profile(get_nhts_dataset("trippub.csv"), n_slices)
+
+
+def calc_trip_length_distribution(trips_df: pd.DataFrame, bins_km) -> np.ndarray:
+    """Shares of private vehicle trips by length in bins ``[bins_km[k], bins_km[k + 1])``.
+
+    :param trips_df: NHTS trips, ``trippub.csv``. Trip length ``TRPMILES`` is in miles, trips are weighted by
+        ``WTTRDFIN``.
+    :type trips_df: pd.DataFrame
+    :param bins_km: Bin edges in km, e.g. `city_road_network.algo.calibration.DEFAULT_TLD_BINS_KM`.
+    :return: Shares of trips per bin summing up to 1.
+    :rtype: np.ndarray
+    """
+    df = trips_df[(trips_df["TRPMILES"] >= 0) & trips_df["TRPTRANS"].isin(VEHICLE_TRIP_MODES)]
+    counts, _ = np.histogram(df["TRPMILES"].to_numpy() * KM_PER_MILE, bins=bins_km, weights=df["WTTRDFIN"].to_numpy())
+    return counts / counts.sum()
+
+
+def get_trip_length_distribution(bins_km) -> np.ndarray:
+    """Trip length distribution of NHTS private vehicle trips, see `calc_trip_length_distribution`. Downloads data if
+    not present in cache."""
+    return calc_trip_length_distribution(get_nhts_dataset("trippub.csv"), bins_km)
+
+
 def transform_russtat_data(df: pd.DataFrame) -> pd.DataFrame:
     """Transforms XLSX file describing average household size in Russia to appropriate form.
 
@@ -26,6 +26,7 @@ wgs = "EPSG:4326"
 
 wgs_to_mollweide = Transformer.from_crs(wgs, mollweide)
 mollweide_to_wgs = Transformer.from_crs(mollweide, wgs)
+wgs84_geod = Geod(ellps="WGS84")
 
 
 def convert_coordinates(x: float, y: float, *, to_wgs=True):
@@ -130,7 +131,6 @@ def get_max_speed(possible_speed):
 
 
 def get_distance(u, v):  # km
-    wgs84_geod = Geod(ellps="WGS84")
     p1 = float(u.get("lon")), float(u.get("lat"))
     p2 = float(v.get("lon")), float(v.get("lat"))
     _, _, dist = wgs84_geod.inv(*p1, *p2)
@@ -13,6 +13,11 @@ from shapely import Polygon
 from shapely.ops import transform
 from shapely.wkt import loads
 
+from city_road_network.algo.od_matrix import (
+    SparseODMatrix,
+    iter_od_cells,
+    load_trip_mat,
+)
 from city_road_network.config import known_highways, timeout
 from city_road_network.downloaders.osm import _get_poly_coord_str
 from city_road_network.processing.data_correction import get_speed, guess_lanes
@@ -140,8 +145,13 @@ def save_zones(city_name: str | None = None):
         f.write(etree.tostring(tree, pretty_print=True, xml_declaration=True, encoding="UTF-8"))
 
 
-def save_od_matrix(city_name: str | None = None, divider: float | None = None):
-    """Saves OD-matrix in format that SUMO expects"""
+def save_od_matrix(
+    city_name: str | None = None, divider: float | None = None, trip_mat: np.ndarray | SparseODMatrix | None = None
+):
+    """Saves OD-matrix in format that SUMO expects. Cells without trips are left out.
+
+    ``trip_mat`` is dense or sparse, by default it is loaded from the city's data directory, see `load_trip_mat`.
+    """
     od_head = """$O;D2
 * From-Time\tTo-Time
 0.00\t1.00
@@ -150,15 +160,14 @@ def save_od_matrix(city_name: str | None = None, divider: float | None = None):
     """
     data_dir = get_data_subdir(city_name)
     sumo_dir = get_sumo_subdir(city_name)
-    trip_mat = np.load(os.path.join(data_dir, "trip_mat.npy"))
+    if trip_mat is None:
+        trip_mat = load_trip_mat(data_dir)
     with open(os.path.join(sumo_dir, OD_FILE_NAME), "w") as f:
         f.write(od_head)
-        for i in range(trip_mat.shape[0]):
-            for j in range(trip_mat.shape[0]):
-                value = int(trip_mat[i, j])
-                if divider:
-                    value = value // divider
-                f.write(f"\t\t{i}\t{j}\t{value}\n")
+        for i, j, value in iter_od_cells(trip_mat):
+            if divider:
+                value = value // divider
+            f.write(f"\t\t{i}\t{j}\t{value}\n")
 
 
 def create_config(city_name: str | None = None, include_zones=True, include_trips=True):
@@ -1,17 +1,85 @@
+import glob
+import json
 import os
 import pickle
+from concurrent.futures import ThreadPoolExecutor
 
 import geopandas as gpd
+import networkx as nx
 import numpy as np
 import pandas as pd
-from shapely import wkt
+import pytest
+from shapely import Point, wkt
 
-from city_road_network.algo.gravity_model import run_gravity_model
+from city_road_network.algo import assignment
+from city_road_network.algo.assignment import (
+    all_or_nothing,
+    get_sources_chunk,
+    zone_all_or_nothing,
+)
+from city_road_network.algo.calibration import (
+    DETERRENCE_FAMILIES,
+    calibrate_gravity_model,
+    model_trip_length_distribution,
+)
+from city_road_network.algo.ch import ContractionHierarchy
+from city_road_network.algo.checkpoint import SimulationCheckpoint
+from city_road_network.algo.common import (
+    PathNT,
+    ZoneIndex,
+    add_passes_count,
+    filter_nodes,
+    recalculate_flow_time,
+)
+from city_road_network.algo.csr import CSRGraph
+from city_road_network.algo.flow import EdgeFlowState, FlowDifference, flow_difference
+from city_road_network.algo.gravity_model import (
+    balance_trip_mat,
+    calc_distance_mat,
+    calc_friction_mat,
+    calc_sparse_friction_mat,
+    run_gravity_model,
+    run_sparse_gravity_model,
+)
+from city_road_network.algo.loading import AllOrNothingLoading, FrankWolfeAssignment
+from city_road_network.algo.metrics import SimulationMetrics
+from city_road_network.algo.od_matrix import SparseODMatrix, load_trip_mat
+from city_road_network.algo.paths import PathSet
+from city_road_network.algo.rerouting import EdgeModification, EdgeUsageIndex
+from city_road_network.algo.route_cache import RouteCache
+from city_road_network.algo.routing import get_router
+from city_road_network.algo.scenarios import Scenario, ScenarioRunner
+from city_road_network.algo.scheduling import (
+    BatchScheduler,
+    TripCell,
+    ZoneCostModel,
+    split_cells,
+)
+from city_road_network.algo.shared import SharedArrays
 from city_road_network.algo.simulation import (
     BatchPaths,
+    NaiveSimulation,
+    RandomNodesGetter,
+    SmarterSimulation,
+    iter_trip_cells,
+    to_batch,
     yield_batches,
     yield_starts_ends,
 )
+from city_road_network.algo.sinks import (
+    ColumnarFileSink,
+    EdgeCountSink,
+    MemorySink,
+    iter_paths,
+    read_paths,
+)
+from city_road_network.algo.skims import calc_skims, get_zone_centers
+from city_road_network.algo.time_sliced import (
+    TimeSlicedSimulation,
+    carryover_shares,
+    split_trip_mat,
+)
+from city_road_network.utils.utils import get_distance
 
 
 def test_gravity_model():
@@ -43,6 +111,109 @@ def test_gravity_model():
         ]
     )
     assert np.array_equal(result, expected)
+    assert np.array_equal(run_sparse_gravity_model(gdf, block_size=2).to_dense(), expected)
+    assert np.array_equal(run_gravity_model(gdf, furness=True), expected)
+    assert np.array_equal(run_sparse_gravity_model(gdf, furness=True).to_dense(), expected)
+
+
+def make_random_zones(seed, n=30):
+    rng = np.random.default_rng(seed)
+    points = [Point(30 + x * 0.3, 59.8 + y * 0.2) for x, y in rng.random((n, 2))]
+    production = rng.integers(50, 500, n)
+    return gpd.GeoDataFrame(
+        {"production": production, "poi_attraction": rng.permutation(production), "centroid": points}
+    )
+
+
+def test_gravity_model_baseline():
+    # trips of the original looped implementation for make_random_zones(0..14)
+    expected = np.load(os.path.join("tests", "data", "gravity_model_baseline.npy"))
+    for seed, expected_trips in enumerate(expected):
+        gdf = make_random_zones(seed)
+        assert np.array_equal(run_gravity_model(gdf), expected_trips)
+        assert np.array_equal(run_sparse_gravity_model(gdf, block_size=7).to_dense(), expected_trips)
+        assert np.abs(run_gravity_model(gdf, furness=True) - expected_trips).max() <= 1
+
+
+def test_gravity_model_matrices():
+    rng = np.random.default_rng(0)
+    points = [Point(30 + rng.random() * 0.3, 59.8 + rng.random() * 0.2) for _ in range(12)]
+    gdf = gpd.GeoDataFrame({"centroid": points})
+    distance_mat = calc_distance_mat(gdf)
+    for i, u in enumerate(points):
+        for j, v in enumerate(points):
+            assert distance_mat[i, j] == get_distance({"lat": u.y, "lon": u.x}, {"lat": v.y, "lon": v.x})
+    friction_mat = calc_friction_mat(distance_mat)
+    assert np.all(np.diag(friction_mat) == 0)
+    d = distance_mat[0, 1]
+    assert friction_mat[0, 1] == pytest.approx(28507 * d**-0.02 * np.exp(-0.123 * d), rel=1e-12)
+    cutoff = float(np.median(distance_mat))
+    friction_mat[distance_mat > cutoff] = 0
+    sparse = calc_sparse_friction_mat(gdf, cutoff_km=cutoff, block_size=5)
+    assert np.array_equal(sparse.to_dense(), friction_mat.astype(np.float32))
+    assert sparse.nnz == np.count_nonzero(friction_mat)
+
+
+def test_balance_trip_mat():
+    rng = np.random.default_rng(1)
+    xy = rng.random((60, 2)) * [150, 30]
+    f_mat = np.exp(-0.5 * np.hypot(*(xy[:, np.newaxis] - xy[np.newaxis, :]).transpose(2, 0, 1)))
+    np.fill_diagonal(f_mat, 0)
+    prod = rng.integers(10, 1000, 60).astype(float)
+    attr = rng.random(60) ** 3
+    attr *= prod.sum() / attr.sum()
+
+    result = balance_trip_mat(f_mat, prod, attr, max_iter=5000, eps=1e-6)
+    assert result.converged
+    assert len(result.prod_errors) == len(result.attr_errors) == result.iterations
+    assert result.prod_errors[-1] < 1e-6 and result.attr_errors[-1] < 1e-6
+    assert np.allclose(result.trip_mat.sum(axis=1), prod, atol=1e-2)
+    assert np.allclose(result.trip_mat.sum(axis=0), attr, atol=1e-2)
+    assert np.allclose(result.trip_mat, result.row_factors[:, None] * f_mat * result.col_factors[None, :])
+
+    accelerated = balance_trip_mat(f_mat, prod, attr, max_iter=5000, eps=1e-6, omega=1.5)
+    assert accelerated.converged and accelerated.iterations < result.iterations
+    assert np.allclose(accelerated.trip_mat, result.trip_mat, atol=1e-2)
+
+    sparse = balance_trip_mat(SparseODMatrix.from_dense(f_mat), prod, attr, max_iter=5000, eps=1e-6)
+    assert sparse.converged
+    assert np.allclose(sparse.trip_mat.to_dense(), result.trip_mat, rtol=1e-4, atol=1e-3)
+
+    prod[:3] *= 1.1
+    attr *= prod.sum() / attr.sum()
+    cold = balance_trip_mat(f_mat, prod, attr, max_iter=5000, eps=1e-6)
+    warm = balance_trip_mat(f_mat, prod, attr, max_iter=5000, eps=1e-6, col_factors=result.col_factors)
+    assert warm.converged and warm.iterations < cold.iterations
+    assert np.allclose(warm.trip_mat, cold.trip_mat, atol=1e-2)
+
+    stopped = balance_trip_mat(f_mat, prod, attr, max_iter=3, eps=1e-6)
+    assert not stopped.converged and stopped.iterations == 3
+
+
+def test_calibrate_gravity_model():
+    rng = np.random.default_rng(0)
+    xy = rng.random((150, 2)) * 40
+    distance_mat = np.hypot(*(xy[:, np.newaxis] - xy[np.newaxis, :]).transpose(2, 0, 1))
+    prod = rng.integers(10, 1000, 150).astype(float)
+    attr = rng.random(150)
+    attr *= prod.sum() / attr.sum()
+    friction_mat = DETERRENCE_FAMILIES["combined"](distance_mat, -0.5, -0.2)
+    target = model_trip_length_distribution(balance_trip_mat(friction_mat, prod, attr).trip_mat, distance_mat)
+
+    result = calibrate_gravity_model(distance_mat, prod, attr, target)
+    assert result.converged
+    assert result.params["b"] == pytest.approx(-0.5, abs=1e-2)
+    assert result.params["c"] == pytest.approx(-0.2, abs=1e-2)
+    assert result.error < 1e-8
+    assert np.allclose(result.shares, target, atol=1e-4)
+    assert np.allclose(result.friction_mat(distance_mat), friction_mat, rtol=0.1)
+
+    exponential = calibrate_gravity_model(distance_mat, prod, attr, target, family="exponential")
+    assert exponential.converged and list(exponential.params) == ["c"]
+    assert result.error < exponential.error == np.square(exponential.shares - target).sum()
+
+    with pytest.raises(ValueError):
+        calibrate_gravity_model(distance_mat, prod, attr, target[:-1])
 
 
 expected_batches = [
@@ -141,6 +312,7 @@ def test_yield_batches():
             assert b.o_zone == exp.o_zone
             assert b.d_zone == exp.d_zone
             assert b.count == exp.count
+    assert list(yield_batches(SparseODMatrix.from_dense(trip_mat), batch_size)) == expected_batches
 
 
 def test_yield_starts_ends():
@@ -158,3 +330,692 @@ def test_yield_starts_ends():
             assert b.o_zone == exp.o_zone
             assert b.d_zone == exp.d_zone
             assert b.count == exp.count
+
+
+def make_grid_graph(size=6, seed=42):
+    """Builds a small road graph with the same node and edge attributes as `read_graph` produces."""
+    rng = np.random.default_rng(seed)
+    graph = nx.MultiDiGraph(crs="epsg:4326")
+    for i in range(size):
+        for j in range(size):
+            zone = (i // (size // 2)) * 2 + j // (size // 2)
+            graph.add_node(1000 + i * size + j, lat=60 + i * 0.005, lon=30 + j * 0.01, zone=zone)
+    for i in range(size):
+        for j in range(size):
+            for di, dj in ((0, 1), (1, 0), (0, -1), (-1, 0)):
+                if not (0 <= i + di < size and 0 <= j + dj < size):
+                    continue
+                length = 560.0 if di else 560.0 * (1 + rng.random())
+                maxspeed = float(rng.choice([20, 40, 60]))
+                graph.add_edge(
+                    1000 + i * size + j,
+                    1000 + (i + di) * size + j + dj,
+                    **{
+                        "length (m)": length,
+                        "length (km)": length / 1000,
+                        "maxspeed (km/h)": maxspeed,
+                        "capacity (veh/h)": 1800,
+                        "flow_time (s)": length / 1000 / maxspeed * 3600,
+                    },
+                )
+    slow_duplicate = dict(graph[1000][1001][0])
+    slow_duplicate["flow_time (s)"] *= 2
+    graph.add_edge(1000, 1001, **slow_duplicate)
+    return graph
+
+
+def test_skims(tmp_path):
+    graph = make_grid_graph()
+    csr = CSRGraph.from_networkx(graph)
+    centers = get_zone_centers(csr, ZoneIndex.from_graph(graph), 5)
+    assert csr.node_ids[centers[:4]].tolist() == [1007, 1010, 1025, 1028] and centers[4] == -1
+    csr.node_coords = None
+    assert csr.node_ids[get_zone_centers(csr, ZoneIndex.from_graph(graph), 4)].tolist() == [1007, 1009, 1019, 1021]
+
+    skims = calc_skims(graph, 5, max_workers=2, cache_dir=str(tmp_path))
+    for weight, skim in skims.items():
+        assert skim.shape == (5, 5)
+        assert np.isinf(skim[4]).all() and np.isinf(skim[:, 4]).all()
+        for i in range(4):
+            dist = nx.single_source_dijkstra_path_length(graph, csr.node_ids[centers[i]], weight=weight)
+            for j in range(4):
+                assert skim[i, j] == pytest.approx(dist[csr.node_ids[centers[j]]])
+        assert np.all(np.diag(skim)[:4] == 0)
+    assert len(os.listdir(tmp_path)) == 1
+    cached = calc_skims(graph, 5, cache_dir=str(tmp_path))
+    assert all(np.array_equal(cached[weight], skims[weight]) for weight in skims)
+
+    graph.edges[1000, 1001, 0]["flow_time (s)"] *= 10
+    calc_skims(graph, 5, max_workers=1, cache_dir=str(tmp_path))
+    assert len(os.listdir(tmp_path)) == 2
+
+    gdf = gpd.GeoDataFrame(
+        {"production": [100, 200, 300, 400], "poi_attraction": [250, 250, 250, 250], "centroid": [Point(30, 60)] * 4}
+    )
+    trip_mat = run_gravity_model(gdf, impedance_mat=skims["length (m)"][:4, :4] / 1000)
+    assert np.abs(trip_mat.sum(axis=1) - gdf["production"]).max() <= 2
+    assert np.all(np.diag(trip_mat) == 0)
+
+
+def test_csr_dijkstra_matches_networkx():
+    graph = make_grid_graph()
+    csr = CSRGraph.from_networkx(graph, weights=["flow_time (s)", "length (m)"])
+    assert csr.n_nodes == graph.number_of_nodes()
+    assert csr.n_edges == graph.number_of_edges()
+    assert len(csr.indices) == csr.n_edges - 1
+
+    for weight in ("flow_time (s)", "length (m)"):
+        for u, v in [(1000, 1035), (1007, 1030), (1035, 1000), (1001, 1001)]:
+            expected_cost, _ = nx.single_source_dijkstra(graph, u, v, weight=weight)
+            cost, path = csr.dijkstra(csr.node_index[u], csr.node_index[v], weight)
+            ids = csr.path_to_ids(path)
+            assert abs(cost - expected_cost) < 1e-9
+            assert ids[0] == u and ids[-1] == v
+            assert abs(nx.path_weight(graph, ids, weight) - cost) < 1e-9
+
+
+def test_shared_csr_arrays():
+    csr = CSRGraph.from_networkx(make_grid_graph(), weights=["flow_time (s)"])
+    shared = SharedArrays(csr.to_arrays())
+    attached = pickle.loads(pickle.dumps(shared))
+    try:
+        shared_csr = CSRGraph.from_arrays(shared.arrays)
+        attached_csr = CSRGraph.from_arrays(attached.arrays)
+        assert np.array_equal(attached_csr.indices, csr.indices)
+        assert attached_csr.dijkstra(0, 35, "flow_time (s)") == csr.dijkstra(0, 35, "flow_time (s)")
+
+        shared_csr.set_edge_weight("flow_time (s)", csr.edge_weights["flow_time (s)"] * 2)
+        assert np.array_equal(attached_csr.weights["flow_time (s)"], csr.weights["flow_time (s)"] * 2)
+    finally:
+        del shared_csr, attached_csr
+        attached.close()
+        shared.close()
+
+
+def test_zone_index():
+    graph = make_grid_graph()
+    zone_index = ZoneIndex.from_graph(graph)
+    rng = np.random.default_rng(0)
+    for zone in ("0", "1", "2", "3"):
+        nodes = zone_index.node_ids[zone_index.get_nodes(zone)]
+        assert sorted(nodes.tolist()) == sorted(filter_nodes(graph, zone))
+        for _ in range(20):
+            assert zone_index.node_ids[zone_index.sample(zone, rng)] in nodes
+    assert len(zone_index.get_nodes("missing")) == 0
+
+
+def test_one_to_many_routing():
+    graph = make_grid_graph()
+    csr = CSRGraph.from_networkx(graph, weights=["flow_time (s)"])
+    found = csr.dijkstra_many(0, [35, 7, 7, 0], "flow_time (s)")
+    for target in (35, 7):
+        assert found[target] == csr.dijkstra(0, target, "flow_time (s)")
+    assert found[0] == (0.0, [0])
+    router = get_router("networkx", graph, csr, "flow_time (s)")
+    networkx_found = router.shortest_paths(0, iter([35, 7, 7, 0]))
+    assert networkx_found.keys() == found.keys()
+    for target, (cost, path) in networkx_found.items():
+        assert abs(cost - found[target][0]) < 1e-9
+        assert path[0] == 0 and path[-1] == target
+        assert abs(nx.path_weight(graph, csr.path_to_ids(path), "flow_time (s)") - cost) < 1e-9
+
+    batches = [BatchPaths(0, 3, 15), BatchPaths(0, 0, 4), BatchPaths(2, 1, 6)]
+    for engine in ("networkx", "csr"):
+        for routing in ("point", "one_to_many"):
+            sim = NaiveSimulation(graph, "flow_time (s)", engine=engine, routing=routing)
+            paths = PathSet.concat([sim.build_paths(batches)], sim.csr.node_ids, n=4)
+            for batch in batches:
+                cell = paths[batch.o_zone][batch.d_zone]
+                assert len(cell) == batch.count
+                for timed_path in cell:
+                    assert timed_path.travel_time > 0
+                    assert abs(nx.path_weight(graph, timed_path.path, "flow_time (s)") - timed_path.travel_time) < 1e-9
+
+
+def test_goal_directed_search_matches_dijkstra():
+    graph = make_grid_graph(size=10)
+    csr = CSRGraph.from_networkx(graph, weights=["flow_time (s)", "length (m)"])
+    rng = np.random.default_rng(1)
+    for weight in ("flow_time (s)", "length (m)"):
+        scale = csr.heuristic_scale(weight)
+        assert scale > 0
+        for u, v in rng.integers(csr.n_nodes, size=(50, 2)):
+            expected_cost, _ = csr.dijkstra(u, v, weight)
+            for cost, path in (csr.astar(u, v, weight, scale), csr.bidirectional_dijkstra(u, v, weight)):
+                assert abs(cost - expected_cost) < 1e-6
+                assert path[0] == u and path[-1] == v
+                assert abs(nx.path_weight(graph, csr.path_to_ids(path), weight) - cost) < 1e-6
+
+    batches = [BatchPaths(0, 3, 10), BatchPaths(3, 0, 10)]
+    for engine in ("networkx", "csr"):
+        for search in ("astar", "bidirectional"):
+            sim = NaiveSimulation(graph, "flow_time (s)", engine=engine, search=search)
+            paths = sim.build_paths(batches)
+            assert paths.n_paths == 20
+            for k in range(paths.n_paths):
+                path = paths.path(k)
+                expected_cost = csr.dijkstra(path[0], path[-1], "flow_time (s)")[0]
+                assert abs(paths.travel_times[k] - expected_cost) < 1e-6
+
+
+def test_astar_with_zero_flow_times(monkeypatch):
+    graph = make_grid_graph(size=10)
+    graph.add_node(2000, lat=60.00004, lon=30.00004, zone=0)
+    for u, v in ((1000, 2000), (2000, 1000)):
+        graph.add_edge(u, v, **{**graph.edges[1000, 1001, 0], "length (m)": 5.0, "length (km)": 0.005})
+    for _, _, edge_data in graph.edges(data=True):
+        edge_data["flow_time (s)"] = float(np.trunc(edge_data["length (km)"] / edge_data["maxspeed (km/h)"] * 3600))
+    warnings = []
+    monkeypatch.setattr("city_road_network.algo.csr.logger.warning", lambda *args: warnings.append(args))
+    csr = CSRGraph.from_networkx(graph, weights=["flow_time (s)", "length (m)"])
+    assert csr.heuristic_scale("flow_time (s)") == 0.0
+    assert len(warnings) == 1
+
+    sim = NaiveSimulation(graph, "flow_time (s)", engine="csr", search="astar")
+    assert sim.router.scale > 0
+    rng = np.random.default_rng(3)
+    for u, v in rng.integers(csr.n_nodes, size=(50, 2)):
+        expected_cost, _ = csr.dijkstra(u, v, "flow_time (s)")
+        cost, path = sim.router.shortest_path(u, v)
+        assert expected_cost <= cost <= expected_cost + len(path) - 1
+        assert abs(nx.path_weight(graph, csr.path_to_ids(path), "flow_time (s)") - cost) < 1e-6
+
+
+def test_contraction_hierarchy(tmp_path):
+    graph = make_grid_graph(size=8)
+    csr = CSRGraph.from_networkx(graph, weights=["flow_time (s)"])
+    graph_weights = csr.edge_weights["flow_time (s)"].copy()
+    hierarchy = ContractionHierarchy.build(csr, "flow_time (s)")
+    filename = os.path.join(tmp_path, "ch.npz")
+    hierarchy.save(filename)
+    loaded = ContractionHierarchy.load(filename)
+    assert np.array_equal(loaded.rank, hierarchy.rank)
+
+    rng = np.random.default_rng(2)
+    pairs = rng.integers(csr.n_nodes, size=(40, 2))
+    for ch in (hierarchy, loaded):
+        for u, v in pairs:
+            cost, path = ch.query(u, v)
+            assert abs(cost - csr.dijkstra(u, v, "flow_time (s)")[0]) < 1e-6
+            assert path[0] == u and path[-1] == v
+            assert abs(nx.path_weight(graph, csr.path_to_ids(path), "flow_time (s)") - cost) < 1e-6
+
+    shortcuts = loaded.forward[1].copy()
+    for scale in (rng.uniform(1, 3, size=csr.n_edges), rng.uniform(0.1, 10, size=csr.n_edges)):
+        csr.set_edge_weight("flow_time (s)", graph_weights * scale)
+        loaded.customize(csr.weights["flow_time (s)"])
+        assert np.array_equal(loaded.rank, hierarchy.rank) and np.array_equal(loaded.forward[1], shortcuts)
+        for u, v in pairs:
+            cost, path = loaded.query(u, v)
+            assert abs(cost - csr.dijkstra(u, v, "flow_time (s)")[0]) < 1e-6
+            assert path[0] == u and path[-1] == v
+
+    other = make_grid_graph(size=8)
+    other.remove_edge(1000, 1001, key=1)
+    other.remove_edge(1010, 1011)
+    with pytest.raises(ValueError):
+        NaiveSimulation(other, "flow_time (s)", engine="ch", hierarchy=hierarchy)
+    with pytest.raises(ValueError):
+        NaiveSimulation(graph, "flow_time (s)", engine="ch", search="astar", hierarchy=hierarchy)
+
+    sim = NaiveSimulation(graph, "flow_time (s)", engine="ch", hierarchy=hierarchy)
+    paths = PathSet.concat([sim.build_paths([BatchPaths(1, 2, 10)])], sim.csr.node_ids)
+    for timed_path in paths[1][2]:
+        assert abs(nx.path_weight(graph, timed_path.path, "flow_time (s)") - timed_path.travel_time) < 1e-6
+
+
+def test_path_set():
+    graph = make_grid_graph()
+    sim = NaiveSimulation(graph, "flow_time (s)", engine="csr")
+    batches = [BatchPaths(0, 3, 5), BatchPaths(2, 1, 3), BatchPaths(0, 3, 2)]
+    parts = [sim.build_paths(batches[:2]), sim.build_paths(batches[2:])]
+    paths = PathSet.concat(pickle.loads(pickle.dumps(parts)), sim.csr.node_ids, n=4)
+    assert paths.n_paths == 10
+    assert len(paths) == 4
+    counts = paths.cell_counts()
+    assert (counts.rows.tolist(), counts.cols.tolist(), counts.values.tolist()) == ([0, 2], [3, 1], [7, 3])
+    assert [(i, j, len(indices)) for i, j, indices in paths.iter_cells()] == [(0, 3, 7), (2, 1, 3)]
+    assert sum(len(cell) for row in paths for cell in row) == 10
+    many_zones = PathSet(paths.nodes, paths.offsets, paths.travel_times, paths.o_zones * 5000, paths.d_zones, n=100_000)
+    assert len(many_zones.cell_indices(10_000, 1)) == 3 and not len(many_zones.cell_indices(5, 3))
+    assert many_zones.cell_counts().nnz == 2
+    for timed_path in paths[0][3]:
+        assert graph.nodes[timed_path.path[0]]["zone"] == 0
+        assert graph.nodes[timed_path.path[-1]]["zone"] == 3
+        assert abs(nx.path_weight(graph, timed_path.path, "flow_time (s)") - timed_path.travel_time) < 1e-9
+
+    nested = [[paths[i][j] for j in range(4)] for i in range(4)]
+    converted = PathSet.from_nested(nested, sim.csr.node_index, sim.csr.node_ids)
+    for i in range(4):
+        for j in range(4):
+            assert converted[i][j] == paths[i][j]
+    starts_ends = [pair for batch in yield_starts_ends(paths, batch_size=4) for b in batch for pair in b.starts_ends]
+    assert starts_ends == [(p.path[0], p.path[-1]) for cell in (paths[0][3], paths[2][1]) for p in cell]
+
+
+def test_edge_flow_state():
+    graph = make_grid_graph()
+    nx.set_edge_attributes(graph, 0, "passes_count")
+    sim = NaiveSimulation(graph, "flow_time (s)", engine="csr")
+    batches = [BatchPaths(0, 1, 30), BatchPaths(3, 2, 30), BatchPaths(1, 0, 30)]
+    paths = PathSet.concat([sim.build_paths(batches)], sim.csr.node_ids, n=4)
+    paths = PathSet.concat([paths, PathSet.from_cells([(0, 0, [PathNT([0, 1], 1.0)] * 5)], sim.csr.node_ids, n=4)])
+
+    expected = recalculate_flow_time(add_passes_count(graph, paths))
+    state = EdgeFlowState.from_networkx(graph)
+    passes = state.count_passes(paths, sim.csr, "flow_time (s)")
+    state.passes += passes
+    assert passes.sum() == sum(len(path) - 1 for row in paths for cell in row for path in (p.path for p in cell))
+    edges = list(graph.edges(keys=True))
+    assert passes[edges.index((1000, 1001, 0))] >= 5 and passes[edges.index((1000, 1001, 1))] == 0
+    state.recalculate_flow_time()
+    result = state.to_graph(graph.copy())
+    for (_, _, expected_data), (_, _, data) in zip(expected.edges(data=True), result.edges(data=True)):
+        for name in ("passes_count", "capacity_occupied", "cur_speed (km/h)", "flow_time (s)"):
+            assert abs(data[name] - expected_data[name]) < 1e-9
+    assert graph[1000][1001][0]["passes_count"] == 0
+
+
+def test_frank_wolfe_assignment():
+    graph = make_grid_graph(size=8)
+    csr = CSRGraph.from_networkx(graph, weights=["flow_time (s)"])
+    origins, targets, counts = np.array([0, 0, 9, 20]), np.array([63, 5, 9, 1]), np.array([3, 2, 4, 1])
+    volumes, costs = all_or_nothing(csr, "flow_time (s)", origins, targets, counts)
+    expected = np.zeros(csr.n_edges)
+    edges = {edge: k for k, edge in enumerate(graph.edges(keys=True))}
+    for u, v, count, cost in zip(origins, targets, counts, costs):
+        expected_cost, path = csr.dijkstra(u, v, "flow_time (s)")
+        assert abs(cost - expected_cost) < 1e-9
+        for a, b in zip(csr.path_to_ids(path), csr.path_to_ids(path)[1:]):
+            key = min(graph[a][b], key=lambda key: graph[a][b][key]["flow_time (s)"])
+            expected[edges[a, b, key]] += count
+    assert np.allclose(volumes, expected)
+
+    trip_mat = np.full((4, 4), 1000)
+    iterations, result = FrankWolfeAssignment(graph).run(trip_mat, max_workers=1, target_gap=1e-3, max_iterations=100)
+    assert iterations[-1].relative_gap <= 1e-3
+    assert iterations[-1].relative_gap < iterations[0].relative_gap
+    assert all(0 <= it.step <= 1 for it in iterations)
+    out_of_zone = trip_mat.sum() - np.trace(trip_mat)
+    assert sum(passes for _, _, passes in result.edges(data="passes_count")) >= out_of_zone
+
+
+def test_all_or_nothing_loading(monkeypatch):
+    graph = make_grid_graph(size=8)
+    sim = NaiveSimulation(graph, "flow_time (s)", engine="csr")
+    paths = PathSet.concat([sim.build_paths([BatchPaths(0, 3, 20), BatchPaths(2, 1, 20)])], sim.csr.node_ids, n=4)
+    volumes, result = AllOrNothingLoading(graph).run(old_paths=paths, max_workers=1)
+    assert np.array_equal(volumes, sim.flow.count_passes(paths, sim.csr, "flow_time (s)"))
+    assert [passes for _, _, passes in result.edges(data="passes_count")] == volumes.tolist()
+
+    origins, targets = paths.nodes[paths.offsets[:-1]], paths.nodes[paths.offsets[1:] - 1]
+    order = np.argsort(origins, kind="stable")
+    counts = np.ones(len(origins))
+    chunked = all_or_nothing(sim.csr, "flow_time (s)", origins[order], targets[order], counts)
+    monkeypatch.setattr(assignment, "TREES_MEMORY_BYTES", 1)
+    assert get_sources_chunk(sim.csr.n_nodes) == 1
+    single = all_or_nothing(sim.csr, "flow_time (s)", origins[order], targets[order], counts)
+    assert np.allclose(single[0], chunked[0]) and np.allclose(single[1], chunked[1])
+
+    csr = sim.csr
+    zone_nodes = [sim.zone_index.get_nodes(str(zone)) for zone in range(4)]
+    trips = np.array([[0, 10, 0, 30], [5, 0, 0, 0]])
+    volumes, costs = zone_all_or_nothing(csr, "flow_time (s)", zone_nodes, np.array([0, 2]), trips)
+    assert np.isfinite(costs[trips > 0]).all()
+    assert abs(volumes @ csr.edge_weights["flow_time (s)"] - costs[trips > 0] @ trips[trips > 0]) < 1e-6
+
+
+def test_reachability_index():
+    graph = make_grid_graph()
+    graph.add_node(2000, lat=60, lon=30, zone=0)
+    graph.add_edge(1000, 2000, **graph[1000][1001][0])
+    graph.add_node(2001, lat=60, lon=30, zone=4)
+    graph.add_edge(2001, 1000, **graph[1000][1001][0])
+    sim = NaiveSimulation(graph, "flow_time (s)", engine="csr")
+    node_index = sim.csr.node_index
+    assert not sim.csr.giant_component()[[node_index[2000], node_index[2001]]].any()
+    assert node_index[2000] not in sim.zone_index.get_nodes("0")
+    assert len(sim.zone_index.get_nodes("4")) == 0
+
+    trip_mat = np.ones((5, 5), dtype=int)
+    unroutable = sim.zone_index.find_unroutable_pairs(trip_mat)
+    assert unroutable == [(0, 4), (1, 4), (2, 4), (3, 4), (4, 0), (4, 1), (4, 2), (4, 3), (4, 4)]
+    with pytest.raises(ValueError, match="9 zone pairs"):
+        sim.run(trip_mat, max_workers=1)
+    paths, _ = sim.run(trip_mat[:4, :4] * 3, max_workers=1)
+    assert paths.n_paths == 48
+
+
+def test_batch_scheduler():
+    trip_mat = np.array([[0, 7, 1], [120, 0, 3], [2, 40, 0]])
+    cells = list(iter_trip_cells(trip_mat))
+    assert [sum(cell.count for cell in part) for part in split_cells(cells, 50)] == [50, 50, 50, 23]
+
+    centroids = np.radians([[60, 30], [60, 30.5], [60.1, 30]])
+    sim = NaiveSimulation(make_grid_graph(), "flow_time (s)", engine="csr")
+    sim.set_nodes_getter(trip_mat, None, seed=3)
+    sim.metrics = SimulationMetrics("test", 2)
+    sink = MemorySink()
+    sink.open(sim.csr.node_ids, 3, 0, [], np.zeros_like(sim.flow.passes))
+    chunks = list(split_cells(cells, 50))
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        scheduler = BatchScheduler(
+            executor, sim.measure_build_paths, 2, ZoneCostModel(centroids), target_seconds=0.01, max_batch_size=30
+        )
+        yielded = list(sim.iter_chunks(scheduler, chunks, sink, lookahead=1))
+    assert [index for index, _ in yielded] == list(range(len(chunks)))
+    assert all(0 < batch.paths <= 30 for batch in sim.metrics.batches)
+    assert np.array_equal(sink.result().cell_counts().to_dense(), trip_mat)
+    for (index, passes), chunk in zip(yielded, chunks):
+        assert np.array_equal(passes, sim.flow.count_passes(sink.get_chunk(index), sim.csr, "flow_time (s)"))
+        assert sink.get_chunk(index).n_paths == sum(cell.count for cell in chunk)
+
+    cell = TripCell(0, 1, 3, [(1, 2), (3, 4), (5, 6)])
+    assert list(to_batch(cell.take(1, 2)).starts_ends) == [(3, 4), (5, 6)]
+    assert SmarterSimulation(make_grid_graph(), "flow_time (s)").calc_batch_size(trip_mat[:1, :1], max_workers=8) == 1
+
+
+def test_pipelined_smarter_simulation():
+    graph = make_grid_graph(size=8)
+    trip_mat = np.full((4, 4), 30)
+    old_paths, _ = SmarterSimulation(graph.copy(), "flow_time (s)", engine="csr").run(trip_mat, max_workers=2)
+
+    def run(weight, staleness):
+        sim = SmarterSimulation(graph.copy(), weight, engine="csr")
+        paths, _ = sim.run(old_paths=old_paths, max_workers=2, n_recalc=8, staleness=staleness)
+        assert np.array_equal(paths.cell_counts().to_dense(), old_paths.cell_counts().to_dense())
+        return sim.flow.passes
+
+    barrier, pipelined = run("flow_time (s)", 0), run("flow_time (s)", 1)
+    assert barrier.sum() > 0
+    assert flow_difference(barrier, pipelined).relative_l1 < 0.5
+    assert flow_difference(run("length (m)", 0), run("length (m)", 2)) == FlowDifference(0.0, 0.0, 0.0)
+
+
+@pytest.mark.parametrize("simulation_cls", [NaiveSimulation, SmarterSimulation])
+def test_checkpoint_resume(tmp_path, monkeypatch, simulation_cls):
+    graph = make_grid_graph(size=8)
+    trip_mat = np.full((4, 4), 10)
+    checkpoint_dir = str(tmp_path / "data")
+    unrelated = [tmp_path / "data" / "edgelist_upd.csv", tmp_path / "data" / "checkpoint" / "notes.txt"]
+    unrelated[1].parent.mkdir(parents=True)
+    for filename in unrelated:
+        filename.write_text("keep")
+    save = SimulationCheckpoint.save
+
+    def interrupted_save(self, index, *args):
+        if index == 2:
+            raise KeyboardInterrupt
+        save(self, index, *args)
+
+    monkeypatch.setattr(SimulationCheckpoint, "save", interrupted_save)
+    with pytest.raises(KeyboardInterrupt):
+        simulation_cls(graph.copy(), "flow_time (s)", engine="csr").run(
+            trip_mat, max_workers=2, checkpoint_dir=checkpoint_dir
+        )
+    monkeypatch.setattr(SimulationCheckpoint, "save", save)
+    saved = SimulationCheckpoint(checkpoint_dir, "").load_paths(2, None, 4)
+
+    sim = simulation_cls(graph.copy(), "flow_time (s)", engine="csr")
+    paths, result = sim.run(trip_mat, max_workers=1, checkpoint_dir=checkpoint_dir, resume=True)
+    assert np.array_equal(paths.cell_counts().to_dense(), trip_mat)
+    assert np.array_equal(paths.nodes[: len(saved[0].nodes)], saved[0].nodes)
+    if simulation_cls is NaiveSimulation:
+        assert np.array_equal(sim.flow.passes, sim.flow.count_passes(paths, sim.csr, "flow_time (s)"))
+
+    again, _ = simulation_cls(graph.copy(), "flow_time (s)", engine="csr").run(
+        trip_mat, max_workers=2, checkpoint_dir=checkpoint_dir, resume=True
+    )
+    assert np.array_equal(again.nodes, paths.nodes)
+
+    simulation_cls(graph.copy(), "flow_time (s)", engine="csr").run(
+        trip_mat, max_workers=1, checkpoint_dir=checkpoint_dir
+    )
+    assert all(filename.read_text() == "keep" for filename in unrelated)
+
+
+def test_path_sinks(tmp_path, monkeypatch):
+    graph = make_grid_graph(size=8)
+    trip_mat = np.full((4, 4), 10)
+    paths_dir = str(tmp_path / "paths")
+    directory, _ = SmarterSimulation(graph.copy(), "flow_time (s)", engine="csr").run(
+        trip_mat, max_workers=2, sink=ColumnarFileSink(paths_dir)
+    )
+    paths = read_paths(directory)
+    assert np.array_equal(paths.cell_counts().to_dense(), trip_mat)
+    assert sum(part.n_paths for part in iter_paths(directory)) == trip_mat.sum()
+
+    sim = NaiveSimulation(graph.copy(), "flow_time (s)", engine="csr")
+    replayed, _ = sim.run(old_paths=paths, max_workers=2)
+    passes, result = NaiveSimulation(graph.copy(), "flow_time (s)", engine="csr").run(
+        old_paths=paths, max_workers=2, sink=EdgeCountSink()
+    )
+    assert np.array_equal(passes, sim.flow.count_passes(replayed, sim.csr, "flow_time (s)"))
+    assert [count for _, _, count in result.edges(data="passes_count")] == passes.tolist()
+
+    save = SimulationCheckpoint.save
+
+    def interrupted_save(self, index, *args):
+        if index == 1:
+            raise KeyboardInterrupt
+        save(self, index, *args)
+
+    monkeypatch.setattr(SimulationCheckpoint, "save", interrupted_save)
+    checkpoint_dir = str(tmp_path / "checkpoint")
+    with pytest.raises(KeyboardInterrupt):
+        NaiveSimulation(graph.copy(), "flow_time (s)", engine="csr").run(
+            trip_mat, max_workers=2, checkpoint_dir=checkpoint_dir, sink=ColumnarFileSink(paths_dir)
+        )
+    monkeypatch.setattr(SimulationCheckpoint, "save", save)
+    assert not glob.glob(os.path.join(checkpoint_dir, "checkpoint", "chunk_*.npz"))
+    NaiveSimulation(graph.copy(), "flow_time (s)", engine="csr").run(
+        trip_mat, max_workers=2, checkpoint_dir=checkpoint_dir, resume=True, sink=ColumnarFileSink(paths_dir)
+    )
+    assert np.array_equal(read_paths(paths_dir).cell_counts().to_dense(), trip_mat)
+
+
+def test_simulation_metrics(tmp_path):
+    graph = make_grid_graph(size=8)
+    trip_mat = np.full((4, 4), 10)
+    metrics_file = str(tmp_path / "metrics.jsonl")
+    sim = SmarterSimulation(graph, "flow_time (s)", engine="csr")
+    sim.run(trip_mat, max_workers=2, metrics_file=metrics_file)
+    metrics = sim.metrics
+    assert metrics.paths == metrics.found == trip_mat.sum()
+    assert metrics.searches >= metrics.found
+    assert metrics.settled_per_search > 0
+    assert 0 < metrics.worker_utilization <= 1.01
+    assert metrics.parent_seconds.keys() >= {"count_passes", "recalculate_flow_time", "set_weights"}
+    assert sorted(batch.chunk for batch in metrics.batches) == [batch.chunk for batch in metrics.batches]
+    with open(metrics_file) as f:
+        records = [json.loads(line) for line in f]
+    assert [record["type"] for record in records] == ["batch"] * len(metrics.batches) + ["summary"]
+    assert records[-1]["paths"] == trip_mat.sum()
+
+    sim = NaiveSimulation(graph, "flow_time (s)")
+    sim.run(trip_mat, max_workers=1)
+    assert sim.metrics.paths == trip_mat.sum()
+    assert sim.metrics.settled_per_search is None
+
+
+def test_seeded_runs_and_route_cache(tmp_path):
+    graph = make_grid_graph(size=8)
+    trip_mat = np.full((4, 4), 10)
+
+    def cells(paths):
+        return [sorted((p.travel_time, tuple(p.path)) for p in cell) for row in paths for cell in row]
+
+    first, _ = NaiveSimulation(graph, "flow_time (s)", engine="csr").run(trip_mat, max_workers=2, batch_size=3, seed=7)
+    second, _ = NaiveSimulation(graph, "flow_time (s)", engine="csr", routing="one_to_many").run(
+        trip_mat, max_workers=1, seed=7
+    )
+    other, _ = NaiveSimulation(graph, "flow_time (s)", engine="csr").run(trip_mat, max_workers=1, seed=8)
+    assert cells(first) == cells(second)
+    assert cells(first) != cells(other)
+
+    getter = RandomNodesGetter(ZoneIndex.from_graph(graph), seed=7)
+    whole = [next(draws) for draws in getter.iter_trips(BatchPaths(1, 2, 2500))]
+    parts = [
+        next(draws)
+        for start, count in ((0, 1000), (1000, 30), (1030, 1470))
+        for draws in getter.iter_trips(BatchPaths(1, 2, count, start=start))
+    ]
+    assert parts == whole and len(set(whole)) > 1
+
+    loading = AllOrNothingLoading(graph)
+    volumes, _ = loading.run(trip_mat, max_workers=1, seed=7)
+    assert np.array_equal(AllOrNothingLoading(graph).run(trip_mat, max_workers=1, seed=7)[0], volumes)
+
+    cache_file = str(tmp_path / "routes.sqlite")
+    sim = SmarterSimulation(graph, "flow_time (s)", engine="csr", route_cache=cache_file)
+    paths, _ = sim.run(trip_mat, max_workers=2, seed=7)
+    assert sim.metrics.cached < sim.metrics.paths
+    sim = SmarterSimulation(graph, "flow_time (s)", engine="csr", route_cache=RouteCache(cache_file))
+    again, _ = sim.run(trip_mat, max_workers=2, seed=7)
+    assert sim.metrics.cached == sim.metrics.paths
+    assert cells(again) == cells(paths)
+
+    sim = NaiveSimulation(graph, "flow_time (s)", engine="csr", route_cache=cache_file)
+    sim.run(old_paths=paths, max_workers=2)
+    sim.run(old_paths=paths, max_workers=2)
+    assert sim.metrics.cached == sim.metrics.paths
+
+
+@pytest.mark.parametrize("engine", ["networkx", "csr"])
+def test_incremental_rerouting(engine):
+    graph = make_grid_graph(size=8)
+    trip_mat = np.full((4, 4), 15)
+    sim = NaiveSimulation(graph, "flow_time (s)", engine=engine)
+    paths, _ = sim.run(trip_mat, max_workers=1, seed=3)
+    index = EdgeUsageIndex.from_paths(paths, sim.csr, sim.weight)
+    assert np.array_equal(index.count_passes(), sim.flow.passes)
+
+    edges = list(graph.edges(keys=True))
+    busiest = edges[int(sim.flow.passes.argmax())]
+    slow = [e for e, (_, _, data) in enumerate(graph.edges(data=True)) if data["maxspeed (km/h)"] == 20]
+    quiet = edges[slow[int(sim.flow.passes[slow].argmin())]]
+    modifications = [EdgeModification(busiest, closed=True), EdgeModification(quiet, maxspeed=200, capacity=3600)]
+    rerouted, new_graph, new_index = sim.reroute(paths, modifications, index, max_workers=1)
+
+    assert rerouted.n_paths == paths.n_paths
+    assert 0 < sim.metrics.paths < paths.n_paths
+    assert np.array_equal(new_index.count_passes(), sim.flow.passes)
+    assert np.array_equal(EdgeUsageIndex.from_paths(rerouted, sim.csr, sim.weight).path_edges, new_index.path_edges)
+    assert sim.flow.passes[edges.index(busiest)] == 0
+    assert new_graph.edges[quiet]["maxspeed (km/h)"] == 200
+    passes = nx.get_edge_attributes(new_graph, "passes_count")
+    occupied = nx.get_edge_attributes(new_graph, "capacity_occupied")
+    assert [passes[edge] for edge in edges] == sim.flow.passes.tolist()
+    assert occupied[quiet] == passes[quiet] / 3600
+
+    reference = NaiveSimulation(graph, "flow_time (s)", engine="csr")
+    reference.apply_modifications(modifications)
+    replayed, _ = reference.run(old_paths=paths, max_workers=1)
+
+    def trip_costs(paths):
+        return sorted(
+            (int(paths.nodes[paths.offsets[k]]), int(paths.nodes[paths.offsets[k + 1] - 1]), round(cost, 6))
+            for k, cost in enumerate(paths.travel_times)
+        )
+
+    assert trip_costs(rerouted) == trip_costs(replayed)
+
+
+def test_scenario_runner():
+    graph = make_grid_graph(size=8)
+    trip_mat = np.full((4, 4), 10)
+    _, base_graph = NaiveSimulation(graph, "flow_time (s)", engine="csr").run(trip_mat, max_workers=1, seed=5)
+    base_passes = [passes for _, _, passes in base_graph.edges(data="passes_count")]
+    edges = list(graph.edges(keys=True))
+    busiest = edges[int(np.argmax(base_passes))]
+
+    scenarios = [
+        Scenario("base"),
+        Scenario("closure", (EdgeModification(busiest, closed=True),)),
+        Scenario("upgrade", (EdgeModification(busiest, maxspeed=120, capacity=3600),)),
+        Scenario("base again"),
+    ]
+    runner = ScenarioRunner(graph)
+    results = runner.run(trip_mat, scenarios, max_workers=2, seed=5)
+
+    assert results.edge_flows["base"].tolist() == base_passes
+    assert results.edge_flows["base again"].tolist() == base_passes
+    assert results.edge_flows.loc[busiest, "closure"] == 0
+    assert results.edge_flows.loc[busiest, "upgrade"] >= results.edge_flows.loc[busiest, "base"]
+    summary = results.summary
+    assert summary["paths"].tolist() == [trip_mat.sum()] * 4
+    assert summary.loc["base", "relative_l1"] == summary.loc["base again", "relative_l1"] == 0
+    assert summary.loc["closure", "relative_l1"] > 0
+    assert summary.loc["closure", "vehicle_hours"] > summary.loc["base", "vehicle_hours"]
+    assert runner.simulation.csr.edge_weights["flow_time (s)"].tolist() == [
+        data for _, _, data in graph.edges(data="flow_time (s)")
+    ]
+
+
+def test_time_sliced_simulation():
+    trip_mat = np.array([[3, 7], [10, 1]])
+    slices = split_trip_mat(trip_mat * 2.5, [0.2, 0.3, 0.4, 0.1])
+    assert np.array_equal(sum(slices), np.rint(trip_mat * 2.5))
+    shares = carryover_shares(np.array([0, 1800, 3600, 7200]), 3600, 3)
+    assert shares.sum(axis=0).tolist() == [0, 0.25, 0.5, 0.75]
+    assert shares[:, 1].tolist() == [0.25, 0, 0] and shares[:, 3].tolist() == [0.5, 0.25, 0]
+
+    graph = make_grid_graph(size=8)
+    trip_mat = np.full((4, 4), 40)
+    sim = TimeSlicedSimulation(graph, "flow_time (s)", engine="csr")
+    profile = np.array([0.1, 0.6, 0.3, 0.0])
+    paths, new_graph = sim.run(trip_mat, profile, daily_scale=1, max_workers=2, n_recalc=2, seed=1)
+
+    assert paths.n_paths == trip_mat.sum()
+    assert [time_slice.trips for time_slice in sim.slices] == [64, 384, 192, 0]
+    passes = sum(time_slice.passes for time_slice in sim.slices)
+    assert np.array_equal(passes, sim.flow.passes)
+    assert passes.sum() == sim.flow.count_passes(paths, sim.csr, sim.weight).sum()
+    assert not sim.slices[0].volumes[passes == 0].any()
+    carried = sim.slices[3].volumes
+    assert carried.sum() > 0 and np.all(carried <= sim.slices[2].passes + 1e-9)
+    busiest = int(np.argmax([time_slice.volumes.max() for time_slice in sim.slices]))
+    assert busiest == 1
+    edges = list(new_graph.edges(data=True))
+    assert [data["passes_count"] for _, _, data in edges] == sim.flow.passes.tolist()
+    e = int(sim.slices[1].volumes.argmax())
+    assert edges[e][2]["peak_capacity_occupied"] == sim.slices[1].volumes[e] / (1800 * 6)
+    assert edges[e][2]["flow_time (s)"] == sim.slices[1].flow_time[e]
+
+    profile = np.zeros(288)
+    profile[0] = 1
+    sim = TimeSlicedSimulation(graph, "flow_time (s)", engine="csr")
+    sim.run(np.full((4, 4), 10), profile, daily_scale=1, max_workers=1, n_recalc=1, seed=1)
+    volumes = [time_slice.volumes.sum() for time_slice in sim.slices]
+    assert volumes[1] > volumes[2] > 0 and not any(volumes[10:])
+
+
+def test_sparse_od_matrix(tmp_path):
+    rng = np.random.default_rng(0)
+    trip_mat = rng.integers(0, 4, size=(6, 6)) * (rng.random((6, 6)) < 0.4)
+    sparse = SparseODMatrix.from_dense(trip_mat)
+    assert sparse.nnz == np.count_nonzero(trip_mat)
+    assert np.array_equal(sparse.to_dense(), trip_mat)
+    assert sparse.sum() == trip_mat.sum()
+    assert np.array_equal(sparse.sum(axis=0), trip_mat.sum(axis=0))
+    assert np.array_equal(sparse.sum(axis=1), trip_mat.sum(axis=1))
+    assert np.array_equal(sparse.crop(4).to_dense(), trip_mat[:4, :4])
+    sparse.save(tmp_path / "trip_mat.npz")
+    assert np.array_equal(load_trip_mat(str(tmp_path)).to_dense(), trip_mat)
+    assert np.array_equal(SparseODMatrix([0, 1], [1, 0], [0.4, 2.6], 2).round().to_dense(), [[0, 0], [3, 0]])
+
+    graph = make_grid_graph(size=8)
+    trip_mat = np.full((4, 4), 5)
+    trip_mat[0, 3] = trip_mat[2, 1] = 0
+
+    def cells(paths):
+        return [sorted((p.travel_time, tuple(p.path)) for p in cell) for row in paths for cell in row]
+
+    dense_paths, _ = NaiveSimulation(graph, "flow_time (s)", engine="csr").run(trip_mat, max_workers=1, seed=2)
+    sparse_paths, _ = NaiveSimulation(graph, "flow_time (s)", engine="csr").run(
+        SparseODMatrix.from_dense(trip_mat), max_workers=1, seed=2
+    )
+    assert cells(sparse_paths) == cells(dense_paths)
+    sim = SmarterSimulation(graph, "flow_time (s)", engine="csr")
+    paths, _ = sim.run(SparseODMatrix.from_dense(trip_mat), n=3, max_workers=1, n_recalc=2)
+    assert np.array_equal(paths.cell_counts().to_dense(), trip_mat[:3, :3])
@@ -1,8 +1,13 @@
 import numpy as np
+import pandas as pd
 import pytest
 
 from city_road_network.downloaders.ghsl import get_tile_ids
 from city_road_network.downloaders.osm import get_relation_poly
+from city_road_network.downloaders.stats import (
+    calc_departure_profile,
+    calc_trip_length_distribution,
+)
 from city_road_network.processing.ghsl import (
     _sort_tile_ids,
     combine_tiles,
@@ -144,3 +149,19 @@ def test_combine_tiles(mocker):
 def test_sort_tiles(tile_ids, expected):
     tile_ids_sorted = _sort_tile_ids(tile_ids)
     assert tile_ids_sorted == expected
+
+
+def test_departure_profile():
+    trips_df = pd.DataFrame(
+        {"STRTTIME": [730, 745, 1710, 1800, -9, 800], "TRPTRANS": [3, 4, 5, 6, 3, 1], "WTTRDFIN": [1, 1, 2, 2, 9, 9]}
+    )
+    profile = calc_departure_profile(trips_df, n_slices=4)
+    assert profile.tolist() == [0.0, 2 / 6, 2 / 6, 2 / 6]
+
+
+def test_trip_length_distribution():
+    trips_df = pd.DataFrame(
+        {"TRPMILES": [0.5, 1, 5, 10, -9, 1], "TRPTRANS": [3, 4, 5, 6, 3, 1], "WTTRDFIN": [1, 1, 2, 4, 9, 9]}
+    )
+    shares = calc_trip_length_distribution(trips_df, [0, 1, 5, 10, np.inf])
+    assert shares.tolist() == [1 / 8, 1 / 8, 2 / 8, 4 / 8]